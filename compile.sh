@@ -7,4 +7,7 @@ if [[ -n "$2" ]]; then
 fi
 
 awk -f preproc.awk < "$1" > "$1".asm
-fasm -m 65536 "$1".asm
+fasm -m 65536 "$1".asm || exit $?
+
+# Don't leave bank around that would crash the driver or can't be checked, magic is up to the listing
+./fplay_check.py -q -f "$1".bin || { rm -f "$1".bin; exit 1; }
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import bisect, argparse
+import fplay_parse
+from fplay_parse import HEADER_BASE_ADDR, FM_TONE_TBL, DRUM_MACRO_TBL
+from fplay_flow import CodeWalker, SKIP_NEXT, SKIP_BYTES
+from tools import *
+
+# Relocatable form of a bank for tools that rewrite it. Bank is cut into units, every code
+# instruction is a unit of its own, everything else is raw data cut at objects and pointer
+# targets. Pointers are kept as relocations to unit keys (original address for everything
+# decoded from file), so units can change size or disappear and assemble() fixes pointers up.
+# Removed unit is just an empty one, pointers to it land on whatever comes next.
+
+HEADER_POINTERS = range(FM_TONE_TBL, DRUM_MACRO_TBL + 2, 2)
+DRUM_ENV_OFFSETS = (3, 5, 7, 9)
+TRACK_SEQ_OFFSET = 8
+
+
+class Unit:
+  __slots__ = ('key', 'data', 'relocs', 'code')
+
+  def __init__(self, key, data, relocs=None, code=False):
+    self.key = key
+    self.data = bytearray(data)
+    self.relocs = relocs if relocs is not None else []   # [(offset, target key, delta)]
+    self.code = code
+
+  def __repr__(self):
+    return f'Unit({self.key!r}, {bytes(self.data).hex()}, {self.relocs})'
+
+
+class Bank:
+  ''' Ordered list of units plus things tools keep asking for: track entries and grammar
+  '''
+
+  def __init__(self, units, entries, use_long=False):
+    self.units = units
+    self.entries = entries
+    self.use_long = use_long
+    self.parser = SequenceParser(use_long, b'')
+    self.fresh = 0
+
+  def new_key(self, hint='new'):
+    self.fresh += 1
+    return (hint, self.fresh)
+
+  def index(self):
+    return {u.key: i for i, u in enumerate(self.units)}
+
+  def decode(self, unit):
+    ''' Parse result for code unit, jump targets come from relocs so they don't matter here
+    '''
+    self.parser.data = bytes(unit.data)
+    return self.parser(0)
+
+  def layout(self):
+    addr_of = {}
+    pos = HEADER_BASE_ADDR
+    for unit in self.units:
+      addr_of[unit.key] = pos
+      pos += len(unit.data)
+    return addr_of, pos
+
+  def assemble(self):
+    addr_of, _ = self.layout()
+    out = bytearray()
+    for unit in self.units:
+      buf = bytearray(unit.data)
+      for offset, key, delta in unit.relocs:
+        buf[offset:offset + 2] = (addr_of[key] + delta).to_bytes(2, 'little')
+      out += buf
+    return bytes(out)
+
+  def size(self):
+    return self.layout()[1] - HEADER_BASE_ADDR
+
+
+def pointer_slots(data):
+  ''' {slot address: target address} for every pointer word outside of code
+  '''
+  slots = {}
+
+  for addr in HEADER_POINTERS:
+    slots[addr] = fplay_parse.get_word(addr)
+
+  for addr, obj in fplay_parse.ADDR_MAP.items():
+    name = getattr(obj, 'name', None)
+    if name in ('pVolSeq', 'pPitchSeq', 'song'):
+      slots[addr] = obj.pos
+    elif name == 'drumDef':
+      for offset in DRUM_ENV_OFFSETS:
+        if (ptr := fplay_parse.get_word(addr + offset)):
+          slots[addr + offset] = ptr
+    elif name == 'track':
+      slots[addr + TRACK_SEQ_OFFSET] = obj.seq_ptr
+
+  return {slot: ptr for slot, ptr in slots.items() if HEADER_BASE_ADDR <= ptr < len(data)}
+
+
+def from_raw(raw, use_long=False):
+  ''' Decode raw bank into relocatable Bank, assemble() of untouched result gives raw back
+  '''
+  fplay_parse.LONG_VCMDS = use_long
+  fplay_parse.load_bank(raw)
+  data = fplay_parse.DATA
+
+  entries = [obj.seq_ptr for obj in fplay_parse.ADDR_MAP.values() if getattr(obj, 'name', None) == 'track']
+  walker = CodeWalker(data, use_long)
+  walker.blocks(entries)
+
+  code = dict(walker.code)
+  for addr, obj in fplay_parse.ADDR_MAP.items():
+    if isinstance(obj, Token):
+      code.setdefault(addr, obj)
+
+  slots = pointer_slots(data)
+
+  # Cut points, code instructions are units on their own
+  cuts = {HEADER_BASE_ADDR, len(data)}
+  covered = 0
+  for addr in sorted(code):
+    if addr < covered:
+      raise ValueError(f'Overlapping code at {addr:04x}')
+    covered = addr + code[addr].length
+    cuts.update((addr, covered))
+  cuts.update(ptr for ptr in slots.values())
+  for addr, obj in fplay_parse.ADDR_MAP.items():
+    if obj is not None and not isinstance(obj, str):
+      cuts.add(addr)
+  cuts = sorted(x for x in cuts if HEADER_BASE_ADDR <= x <= len(data))
+
+  starts = cuts[:-1]
+
+  def target(ptr):
+    i = bisect.bisect_right(starts, ptr) - 1
+    return starts[i], ptr - starts[i]
+
+  units = []
+  for start, end in zip(starts, cuts[1:]):
+    relocs = []
+    for slot in range(start, end):
+      if slot in slots:
+        key, delta = target(slots[slot])
+        relocs.append((slot - start, key, delta))
+
+    if start in code:
+      res = code[start]
+      tgt = walker.target(res)
+      if tgt is not None:
+        key, delta = target(tgt)
+        relocs.append((res.length - 2, key, delta))
+
+    units.append(Unit(start, data[start:end], relocs, start in code))
+
+  bank = Bank(units, entries, use_long)
+  if bank.assemble() != raw:
+    raise ValueError('Bank doesn\'t survive reassembly, some pointer is not understood')
+  return bank
+
+
+def frozen_keys(bank):
+  ''' Units right after swfm/swsg/scne, driver skips fixed number of bytes over them so
+      they must keep their size
+  '''
+  res = set()
+  units = bank.units
+  for i, unit in enumerate(units):
+    if unit.code and unit.data and unit.data[0] in SKIP_NEXT:
+      left = SKIP_BYTES
+      j = i + 1
+      while left > 0 and j < len(units):
+        res.add(units[j].key)
+        left -= len(units[j].data)
+        j += 1
+      if j < len(units):
+        res.add(units[j].key)
+  return res
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Check that FPLAY bank survives relocatable round trip')
+  parser.add_argument('file', help='Path to SONG.DAT')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-l', '--long', action='store_true', help='Use long command names')
+  args = parser.parse_args()
+
+  fplay_parse.FORCE = args.force
+  with open(args.file, 'rb') as f:
+    bank = from_raw(f.read(), args.long)
+
+  code = sum(u.code for u in bank.units)
+  orig_print(f'{len(bank.units)} units, {code} code, {bank.size()} bytes, round trip ok')
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+import argparse
+import fplay_parse
+import fplay_bank
+from fplay_parse import HEADER_BASE_ADDR
+from fplay_flow import CodeWalker, JCNZ, SET_LOOP, ENTER, RETURN, SKIP_BYTES
+from fplay_sim import FM_CHANNELS, DRUM_BASE, DRUM_END
+from tools import *
+
+# Static checks of a bank against what the driver can hold, no playback involved.
+#
+#   size       bank is loaded at 4000h of driver segment into DATA_BUF_SIZE bytes, 48K at most
+#   enter      driver keeps single return address per track (trackState.jump_offset),
+#              enter inside of subroutine overwrites it and return never comes back
+#   jcnz       there is one loop_counter and one loop_escape_cycle per track, loop inside of
+#              loop on the same counter clobbers outer one
+#   tables     i/ve/pe and drum bytes index tables without bounds checks
+#   hangs      PLAY fetch loop only leaves on note, rest, drum or stop, loop of anything else spins
+#              inside of interrupt forever, so does code that runs into bytes that aren't code
+
+MAX_DATA_BUFFER = 0xc000    # maxDataBuffer in PARSE_ARGS, "48K"
+MAX_ENVELOPES = 0x80        # Env index is doubled into byte offset of the table
+
+SET_PITCH_ENV = 0x83
+SET_VOL_ENV = 0x88
+SET_INSTRUMENT = 0xa3
+
+# Conditions on channel are known statically, track header fixes the channel
+JUMP_IF_FM = 0xa1
+JUMP_IF_SSG = 0xa2
+JUMP_IF_CHAN = 0xaa
+SKIP_IF_FM = 0xa5
+SKIP_IF_SSG = 0xa6
+SKIP_IF_CHAN = 0xa9
+
+TABLES = {
+  'header': ('pFmToneTbl', 'pNoteLengthTbl', 'pVolEnvTbl', 'pPitchEnvTbl', 'pSongTbl', 'pDrumMacroTbl', 'magic'),
+  'instruments': ('fmInstrument',),
+  'envelopes': ('pVolSeq', 'pPitchSeq', 'volSeq', 'pitchSeq', 'gateSeq', 'noiseSeq', 'noteLen'),
+  'drum macros': ('drumDef',),
+  'songs': ('song', 'songDef', 'track'),
+}
+TABLE_OF = {name: table for table, names in TABLES.items() for name in names}
+
+
+def footprint(bank):
+  ''' {table: bytes}, code is counted as tracks, bytes nothing points at go to their neighbour
+  '''
+  res = dict.fromkeys(list(TABLES) + ['tracks'], 0)
+  table = 'header'
+  for unit in bank.units:
+    if unit.code:
+      table = 'tracks'
+    else:
+      obj = fplay_parse.ADDR_MAP.get(unit.key)
+      table = TABLE_OF.get(getattr(obj, 'name', None), table)
+    res[table] += len(unit.data)
+  return res
+
+
+def counter(walker, res):
+  # jcnz 0 and slc 0 use loop_counter, anything else loop_escape_cycle
+  return 'loop_counter' if not walker.data[res.addr + 1] else 'loop_escape_cycle'
+
+
+def check_calls(walker, entries, problems):
+  ''' Walks every track with subroutine state, returns max enter depth and
+      {subroutine entry: set of instruction addresses}
+  '''
+  subs = {}
+  depth = 0
+  seen = set()
+  stack = [(x, None) for x in entries]
+
+  while stack:
+    addr, sub = stack.pop()
+    if (addr, sub) in seen:
+      continue
+    seen.add((addr, sub))
+    if sub is not None:
+      subs.setdefault(sub, set()).add(addr)
+
+    res = walker.decode(addr)
+    code = walker.opcode(res) if res._vcmd else None
+
+    if code == ENTER:
+      target = walker.target(res)
+      if sub is not None:
+        depth = max(depth, 2)
+        if target == sub:
+          problems.append(f'{addr:04x}: subroutine {sub:04x} enters itself, recursion never returns')
+        else:
+          problems.append(f'{addr:04x}: enter {target:04x} inside of subroutine {sub:04x}, return address is lost')
+        continue
+      depth = max(depth, 1)
+      stack += [(res.addr + res.length, None), (target, target)]
+      continue
+
+    if code == RETURN and sub is None:
+      problems.append(f'{addr:04x}: return outside of subroutine')
+      continue
+
+    stack += [(x, sub) for x in walker.successors(res)]
+
+  return depth, subs
+
+
+def check_loops(walker, subs, problems):
+  ''' Loops are jcnz jumping back, loop body is address range between target and jcnz.
+      Returns max nesting depth per counter.
+  '''
+  code = [walker.code[x] for x in sorted(walker.code)]
+  loops = []
+  for res in code:
+    if res._vcmd and walker.opcode(res) == JCNZ and walker.target(res) <= res.addr:
+      loops.append((walker.target(res), res.addr, counter(walker, res)))
+
+  sub_counters = {}
+  for entry, addrs in subs.items():
+    sub_counters[entry] = {counter(walker, walker.code[x]) for x in addrs
+                           if walker.code[x]._vcmd and walker.opcode(walker.code[x]) == JCNZ}
+
+  depth = {}
+  for start, end, name in loops:
+    inner = [x for x in loops if x[2] == name and start <= x[0] and x[1] < end]
+    for x in inner:
+      problems.append(f'{x[1]:04x}: loop {x[0]:04x}..{x[1]:04x} inside of loop {start:04x}..{end:04x}, '
+                      f'both use {name}')
+
+    # Subroutine called from loop body shares the counters
+    for res in code:
+      if start <= res.addr < end and res._vcmd and walker.opcode(res) == ENTER:
+        if name in sub_counters.get(walker.target(res), ()):
+          inner.append(res)
+          problems.append(f'{res.addr:04x}: subroutine {walker.target(res):04x} uses {name} '
+                          f'of loop {start:04x}..{end:04x}')
+
+    depth[name] = max(depth.get(name, 0), 1 + bool(inner))
+  return depth
+
+
+def check_refs(walker, problems):
+  ''' Indexes into tables the driver doesn't bounds check
+  '''
+  objs = [o for o in fplay_parse.ADDR_MAP.values() if o is not None and not isinstance(o, str)]
+  sizes = {
+    SET_INSTRUMENT: ('instrument', sum(o.name == 'fmInstrument' for o in objs)),
+    SET_VOL_ENV: ('volume envelope', sum(o.name == 'pVolSeq' for o in objs)),
+    SET_PITCH_ENV: ('pitch envelope', sum(o.name == 'pPitchSeq' for o in objs)),
+  }
+  drums = sum(o.name == 'drumDef' for o in objs)
+  parser = walker.parser
+
+  for table, (what, count) in sizes.items():
+    if table != SET_INSTRUMENT and count > MAX_ENVELOPES:
+      problems.append(f'{count} {what}s, driver can index only {MAX_ENVELOPES}')
+  if drums > parser.drum_hi - parser.drum_lo + 1:
+    problems.append(f'{drums} drum macros, only {parser.drum_hi - parser.drum_lo + 1} drum bytes exist')
+
+  for addr in sorted(walker.code):
+    res = walker.code[addr]
+    op = walker.data[addr]
+    if res._vcmd and op in sizes:
+      what, count = sizes[op]
+      if walker.data[addr + 1] >= count:
+        problems.append(f'{addr:04x}: {what} {walker.data[addr + 1]} out of table of {count}')
+    elif parser.drum_lo <= op <= parser.drum_hi and op - parser.drum_lo >= drums:
+      problems.append(f'{addr:04x}: drum {op - parser.drum_lo} out of table of {drums}')
+
+  # Track headers carry initial envelopes and instrument too
+  for addr, obj in fplay_parse.ADDR_MAP.items():
+    if getattr(obj, 'name', None) == 'track':
+      for offset, op in ((3, SET_VOL_ENV), (4, SET_PITCH_ENV), (10, SET_INSTRUMENT)):
+        what, count = sizes[op]
+        if walker.data[addr + offset] >= count:
+          problems.append(f'{addr:04x}: track header {what} {walker.data[addr + offset]} out of table of {count}')
+
+
+def chan_taken(code, arg, chan):
+  if code in (JUMP_IF_FM, SKIP_IF_FM):
+    return chan < FM_CHANNELS
+  if code in (JUMP_IF_SSG, SKIP_IF_SSG):
+    return chan >= FM_CHANNELS
+  return arg == chan
+
+
+def chan_successors(walker, res, chan):
+  ''' Same as CodeWalker.successors, with channel conditions decided for track on chan
+  '''
+  code = walker.opcode(res)
+  nxt = res.addr + res.length
+  if code in (JUMP_IF_FM, JUMP_IF_SSG, JUMP_IF_CHAN):
+    return [walker.target(res) if chan_taken(code, walker.data[res.addr + 1], chan) else nxt]
+  if code in (SKIP_IF_FM, SKIP_IF_SSG, SKIP_IF_CHAN):
+    return [nxt + SKIP_BYTES if chan_taken(code, walker.data[res.addr + 1], chan) else nxt]
+  return walker.successors(res)
+
+
+def is_code(parser, data, addr):
+  ''' Byte at addr starts instruction of the grammar that fits into bank, parser stops
+      in debugger on anything else
+  '''
+  op = data[addr]
+  if parser.note_lo <= op <= parser.note_hi or parser.drum_lo <= op <= parser.drum_hi:
+    return True
+  return op in parser.commands and addr + parser.commands[op].length <= len(data)
+
+
+def track_graph(walker, entry, chan, problems):
+  ''' Zero time part of track control flow: ({(addr, return address): [successor states]},
+      {jcnz state: state it jumps back to}). Notes, rests and drums end fetch loop, so they and
+      edges out of them are left out, notes map to None. jcnz jumps run out with the counter,
+      they are kept apart.
+  '''
+  graph = {}
+  counted = {}
+  stack = [(entry, None)]
+  while stack:
+    state = stack.pop()
+    if state in graph:
+      continue
+    addr, ret = state
+    graph[state] = None
+
+    if not HEADER_BASE_ADDR <= addr < len(walker.data):
+      problems.append(f'{addr:04x}: track {entry:04x} runs out of bank without stop or goto')
+      continue
+    if not is_code(walker.parser, walker.data, addr):
+      problems.append(f'{addr:04x}: track {entry:04x} runs into byte {walker.data[addr]:02x} that isn\'t code')
+      continue
+    res = walker.decode(addr)
+
+    # Same byte classes as fetch loop, rest is note 0 there
+    code = walker.opcode(res)
+    if code < 0x80 or DRUM_BASE <= code < DRUM_END:
+      stack.append((addr + res.length, ret))
+      continue
+
+    if code == ENTER:
+      # Nested enter is reported by check_calls
+      nxt = [(walker.target(res), res.addr + res.length)] if ret is None else []
+    elif code == RETURN:
+      nxt = [(ret, None)] if ret is not None else []
+    elif code == JCNZ:
+      nxt = [(res.addr + res.length, ret)]
+      counted[state] = (walker.target(res), ret)
+      stack.append(counted[state])
+    else:
+      nxt = [(x, ret) for x in chan_successors(walker, res, chan)]
+    graph[state] = nxt
+    stack += nxt
+
+  return graph, counted
+
+
+def busy_loops(graph):
+  ''' Strongly connected parts of zero time graph that can loop, Tarjan without recursion
+  '''
+  index, low, on_stack, scc_stack = {}, {}, set(), []
+  res = []
+  for root in graph:
+    if graph[root] is None or root in index:
+      continue
+    work = [(root, 0)]
+    while work:
+      node, i = work.pop()
+      if i == 0:
+        index[node] = low[node] = len(index)
+        scc_stack.append(node)
+        on_stack.add(node)
+      succ = [x for x in graph[node] if graph.get(x) is not None]
+      if i < len(succ):
+        work.append((node, i + 1))
+        nxt = succ[i]
+        if nxt not in index:
+          work.append((nxt, 0))
+        elif nxt in on_stack:
+          low[node] = min(low[node], index[nxt])
+        continue
+
+      if work:
+        parent = work[-1][0]
+        low[parent] = min(low[parent], low[node])
+      if low[node] == index[node]:
+        part = []
+        while True:
+          x = scc_stack.pop()
+          on_stack.discard(x)
+          part.append(x)
+          if x == node:
+            break
+        if len(part) > 1 or node in graph[node]:
+          res.append(sorted(part))
+  return res
+
+
+def check_hangs(walker, problems):
+  ''' Loops of code that never gets to note, rest or drum, per track since channel decides jumps.
+      jcnz loop counts as one only when slc inside of it reloads the same counter.
+  '''
+  tracks = {(o.seq_ptr, o.chan) for o in fplay_parse.ADDR_MAP.values() if getattr(o, 'name', None) == 'track'}
+  seen = set()
+
+  def report(part, entry, chan, why):
+    addrs = tuple(sorted({x[0] for x in part}))
+    if addrs not in seen:
+      seen.add(addrs)
+      problems.append(f'{addrs[0]:04x}: loop {", ".join(f"{x:04x}" for x in addrs)} of track {entry:04x} '
+                      f'on channel {chan} {why}')
+
+  for entry, chan in sorted(tracks):
+    graph, counted = track_graph(walker, entry, chan, problems)
+    for part in busy_loops(graph):
+      report(part, entry, chan, 'has no note, rest or drum, driver hangs in interrupt')
+    if not counted:
+      continue
+
+    full = {state: nxt + [counted[state]] if state in counted else nxt for state, nxt in graph.items()}
+    for part in busy_loops(full):
+      members = set(part)
+      reloaded = {counter(walker, walker.code[x[0]]) for x in part if walker.data[x[0]] == SET_LOOP}
+      if any(counted.get(x) in members and counter(walker, walker.code[x[0]]) in reloaded for x in part):
+        report(part, entry, chan, 'has no note, rest or drum and slc reloads its jcnz counter, driver may hang in interrupt')
+
+
+def check_bank(raw, buffer_size=MAX_DATA_BUFFER, use_long=False, force=False):
+  ''' Returns check result with `tables` footprint, `depth` and `problems` list. Bank that
+      fplay_bank can't model has `unmodelled` reason and no `tables`, that alone isn't a problem.
+      Tools checking a bank they just built pass force, magic is not a driver limit.
+  '''
+  saved, fplay_parse.FORCE = fplay_parse.FORCE, force or fplay_parse.FORCE
+  try:
+    return check_loaded(raw, buffer_size, use_long)
+  finally:
+    fplay_parse.FORCE = saved
+
+
+def check_loaded(raw, buffer_size, use_long):
+  res = mkobj('bankCheck', size=len(raw), buffer_size=buffer_size, problems=[], unmodelled=None)
+  try:
+    bank = fplay_bank.from_raw(raw, use_long)
+    res.tables = footprint(bank)
+    entries = bank.entries
+  except ValueError as e:
+    # Relocatable form doesn't know this layout, driver may still play it. Table footprint
+    # needs that form, everything else works on decoded code alone.
+    res.unmodelled = str(e)
+    res.tables = None
+    fplay_parse.LONG_VCMDS = use_long
+    fplay_parse.load_bank(raw)
+    entries = [o.seq_ptr for o in fplay_parse.ADDR_MAP.values() if getattr(o, 'name', None) == 'track']
+  walker = CodeWalker(fplay_parse.DATA, use_long)
+
+  if len(raw) > buffer_size:
+    res.problems.append(f'bank is {len(raw)} bytes, driver buffer is {buffer_size}')
+  if HEADER_BASE_ADDR + len(raw) > 0x10000:
+    res.problems.append(f'bank is {len(raw)} bytes, doesn\'t fit 64K segment after {HEADER_BASE_ADDR:04x}h')
+
+  res.enter_depth, subs = check_calls(walker, entries, res.problems)
+  res.loop_depth = check_loops(walker, subs, res.problems)
+  check_refs(walker, res.problems)
+  check_hangs(walker, res.problems)
+  res.problems = list(dict.fromkeys(res.problems))
+  return res
+
+
+def print_check(res, quiet=False):
+  if res.unmodelled:
+    orig_print(f'bank not modelled, table sizes unknown: {res.unmodelled}')
+  if not quiet:
+    for table, size in (res.tables or {}).items():
+      orig_print(f'{table}\t{size}')
+    orig_print(f'total\t{res.size}\tof {res.buffer_size}, {res.buffer_size - res.size} free')
+    orig_print(f'enter depth\t{res.enter_depth}')
+    for name, depth in sorted(res.loop_depth.items()):
+      orig_print(f'{name} depth\t{depth}')
+  for problem in res.problems:
+    orig_print(problem)
+
+
+def refuse_broken(raw, use_long=False):
+  ''' For tools writing banks, exits instead of writing bank that breaks the driver
+  '''
+  problems = check_bank(raw, use_long=use_long, force=True).problems
+  for problem in problems:
+    orig_print(problem)
+  if problems:
+    raise SystemExit('Bank fails driver limits, not written')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Check FPLAY bank against driver memory and nesting limits')
+  parser.add_argument('file', help='Path to SONG.DAT')
+  parser.add_argument('-b', '--buffer', type=int, default=MAX_DATA_BUFFER // 1024,
+                      help='Driver data buffer size in KiB, as given to the driver')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-l', '--long', action='store_true', help='Use long command names')
+  parser.add_argument('-q', '--quiet', action='store_true', help='Print only problems')
+  args = parser.parse_args()
+
+  with open(args.file, 'rb') as f:
+    raw = f.read()
+  try:
+    res = check_bank(raw, min(args.buffer * 1024, MAX_DATA_BUFFER), args.long, args.force)
+  except ValueError as e:
+    raise SystemExit(f'{args.file}: {e}')
+
+  print_check(res, args.quiet)
+  if res.problems:
+    raise SystemExit(1)
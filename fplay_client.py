@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import os, sys, json, socket, argparse
+
+# Thin client for fplay_daemon.py, imports nothing heavy on purpose.
+#
+#   ./fplay_client.py [-l] [-d] [-f] MADOU.DAT > MADOU.M      same as fplay_parse.py
+#   ./fplay_client.py -c MADOU.M [vcmds.json]                 same as compile.sh
+#
+# When daemon isn't running the request is run locally the old way.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def default_socket():
+  return os.environ.get('FPLAY_SOCKET', f'/tmp/fplay-{os.getuid()}.sock')
+
+
+def request(path, req):
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+    sock.connect(path)
+    sock.sendall(json.dumps(req).encode() + b'\n')
+    with sock.makefile('rb') as f:
+      return json.loads(f.readline())
+
+
+def run_local(args):
+  import subprocess
+  if args.compile:
+    cmd = [os.path.join(HERE, 'compile.sh'), args.file] + ([args.grammar] if args.grammar else [])
+  else:
+    cmd = [sys.executable, os.path.join(HERE, 'fplay_parse.py'), args.file]
+    cmd += [flag for flag, on in (('-l', args.long), ('-d', args.debug), ('-f', args.force), ('-s', args.scan)) if on]
+  return subprocess.run(cmd).returncode
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Decompile or compile FPLAY banks through fplay_daemon.py')
+  parser.add_argument('file', help='Path to SONG.DAT, or listing with -c')
+  parser.add_argument('grammar', nargs='?', help='Grammar to generate macros from when compiling')
+  parser.add_argument('-c', '--compile', action='store_true', help='Compile listing like compile.sh')
+  parser.add_argument('-d', '--debug', action='store_true', help='Print address of each token')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-l', '--long', action='store_true', help='Use long command names for listing')
+  parser.add_argument('-s', '--scan', action='store_true', help='Also decode songs and tracks nothing points at')
+  parser.add_argument('-u', '--unix', default=default_socket(), help='Daemon socket path, $FPLAY_SOCKET by default')
+  args = parser.parse_args()
+
+  if args.compile:
+    req = {'cmd': 'compile', 'file': args.file, 'grammar': args.grammar}
+  else:
+    req = {'cmd': 'decompile', 'file': args.file, 'long': args.long, 'debug': args.debug, 'force': args.force,
+           'scan': args.scan}
+  req['cwd'] = os.getcwd()
+
+  try:
+    res = request(args.unix, req)
+  except (FileNotFoundError, ConnectionRefusedError):
+    sys.exit(run_local(args))
+
+  sys.stdout.write(res['stdout'])
+  sys.stderr.write(res['stderr'])
+  sys.exit(res['code'])
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+import os, re, sys, argparse
+import fplay_parse
+from fplay_sim import SongPlayer, song_pointers, FM_CHANNELS
+from tools import *
+
+# Rough CPU cost of the driver per timer interrupt, to spot songs that risk overrunning it on
+# a real 286 machine. Costs are estimated from fplay.lst: every labelled piece of driver code
+# is walked along its longest path, loops once except `loop` with known cx, called routines
+# added in. Instructions cost their 80286 clock count, writes to port 5Fh cost their fixed
+# 0.6us bus wait on top. So figures are pessimistic, which is what overload check wants.
+#
+# Simulator then says what driver did in each interrupt, and it's priced with these pieces:
+#
+#   interrupt   PLAY_INTERRUPT itself, track routines excluded
+#   track       PFADE, PLAY, SGDRUM, NOIADD, PPORT, SOFTVB, SOFTEV for each active track
+#   tick        tick_overflowed part of PLAY, when track's tempo counter overflows
+#   note/drum   fetch of a note or drum byte, note handler with KEYOFF/KEYON
+#   setton      FM tone load, when note lands on channel that has another instrument loaded
+#   vcmd        fetch and dispatch of a command plus its handler from VCMD_JUMPTABLE
+
+# Next to the tools, so they work from any directory
+LISTING = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fplay.lst')
+
+OPN_CLOCK = 3993600
+DEFAULT_TIMER_A = 0x52    # SYSINI
+PORT_WAIT = 'DUMMY_WAIT06'
+PORT_WAIT_NS = 600
+
+# 80286 clocks, (register operands, memory operand)
+CYCLES_286 = {
+  'mov': (2, 5), 'add': (2, 7), 'adc': (2, 7), 'sub': (2, 7), 'sbb': (2, 7),
+  'and': (2, 7), 'or': (2, 7), 'xor': (2, 7), 'cmp': (2, 6), 'test': (2, 6),
+  'inc': (2, 7), 'dec': (2, 7), 'neg': (2, 7), 'not': (2, 7),
+  'rol': (2, 7), 'ror': (2, 7), 'rcl': (2, 8), 'rcr': (2, 8),
+  'shl': (2, 7), 'shr': (2, 7), 'sal': (2, 7), 'sar': (2, 7),
+  'push': (3, 5), 'pop': (5, 5), 'xchg': (3, 5),
+  'mul': (13, 16), 'imul': (13, 16), 'div': (14, 17), 'idiv': (17, 20),
+  'call': (7, 11), 'jmp': (7, 11),
+  'pushf': 3, 'popf': 5, 'lea': 3, 'les': 7, 'lds': 7, 'cbw': 2, 'cwd': 2,
+  'in': 5, 'out': 3, 'nop': 3, 'cli': 3, 'sti': 2, 'cld': 2, 'std': 2, 'clc': 2, 'stc': 2,
+  'lahf': 2, 'sahf': 2, 'xlat': 5, 'lodsb': 5, 'lodsw': 5, 'stosb': 3, 'stosw': 3,
+  'movsb': 5, 'movsw': 5, 'retn': 11, 'ret': 11, 'retf': 15, 'iret': 17,
+  'loop': 4, 'jcxz': 4,
+}
+JCC_NOT_TAKEN = 3
+LOOP_TAKEN = 8      # Taken jcc is 7+, loop 8
+NAMED_COUNTS = {'FmTone.fbalg': 0x1c}
+DATA_DIRECTIVES = ('db', 'dw', 'dd')
+
+VCMD_TABLE = 'VCMD_JUMPTABLE'
+TRACK_ROUTINES = ('PFADE', 'PLAY', 'SGDRUM', 'NOIADD', 'PPORT', 'SOFTVB', 'SOFTEV')
+# Tone load after channel changed hands, priced separately when it really happens
+RARE_CALLS = ('SETTON',)
+SET_INSTRUMENT = 0xa3
+
+sys.setrecursionlimit(20000)
+
+LINE_RE = re.compile(r'^code:([0-9A-F]{4}) (.*)$')
+
+
+class Listing:
+  ''' Instructions and labels of IDA listing, enough to walk the code
+  '''
+
+  def __init__(self, path=LISTING):
+    self.instrs = []   # [(mnemonic, operands)]
+    self.labels = {}   # name: index in instrs
+    self.local = {}    # name: [index], IDA reuses short names like `loop` in every proc
+
+    with open(path, encoding='utf-8', errors='replace') as f:
+      for line in f:
+        m = LINE_RE.match(line.rstrip('\n'))
+        if not m:
+          continue
+        text = m.group(2).split(';', 1)[0]
+        if not text.strip() or text.split()[0] in ('endp', 'align'):
+          continue
+
+        # Label is anything that starts right after address column
+        if not text[0].isspace():
+          words = text.split(None, 2)
+          if words[0] == 'proc':
+            self.add_label(words[1])
+            continue
+          self.add_label(words[0].rstrip(':'))
+          text = text[len(words[0]):]
+
+        words = text.split(None, 1)
+        if words:
+          self.instrs.append((words[0], words[1].strip() if len(words) > 1 else ''))
+
+  def add_label(self, name):
+    self.labels[name] = len(self.instrs)
+    self.local.setdefault(name, []).append(len(self.instrs))
+
+  def resolve(self, name, pos):
+    ''' Index of label nearest to pos, None for unknown names
+    '''
+    if name not in self.local:
+      return None
+    return min(self.local[name], key=lambda x: abs(x - pos))
+
+  def table(self, name):
+    ''' Labels from `dw offset X` jump table
+    '''
+    res = []
+    pos = self.labels[name]
+    while pos < len(self.instrs) and self.instrs[pos][0] == 'dw' and self.instrs[pos][1].startswith('offset '):
+      res.append(self.instrs[pos][1].split()[1])
+      pos += 1
+    return res
+
+
+def jump_target(operands):
+  words = [x for x in operands.split() if x not in ('short', 'near', 'far', 'ptr')]
+  return words[-1] if words else None
+
+
+def parse_number(text):
+  text = text.strip()
+  if text in NAMED_COUNTS:
+    return NAMED_COUNTS[text]
+  try:
+    return int(text[:-1], 16) if text.lower().endswith('h') else int(text)
+  except ValueError:
+    return None
+
+
+class CostModel:
+  ''' Worst path cost estimates of listing labels, in CPU cycles at given clock
+  '''
+
+  def __init__(self, listing, mhz=8.0):
+    self.listing = listing
+    self.wait = round(PORT_WAIT_NS * mhz / 1000)
+    self.memo = {}
+    self.busy = set()
+
+  def instr(self, mnemonic, operands):
+    cost = CYCLES_286.get(mnemonic)
+    if cost is None:
+      cost = JCC_NOT_TAKEN if mnemonic.startswith('j') else 2
+    elif isinstance(cost, tuple):
+      cost = cost['[' in operands]
+    if mnemonic == 'out' and operands.startswith(PORT_WAIT):
+      cost += self.wait
+    return cost
+
+  def loop_count(self, head):
+    # `mov cx, N` shortly before loop head
+    for pos in range(head - 1, max(head - 8, 0), -1):
+      mnemonic, operands = self.listing.instrs[pos]
+      if mnemonic == 'mov' and operands.startswith('cx,'):
+        return parse_number(operands[3:])
+    return None
+
+  def cost(self, label, stops=(), skip=()):
+    ''' Cycles of the longest path from label to return, `stops` labels end the walk,
+        `skip` routines are not added when called
+    '''
+    labels = self.listing.labels
+    stop = frozenset(labels[x] for x in stops if x in labels)
+    return self.walk(labels[label], stop, frozenset(skip))
+
+  def walk(self, pos, stop, skip):
+    key = (pos, stop, skip)
+    if key in self.memo:
+      return self.memo[key]
+    if key in self.busy or pos >= len(self.listing.instrs):
+      return 0   # Back edge, loop is counted once unless it's `loop` with known count
+
+    mnemonic, operands = self.listing.instrs[pos]
+    if mnemonic in DATA_DIRECTIVES:
+      return 0
+
+    self.busy.add(key)
+    nxt = lambda p: 0 if p in stop else self.walk(p, stop, skip)
+    name = jump_target(operands)
+    target = self.listing.resolve(name, pos)
+    total = self.instr(mnemonic, operands)
+
+    if target == pos:
+      target += 1   # Several handlers start with `jmp $+2`, IDA names it as jump to itself
+
+    if mnemonic in ('retn', 'ret', 'retf', 'iret'):
+      pass
+    elif mnemonic == 'jmp':
+      total += nxt(target) if target is not None else 0
+    elif mnemonic == 'loop' and target is not None and target < pos:
+      count = self.loop_count(target)
+      if count:
+        body = self.walk(target, stop | {pos}, skip)
+        total += (count - 1) * (body + LOOP_TAKEN - total)
+      total += nxt(pos + 1)
+    elif mnemonic.startswith('j') or mnemonic == 'loop':
+      taken = LOOP_TAKEN - total + nxt(target) if target is not None else 0
+      total += max(nxt(pos + 1), taken)
+    else:
+      if mnemonic == 'call' and target is not None and name not in skip:
+        total += self.walk(target, frozenset(), skip)
+      total += nxt(pos + 1)
+
+    self.busy.discard(key)
+    self.memo[key] = total
+    return total
+
+  def pieces(self):
+    ''' Costs of everything simulator reports, see top of the file
+    '''
+    res = mkobj('costPieces')
+    res.interrupt = self.cost('PLAY_INTERRUPT', skip=TRACK_ROUTINES + ('INIT_TRACKS', 'STPBGM'))
+    res.track = sum(self.cost(x, stops=('tick_overflowed',), skip=RARE_CALLS) for x in TRACK_ROUTINES)
+    res.tick = self.cost('tick_overflowed', stops=('__loadCmd', '__finishLoop'))
+    res.setton = self.cost('SETTON')
+
+    fetch = self.cost('__loadCmd', stops=('__cmd_00_7f', '__cmd_80_cf', '__play_drum', '__set_note_0'))
+    res.note = fetch + self.cost('__cmd_00_7f', stops=('__finishLoop',), skip=RARE_CALLS)
+    res.drum = fetch + self.cost('__play_drum', stops=('__finishLoop',), skip=RARE_CALLS)
+    dispatch = fetch + self.cost('__cmd_80_cf', stops=('__finishLoop', '__jmp_fetchCmd'))
+    res.vcmds = {}
+    for i, name in enumerate(self.listing.table(VCMD_TABLE)):
+      res.vcmds[0x80 + i] = mkobj('vcmdCost', handler=name, cycles=dispatch + self.cost(name))
+    return res
+
+
+def budget(mhz, timer_a=DEFAULT_TIMER_A):
+  ''' Cycles between two OPN timer A interrupts
+  '''
+  period = 72 * (1024 - timer_a) / OPN_CLOCK
+  return round(mhz * 1e6 * period)
+
+
+class CostPlayer(SongPlayer):
+  ''' Simulator that prices what driver does in every interrupt
+  '''
+
+  def __init__(self, pieces, data, song_ptr, **kwargs):
+    self.pieces = pieces
+    self.cycles = 0
+    self.items = []
+    self.chan_inst = {}   # CUR_INSTS, SETTON only runs when channel has other tone loaded
+    super().__init__(data, song_ptr, **kwargs)
+
+  def trace(self, track, item):
+    self.items.append((track, item))
+    if item == 'tick':
+      self.cycles += self.pieces.tick
+    elif item < 0x80:
+      self.cycles += self.pieces.note
+    elif item in self.pieces.vcmds:
+      self.cycles += self.pieces.vcmds[item].cycles
+    else:
+      self.cycles += self.pieces.drum
+
+  def step(self):
+    active = sum(t.active for t in self.tracks)
+    self.cycles = self.pieces.interrupt + active * self.pieces.track
+    self.items = []
+    events = super().step()
+
+    # Tone loads, instrument is known only after note or drum was processed
+    for track, item in self.items:
+      if item == 'tick' or track.blocked or track.chan >= FM_CHANNELS:
+        continue
+      if item == SET_INSTRUMENT:
+        self.chan_inst[track.chan] = track.instrument
+      elif item < 0x80 or item not in self.pieces.vcmds:
+        if self.chan_inst.get(track.chan) != track.instrument:
+          self.chan_inst[track.chan] = track.instrument
+          self.cycles += self.pieces.setton
+    return events
+
+  def profile(self, max_interrupts):
+    ''' [(cycles, [(track, what ran)])] for every interrupt
+    '''
+    res = []
+    while not self.finished and self.interrupt < max_interrupts:
+      self.step()
+      res.append((self.cycles, self.items))
+    return res
+
+
+def describe(items, parser):
+  names = []
+  for track, item in items:
+    if item == 'tick':
+      continue
+    if item < 0x80:
+      names.append('note')
+    elif item in parser.commands:
+      names.append(parser.commands[item].name)
+    else:
+      names.append('drum')
+  return ' '.join(names)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Estimate FPLAY driver CPU load per timer interrupt')
+  parser.add_argument('file', nargs='?', help='Path to SONG.DAT')
+  parser.add_argument('song', type=int, nargs='*', help='Song indexes, all songs by default')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-c', '--mhz', type=float, default=8.0, help='CPU clock, MHz')
+  parser.add_argument('-t', '--timer', type=lambda x: int(x, 0), default=DEFAULT_TIMER_A, help='OPN timer A value')
+  parser.add_argument('-w', '--worst', type=int, default=0, help='Show this many most expensive interrupts per song')
+  parser.add_argument('-m', '--max', type=int, default=20000, help='Stop after this many interrupts')
+  parser.add_argument('--table', action='store_true', help='Print cost of every piece instead')
+  args = parser.parse_args()
+
+  model = CostModel(Listing(), args.mhz)
+  pieces = model.pieces()
+  limit = budget(args.mhz, args.timer)
+
+  if args.table or not args.file:
+    for name in ('interrupt', 'track', 'tick', 'note', 'drum', 'setton'):
+      orig_print(f'{name}\t{getattr(pieces, name)}')
+    for code, cost in sorted(pieces.vcmds.items()):
+      orig_print(f'{code:02x}\t{cost.cycles}\t{cost.handler}')
+    orig_print(f'budget\t{limit}')
+    raise SystemExit
+
+  fplay_parse.FORCE = args.force
+  with open(args.file, 'rb') as f:
+    fplay_parse.load_bank(f.read())
+  data = fplay_parse.DATA
+  songs = song_pointers(data)
+
+  orig_print('song\tinterrupts\tavg\tworst\tat\tload')
+  over = False
+  for num in args.song or range(len(songs)):
+    player = CostPlayer(pieces, data, songs[num])
+    prof = player.profile(args.max)
+    if not prof:
+      continue
+    worst = max(range(len(prof)), key=lambda i: prof[i][0])
+    avg = sum(x for x, _ in prof) / len(prof)
+    over |= prof[worst][0] > limit
+    orig_print(f'{num}\t{len(prof)}\t{avg:.0f}\t{prof[worst][0]}\t{worst}\t{prof[worst][0] / limit:.1%}')
+
+    for i in sorted(range(len(prof)), key=lambda i: -prof[i][0])[:args.worst]:
+      orig_print(f'\t\t{i}\t{prof[i][0]}\t{describe(prof[i][1], player.parser)}')
+
+  if over:
+    raise SystemExit(1)
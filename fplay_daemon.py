@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import io, os, sys, json, shutil, hashlib, argparse, signal, threading, subprocess, traceback, socketserver, multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import fplay_parse
+import gen_macro
+import fplay_check
+from tools import *
+
+# Keeps interpreter, tools.py and grammars warm and serves decompile/compile requests over
+# a unix socket. Requests are read by threads and run in a pool of worker processes forked once
+# grammars are parsed, so requests from parallel builds run side by side while workers keep
+# whatever they cached for the life of daemon. Decoder module state is reset by every decode.
+# Listings are also cached in daemon itself by bank bytes, options and grammar, so decompile
+# of the same bank from any directory is answered without a worker.
+#
+# Request is one JSON line, response is one JSON line {"code": 0, "stdout": "...", "stderr": "..."}
+#
+#   {"cmd": "decompile", "cwd": "/dir", "file": "MADOU.DAT", "long": false, "debug": false, "force": false,
+#    "scan": false}
+#   {"cmd": "compile", "cwd": "/dir", "file": "MADOU.M", "grammar": "vcmds.json"}
+#
+# fplay_client.py speaks this protocol and mirrors fplay_parse.py and compile.sh command lines.
+
+GRAMMAR_STAMP = '.grammar_stamp'
+GENERATED = ('vcmds.inc', 'preproc.awk')
+LISTING_CACHE = 256
+
+
+def default_socket():
+  return os.environ.get('FPLAY_SOCKET', f'/tmp/fplay-{os.getuid()}.sock')
+
+
+def file_digest(path):
+  with open(path, 'rb') as f:
+    return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def decompile(path, use_long=False, debug=False, force=False, scan=False):
+  fplay_parse.LONG_VCMDS = use_long
+  fplay_parse.DEBUG_ENABLED = debug
+  fplay_parse.FORCE = force
+  fplay_parse.SCAN = scan
+
+  with open(path, 'rb') as f:
+    raw = f.read()
+
+  out = io.StringIO()
+  with redirect_stdout(out):
+    fplay_parse.do_barrel_roll(raw)
+  return out.getvalue()
+
+
+def regen_macros(grammar):
+  ''' Same as ./gen_macro.py grammar, skipped when generated files already match grammar
+  '''
+  with open(grammar, 'rb') as f:
+    digest = hashlib.sha1(f.read()).hexdigest()
+
+  # Generated files' mtimes are part of stamp, so running compile.sh in between is noticed
+  def stamp():
+    return ' '.join([digest] + [str(os.stat(x).st_mtime_ns) for x in GENERATED])
+
+  if all(os.path.exists(x) for x in GENERATED + (GRAMMAR_STAMP,)):
+    with open(GRAMMAR_STAMP) as f:
+      if f.read() == stamp():
+        return
+
+  gen_macro.generate(grammar)
+  with open(GRAMMAR_STAMP, 'w') as f:
+    f.write(stamp())
+
+
+def compile_listing(listing, grammar=None):
+  ''' Same steps as compile.sh, returns (code, stdout, stderr)
+  '''
+  if not shutil.which('fasm'):
+    return 1, '', 'fasm not found\n'
+
+  if grammar:
+    regen_macros(grammar)
+
+  with open(listing, 'rb') as src, open(listing + '.asm', 'wb') as dst:
+    res = subprocess.run(['awk', '-f', 'preproc.awk'], stdin=src, stdout=dst, stderr=subprocess.PIPE)
+  if res.returncode:
+    return res.returncode, '', res.stderr.decode(errors='replace')
+
+  res = subprocess.run(['fasm', '-m', '65536', listing + '.asm'], capture_output=True)
+  out, err = res.stdout.decode(errors='replace'), res.stderr.decode(errors='replace')
+  if res.returncode:
+    return res.returncode, out, err
+
+  # Same as fplay_check.py -q -f in compile.sh, bank that can't be checked is removed too
+  with open(listing + '.bin', 'rb') as f:
+    raw = f.read()
+  try:
+    res = fplay_check.check_bank(raw, force=True)
+  except Exception as e:
+    os.unlink(listing + '.bin')
+    return 1, out, err + f'{listing}.bin: {type(e).__name__}: {e}\n'
+  problems = res.problems
+  if res.unmodelled:
+    out += f'bank not modelled, table sizes unknown: {res.unmodelled}\n'
+  if problems:
+    os.unlink(listing + '.bin')
+    return 1, out + ''.join(x + '\n' for x in problems), err
+  return 0, out, err
+
+
+def handle_request(req):
+  os.chdir(req.get('cwd', '.'))
+  cmd = req.get('cmd')
+
+  if cmd == 'decompile':
+    out = decompile(req['file'], req.get('long', False), req.get('debug', False), req.get('force', False),
+                    req.get('scan', False))
+    return 0, out, ''
+  if cmd == 'compile':
+    return compile_listing(req['file'], req.get('grammar'))
+  if cmd == 'ping':
+    return 0, 'pong\n', ''
+  raise ValueError(f'Unknown command {cmd!r}')
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+  def handle(self):
+    try:
+      code, out, err = self.server.request(json.loads(self.rfile.readline()))
+    except Exception:
+      code, out, err = 1, '', traceback.format_exc()
+    self.wfile.write(json.dumps({'code': code, 'stdout': out, 'stderr': err}).encode() + b'\n')
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, path, workers=None):
+    super().__init__(path, RequestHandler)
+    # Fork context starts every worker at first submit, start() does it while caches are warm.
+    # Ctrl-C is for daemon, workers go away with pool.
+    self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork'),
+                                    initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+    self.lock = threading.Lock()
+    # (bank digest, grammar digest, long, debug, force, scan) -> listing text
+    self.listings = OrderedDict()
+
+  def start(self):
+    self.pool.submit(os.getpid).result()
+
+  def request(self, req):
+    if req.get('cmd') == 'ping':
+      return 0, 'pong\n', ''
+    if req.get('cmd') != 'decompile':
+      return self.pool.submit(handle_request, req).result()
+
+    opts = tuple(req.get(x, False) for x in ('long', 'debug', 'force', 'scan'))
+    key = (file_digest(os.path.join(req.get('cwd', '.'), req['file'])), file_digest(grammar_path(opts[0]))) + opts
+    with self.lock:
+      if key in self.listings:
+        self.listings.move_to_end(key)
+        return 0, self.listings[key], ''
+
+    code, out, err = self.pool.submit(handle_request, req).result()
+    if not code:
+      with self.lock:
+        self.listings[key] = out
+        if len(self.listings) > LISTING_CACHE:
+          self.listings.popitem(last=False)
+    return code, out, err
+
+
+def warm_up():
+  # Parse both grammars once so forked workers get them from parser cache
+  for use_long in (False, True):
+    try:
+      SequenceParser(use_long, b'')
+    except OSError:
+      pass
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Serve FPLAY decompile/compile requests over a unix socket')
+  parser.add_argument('-u', '--unix', default=default_socket(), help='Unix socket path, $FPLAY_SOCKET by default')
+  parser.add_argument('-j', '--jobs', type=int, help='Worker processes, CPU count by default')
+  args = parser.parse_args()
+
+  warm_up()
+  if os.path.exists(args.unix):
+    os.unlink(args.unix)
+
+  with Daemon(args.unix, args.jobs) as server:
+    try:
+      server.start()
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.pool.shutdown(cancel_futures=True)
+      os.unlink(args.unix)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import argparse, hashlib
+from collections import deque
+import fplay_parse
+from fplay_parse import SNG_TBL
+from fplay_flow import CodeWalker
+from tools import *
+
+# Structural diff of two banks. Objects are compared by content digest instead of address,
+# pointers inside objects are replaced with digests of what they point to, so an inserted
+# byte doesn't make everything after it look different. Objects that didn't match by content
+# are paired by their position (table index, song/track/block order) and reported as changed.
+
+ENVELOPES = ('volSeq', 'pitchSeq', 'gateSeq', 'noiseSeq')
+CATEGORIES = ('instrument',) + ENVELOPES + ('drum', 'song', 'block')
+
+
+def digest(*parts):
+  h = hashlib.blake2b(digest_size=8)
+  for part in parts:
+    h.update(part if isinstance(part, (bytes, bytearray)) else repr(part).encode())
+  return h.hexdigest()
+
+
+def block_text(block, limit=8):
+  names = [res.name for res in block[:limit]]
+  if len(block) > limit:
+    names.append('...')
+  return ' '.join(names)
+
+
+def summarize_bank(raw):
+  ''' Load bank and return {category: [(position, digest, info)]}, info is shown in reports
+  '''
+  fplay_parse.load_bank(raw)
+  data = fplay_parse.DATA
+  res = {cat: [] for cat in CATEGORIES}
+  env_digests = {}
+  counters = dict.fromkeys(ENVELOPES, 0)
+
+  for addr, obj in fplay_parse.ADDR_MAP.items():
+    name = getattr(obj, 'name', None)
+
+    if name == 'fmInstrument':
+      res['instrument'].append((len(res['instrument']), digest(data[addr:addr + obj.length]), f'{addr:04x}'))
+
+    elif name in ENVELOPES:
+      env_digests[addr] = dig = digest(name, data[addr:addr + obj.length])
+      res[name].append((counters[name], dig, f'{addr:04x}'))
+      counters[name] += 1
+
+  for addr, obj in fplay_parse.ADDR_MAP.items():
+    if getattr(obj, 'name', None) == 'drumDef':
+      envs = [env_digests.get(ptr) for ptr in
+              (obj.vol_env_ptr, obj.pitch_env_ptr, obj.ssg_mask_env_ptr, obj.ssg_noise_env_ptr)]
+      res['drum'].append((len(res['drum']), digest(obj.instr, obj.note, obj.vol_mod, envs), f'{addr:04x}'))
+
+  walker = CodeWalker(data, fplay_parse.LONG_VCMDS)
+  tbl = fplay_parse.get_word(SNG_TBL)
+  block_digests = {}
+
+  for song_idx, (addr, obj) in enumerate(
+      (a, o) for a, o in fplay_parse.ADDR_MAP.items() if getattr(o, 'name', None) == 'song'):
+    song_ptr = obj.pos
+    tracks = []
+
+    for track_idx in range(data[song_ptr] & 0xf):
+      hdr_ptr = song_ptr + 1 + track_idx * 0xc
+      seq_ptr = int.from_bytes(data[hdr_ptr + 8:hdr_ptr + 10], 'little')
+      blocks = walker.blocks([seq_ptr])
+
+      # Shape ignores jump addresses, full digest swaps them for shape of jump target
+      shapes = {}
+      for start, block in blocks.items():
+        shape = []
+        for ins in block:
+          raw_ins = data[ins.addr:ins.addr + ins.length]
+          shape.append(raw_ins[:-2] if walker.target(ins) is not None else raw_ins)
+        shapes[start] = digest(*shape)
+
+      track_digests = []
+      for block_idx, (start, block) in enumerate(blocks.items()):
+        parts = []
+        for ins in block:
+          raw_ins = data[ins.addr:ins.addr + ins.length]
+          if (target := walker.target(ins)) is not None:
+            parts += [raw_ins[:-2], shapes.get(target)]
+          else:
+            parts.append(raw_ins)
+        parts += [shapes.get(x) for x in walker.block_successors(block)]
+        dig = digest(*parts)
+        track_digests.append(dig)
+
+        # Blocks shared between tracks and songs are reported once, at first place they show up
+        if start not in block_digests:
+          block_digests[start] = dig
+          res['block'].append(((song_idx, track_idx, block_idx), dig, f'{start:04x} {block_text(block)}'))
+
+      tracks.append(digest(data[hdr_ptr:hdr_ptr + 8], data[hdr_ptr + 10:hdr_ptr + 12], track_digests))
+
+    index = (addr - tbl) // 2
+    res['song'].append((song_idx, digest(data[song_ptr], tracks), f'#{index} {song_ptr:04x}'))
+
+  return res
+
+
+def align(old, new):
+  ''' Pairs items by digest first, then leftovers by position. Linear in number of items.
+      Returns (same, moved, changed, removed, added) lists.
+  '''
+  by_digest = {}
+  for item in old:
+    by_digest.setdefault(item[1], deque()).append(item)
+
+  same, moved, rest_new = [], [], []
+  for item in new:
+    bucket = by_digest.get(item[1])
+    if bucket:
+      match = bucket.popleft()
+      (same if match[0] == item[0] else moved).append((match, item))
+    else:
+      rest_new.append(item)
+
+  rest_old = {item[0]: item for bucket in by_digest.values() for item in bucket}
+  changed, added = [], []
+  for item in rest_new:
+    match = rest_old.pop(item[0], None)
+    if match is None:
+      added.append(item)
+    else:
+      changed.append((match, item))
+
+  removed = sorted(rest_old.values())
+  return same, moved, changed, removed, added
+
+
+def diff_banks(old_raw, new_raw):
+  ''' Returns {category: (same, moved, changed, removed, added)}
+  '''
+  old = summarize_bank(old_raw)
+  new = summarize_bank(new_raw)
+  return {cat: align(old[cat], new[cat]) for cat in CATEGORIES}
+
+
+def fmt_pos(pos):
+  return '/'.join(str(x) for x in pos) if isinstance(pos, tuple) else str(pos)
+
+
+def print_diff(res, show_moved=False):
+  for cat in CATEGORIES:
+    same, moved, changed, removed, added = res[cat]
+    if not (changed or removed or added or (show_moved and moved)):
+      continue
+
+    orig_print(f'{cat}: {len(changed)} changed, {len(added)} added, {len(removed)} removed, '
+               f'{len(moved)} moved, {len(same)} same')
+    for old, new in changed:
+      orig_print(f'~ {cat} {fmt_pos(new[0])}\t{old[2]}\t->\t{new[2]}')
+    for item in removed:
+      orig_print(f'- {cat} {fmt_pos(item[0])}\t{item[2]}')
+    for item in added:
+      orig_print(f'+ {cat} {fmt_pos(item[0])}\t{item[2]}')
+    if show_moved:
+      for old, new in moved:
+        orig_print(f'> {cat} {fmt_pos(old[0])} -> {fmt_pos(new[0])}\t{new[2]}')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Structural diff of two FPLAY banks')
+  parser.add_argument('old', help='Path to old SONG.DAT')
+  parser.add_argument('new', help='Path to new SONG.DAT')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-m', '--moved', action='store_true', help='Also list objects that only moved')
+  args = parser.parse_args()
+
+  fplay_parse.FORCE = args.force
+  with open(args.old, 'rb') as f:
+    old_raw = f.read()
+  with open(args.new, 'rb') as f:
+    new_raw = f.read()
+
+  print_diff(diff_banks(old_raw, new_raw), args.moved)
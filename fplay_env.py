@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+import argparse
+from array import array
+import fplay_parse
+from fplay_parse import VOL_TBL, PITCH_TBL, DRUM_MACRO_TBL
+from tools import *
+
+# Envelope token lists produced by proc_volseq/proc_pitchseq/proc_drumseq expanded into
+# plain value arrays with control tokens and jumps resolved, so player only indexes them.
+# Curves are memoized by (kind, address) and shared between every track and drumDef.
+
+VOL_CODES = {'vMark': 0x80, 'vStop': 0x81, 'vRestart': 0x82, 'vJump': 0x83, 'vJumpFar': 0x84, 'nEnd': 0xff}
+PITCH_CODES = {'pStop': 0x80, 'pJump': 0x81}
+DRUM_CODES = {'vStop': 0x81, 'nEnd': 0xff}
+
+SEQ_PROCS = {
+  'volSeq': fplay_parse.proc_volseq,
+  'pitchSeq': fplay_parse.proc_pitchseq,
+  'gateSeq': lambda ptr: fplay_parse.proc_drumseq(ptr, name='gateSeq'),
+  'noiseSeq': lambda ptr: fplay_parse.proc_drumseq(ptr, name='noiseSeq'),
+}
+
+CURVES = {}
+CURVES_DATA = None
+
+
+class EnvelopeCurve:
+  ''' Attack plays once from key on, then loop repeats while key is held, empty loop holds
+      last attack value. Envelopes with a sustain mark keep another curve for key off.
+  '''
+  __slots__ = ('attack', 'loop', 'release')
+
+  def __init__(self, attack, loop, release=None):
+    self.attack = attack
+    self.loop = loop
+    self.release = release
+
+  def value(self, step, released_at=None):
+    if self.release is not None and released_at is not None and step >= released_at:
+      return self.release.value(step - released_at)
+
+    if step < len(self.attack):
+      return self.attack[step]
+    if self.loop:
+      return self.loop[(step - len(self.attack)) % len(self.loop)]
+    return self.attack[-1] if self.attack else 0
+
+  def __len__(self):
+    return len(self.attack) + len(self.loop)
+
+  def __repr__(self):
+    res = f'attack={list(self.attack)} loop={list(self.loop)}'
+    if self.release is not None:
+      res += f' release=({self.release!r})'
+    return res
+
+
+def seq_bytes(tokens, codes):
+  ''' Turn token list back into bytes, jump arguments are taken as they are
+  '''
+  res = bytearray()
+  for i, tok in enumerate(tokens):
+    if isinstance(tok, str):
+      res.append(codes[tok])
+    elif i and tokens[i-1] == 'vJumpFar':
+      res += tok.to_bytes(2, 'little')
+    else:
+      res.append(tok & 0xff)
+  return res
+
+
+def walk(raw, step, typecode):
+  ''' Drive byte level envelope walker from the start until it stops or revisits a position.
+      `step` returns (value, next position) or None to hold. Returns attack and loop arrays.
+  '''
+  values = array(typecode)
+  seen = {}
+  pos = 0
+
+  while pos < len(raw):
+    if pos in seen:
+      at = seen[pos]
+      return values[:at], values[at:]
+    res = step(raw, pos)
+    if res is None:
+      break
+    seen[pos] = len(values)
+    value, pos = res
+    values.append(value)
+
+  return values, array(typecode)
+
+
+def expand_volseq(tokens):
+  raw = seq_bytes(tokens, VOL_CODES)
+
+  end = len(raw)
+  for i, val in enumerate(raw):
+    if val >= 0x80:
+      end = i
+      break
+
+  attack = array('b', raw[:end])
+  loop = array('b')
+  tail = raw[end] if end < len(raw) else 0x81
+
+  # SOFTEV jumps go backwards relative to their own location, restart goes to the very beginning.
+  # vStop and nEnd hold last level.
+  if tail == 0x82:
+    attack, loop = loop, attack
+  elif tail == 0x83:
+    loop = attack[max(end - raw[end + 1] - 1, 0):]
+  elif tail == 0x84:
+    # Far jump also shifts every following level by restart offset
+    offset = int.from_bytes(raw[end + 2:end + 3], 'little', signed=True)
+    loop = array('b', (min(max(x + offset, 0), 0xf) for x in attack[max(end - raw[end + 1] - 1, 0):]))
+  elif tail == 0x80:
+    # Sustain mark, level holds while key is held, rest of envelope plays after key off
+    return EnvelopeCurve(attack, loop, expand_volseq(tokens[end + 1:]))
+
+  return EnvelopeCurve(attack, loop)
+
+
+def expand_pitchseq(tokens):
+  raw = seq_bytes(tokens, PITCH_CODES)
+
+  # VIBADD: 80 restarts from envelope start, 81 n jumps n bytes back from the 81 itself
+  def step(raw, pos):
+    val = raw[pos]
+    if val == 0x80:
+      pos = 0
+      val = raw[pos]
+    elif val == 0x81:
+      pos -= raw[pos + 1]
+      val = raw[pos]
+    if val in (0x80, 0x81):
+      return None
+    return int.from_bytes(bytes([val]), 'little', signed=True), pos + 1
+
+  attack, loop = walk(raw, step, 'b')
+  return EnvelopeCurve(attack, loop)
+
+
+def expand_drumseq(tokens):
+  # SGDRUM steps once per interrupt and holds last value before terminator
+  values = array('B', (x for x in tokens if not isinstance(x, str)))
+  return EnvelopeCurve(values, array('B'))
+
+
+EXPANDERS = {
+  'volSeq': expand_volseq,
+  'pitchSeq': expand_pitchseq,
+  'gateSeq': expand_drumseq,
+  'noiseSeq': expand_drumseq,
+}
+
+
+def get_curve(ptr, kind):
+  ''' Memoized curve for envelope of given kind at bank address, None for null pointers.
+      Cache follows fplay_parse.DATA, loading another bank drops it.
+  '''
+  global CURVES_DATA
+
+  if CURVES_DATA is not fplay_parse.DATA:
+    CURVES.clear()
+    CURVES_DATA = fplay_parse.DATA
+
+  if not ptr:
+    return None
+
+  key = (kind, ptr)
+  if (curve := CURVES.get(key)) is not None:
+    return curve
+
+  obj = fplay_parse.ADDR_MAP.get(ptr)
+  if getattr(obj, 'name', None) != kind:
+    SEQ_PROCS[kind](ptr)
+    obj = fplay_parse.ADDR_MAP[ptr]
+
+  curve = CURVES[key] = EXPANDERS[kind](obj.tokens)
+  return curve
+
+
+def vol_curve(idx):
+  return get_curve(fplay_parse.get_word(fplay_parse.get_word(VOL_TBL) + idx * 2), 'volSeq')
+
+
+def pitch_curve(idx):
+  return get_curve(fplay_parse.get_word(fplay_parse.get_word(PITCH_TBL) + idx * 2), 'pitchSeq')
+
+
+def drum_curves(idx):
+  ''' Volume, pitch, gate and noise curves of drum macro, missing ones are None
+  '''
+  ptr = fplay_parse.get_word(DRUM_MACRO_TBL) + idx * 0xb + 3
+  return tuple(
+    get_curve(fplay_parse.get_word(ptr + i * 2), kind)
+    for i, kind in enumerate(('volSeq', 'pitchSeq', 'gateSeq', 'noiseSeq'))
+  )
+
+
+def expand_bank():
+  ''' Expand every envelope that decoder has found, returns {(kind, addr): curve}
+  '''
+  for addr, obj in list(fplay_parse.ADDR_MAP.items()):
+    if getattr(obj, 'name', None) in EXPANDERS:
+      get_curve(addr, obj.name)
+  return dict(CURVES)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Print expanded FPLAY envelope curves')
+  parser.add_argument('file', help='Path to SONG.DAT')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  args = parser.parse_args()
+
+  fplay_parse.FORCE = args.force
+  with open(args.file, 'rb') as f:
+    fplay_parse.load_bank(f.read())
+
+  for (kind, addr), curve in sorted(expand_bank().items(), key=lambda x: x[0][1]):
+    orig_print(f'{kind}_{addr:x}\t{curve!r}')
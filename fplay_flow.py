@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import fplay_parse
+from tools import *
+
+# Control flow of sequence code the way PLAY fetch loop in fplay.lst sees it.
+# Shared by tools that need to walk track code without running it.
+
+GOTO = 0x80
+JCNZ = 0x81
+SET_LOOP = 0x8d
+JUMP_IF_FADING = 0x95
+ENTER = 0x9a
+RETURN = 0x9b
+
+# jcnz, jfa, jfm, jsg, jce fall through when condition doesn't hold
+COND_JUMPS = {JCNZ, JUMP_IF_FADING, 0xa1, 0xa2, 0xaa}
+# swfm, swsg and scne skip two bytes after themselves when condition holds
+SKIP_NEXT = {0xa5, 0xa6, 0xa9}
+SKIP_BYTES = 2
+# Every opcode that takes jump address, address is always the last word parameter
+JUMPS = COND_JUMPS | {GOTO, ENTER}
+FINALS = {0x82, 0x85, 0x98, 0x9c, 0x9e, 0x9f, 0xa0}
+
+
+class CodeWalker:
+  ''' Decodes sequence code on demand and keeps every instruction it has seen.
+      Doesn't depend on fplay_parse.ADDR_MAP, so targets that decoder didn't follow are reachable too.
+  '''
+
+  def __init__(self, data=None, use_long=False):
+    self.data = fplay_parse.DATA if data is None else data
+    self.parser = SequenceParser(use_long, self.data)
+    self.code = {}
+
+  def decode(self, addr):
+    res = self.code.get(addr)
+    if res is None:
+      res = self.code[addr] = self.parser(addr)
+    return res
+
+  def opcode(self, res):
+    return self.data[res.addr]
+
+  def target(self, res):
+    if res._vcmd and self.opcode(res) in JUMPS:
+      return int.from_bytes(self.data[res.addr + res.length - 2:res.addr + res.length], 'little')
+    return None
+
+  def successors(self, res):
+    ''' Addresses execution can continue at, fall through comes first
+    '''
+    nxt = res.addr + res.length
+    if not res._vcmd:
+      return [nxt]
+
+    code = self.opcode(res)
+    if code in FINALS or code == RETURN:
+      return []
+    if code == GOTO:
+      return [self.target(res)]
+    if code in COND_JUMPS or code == ENTER:
+      return [nxt, self.target(res)]
+    if code in SKIP_NEXT:
+      return [nxt, nxt + SKIP_BYTES]
+    return [nxt]
+
+  def blocks(self, entries):
+    ''' Split code reachable from entries into basic blocks.
+        Returns {start: [instructions]} in depth-first order of first visit.
+    '''
+    leaders = set(entries)
+    seen = set()
+    stack = list(reversed(entries))
+
+    # Pass 1: find reachable code and every address that starts a block
+    while stack:
+      addr = stack.pop()
+      if addr in seen:
+        continue
+      seen.add(addr)
+      res = self.decode(addr)
+      succ = self.successors(res)
+      if len(succ) != 1 or succ[0] != res.addr + res.length:
+        leaders.update(succ)
+      stack.extend(reversed(succ))
+
+    # Pass 2: collect blocks in order
+    res_blocks = {}
+    stack = list(reversed(entries))
+    while stack:
+      start = stack.pop()
+      if start in res_blocks:
+        continue
+      block = res_blocks[start] = []
+      addr = start
+      while True:
+        res = self.decode(addr)
+        block.append(res)
+        succ = self.successors(res)
+        if len(succ) == 1 and succ[0] == res.addr + res.length and succ[0] not in leaders:
+          addr = succ[0]
+          continue
+        stack.extend(reversed(succ))
+        break
+
+    return res_blocks
+
+  def block_successors(self, block):
+    return self.successors(block[-1])
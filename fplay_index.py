@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+import os, sys, sqlite3, argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import fplay_parse
+from fplay_parse import HEADER_BASE_ADDR
+from fplay_flow import CodeWalker
+from fplay_diff import digest, ENVELOPES
+from fplay_stats import find_banks
+from tools import *
+
+# On-disk fingerprint index of many banks, to find reuse without decoding the corpus again.
+# Banks are decoded in worker processes, main process only writes rows. Bank is indexed again
+# only when its size or mtime changed, banks deleted from indexed directory are dropped by next add.
+#
+#   instrument  digest of operator and fbalg bytes, raw bytes kept for similarity search
+#   envelope    digest of kind and token bytes, same as fplay_diff
+#   drum        digest of drum macro with its envelopes by digest, same as fplay_diff
+#   phrase      rolling hash of every PHRASE_TOKENS tokens of track code, jump addresses left out
+#
+# Query bank is decoded on the fly, so it doesn't have to be in the index itself.
+
+SCHEMA_VERSION = 2
+PHRASE_TOKENS = 8
+PATCH_BYTES = 29            # 28 operator bytes and fbalg, unused tail doesn't count
+COMMIT_BANKS = 100
+HASH_MOD = (1 << 61) - 1
+HASH_BASE = 0x100000001b3
+
+SCHEMA = '''
+create table if not exists banks (id integer primary key, path text unique, size integer, mtime integer);
+create table if not exists instruments (bank integer, idx integer, addr integer, alg integer, digest text, params blob);
+create table if not exists envelopes (bank integer, kind text, idx integer, addr integer, digest text);
+create table if not exists drums (bank integer, idx integer, addr integer, digest text);
+create table if not exists phrases (bank integer, song integer, track integer, pos integer, hash integer);
+create index if not exists instruments_digest on instruments (digest);
+create index if not exists instruments_alg on instruments (alg);
+create index if not exists envelopes_digest on envelopes (digest);
+create index if not exists drums_digest on drums (digest);
+create index if not exists phrases_hash on phrases (hash);
+create index if not exists instruments_bank on instruments (bank);
+create index if not exists envelopes_bank on envelopes (bank);
+create index if not exists drums_bank on drums (bank);
+create index if not exists phrases_bank on phrases (bank);
+'''
+TABLES = ('instruments', 'envelopes', 'drums', 'phrases')
+
+
+def default_db():
+  return os.environ.get('FPLAY_INDEX', 'fplay.idx')
+
+
+def connect(path):
+  db = sqlite3.connect(path)
+  if db.execute('pragma user_version').fetchone()[0] != SCHEMA_VERSION:
+    for table in ('banks',) + TABLES:
+      db.execute(f'drop table if exists {table}')
+    db.execute(f'pragma user_version = {SCHEMA_VERSION}')
+  db.executescript(SCHEMA)
+  return db
+
+
+def token_key(walker, ins):
+  # Jump address depends on where code sits, phrase is the same wherever it sits
+  raw = walker.data[ins.addr:ins.addr + ins.length]
+  return raw[:-2] if walker.target(ins) is not None else raw
+
+
+def rolling(keys, width=PHRASE_TOKENS):
+  ''' Polynomial hash of every window of width keys, windows start at 0..len-width
+  '''
+  values = [int(digest(x), 16) % HASH_MOD for x in keys]
+  top = pow(HASH_BASE, width - 1, HASH_MOD)
+  res = []
+  h = 0
+  for i, value in enumerate(values):
+    if i >= width:
+      h = (h - values[i - width] * top) % HASH_MOD
+    h = (h * HASH_BASE + value) % HASH_MOD
+    if i >= width - 1:
+      res.append(h)
+  return res
+
+
+def track_phrases(walker, seq_ptr, width=PHRASE_TOKENS):
+  ''' [(address of first token, hash)], blocks are taken in walk order, fall through first
+  '''
+  code = [ins for block in walker.blocks([seq_ptr]).values() for ins in block]
+  return [(code[i].addr, h) for i, h in enumerate(rolling([token_key(walker, x) for x in code], width))]
+
+
+def fingerprints(raw):
+  ''' Decodes bank, returns {table: [row without bank id]}
+  '''
+  fplay_parse.load_bank(raw)
+  data = fplay_parse.DATA
+  res = {table: [] for table in TABLES}
+  env_digests = {}
+  counters = dict.fromkeys(ENVELOPES, 0)
+  objs = [(a, o) for a, o in fplay_parse.ADDR_MAP.items() if o is not None and not isinstance(o, str)]
+
+  for addr, obj in objs:
+    if obj.name == 'fmInstrument':
+      params = data[addr:addr + PATCH_BYTES]
+      res['instruments'].append((len(res['instruments']), addr, params[-1] & 7, digest(params), params))
+    elif obj.name in ENVELOPES:
+      env_digests[addr] = dig = digest(obj.name, data[addr:addr + obj.length])
+      res['envelopes'].append((obj.name, counters[obj.name], addr, dig))
+      counters[obj.name] += 1
+
+  for addr, obj in objs:
+    if obj.name == 'drumDef':
+      envs = [env_digests.get(ptr) for ptr in
+              (obj.vol_env_ptr, obj.pitch_env_ptr, obj.ssg_mask_env_ptr, obj.ssg_noise_env_ptr)]
+      res['drums'].append((len(res['drums']), addr, digest(obj.instr, obj.note, obj.vol_mod, envs)))
+
+  walker = CodeWalker(data, fplay_parse.LONG_VCMDS)
+  songs = [o.pos for _, o in objs if o.name == 'song']
+  for song_idx, song_ptr in enumerate(songs):
+    for track_idx in range(data[song_ptr] & 0xf):
+      hdr_ptr = song_ptr + 1 + track_idx * 0xc
+      seq_ptr = int.from_bytes(data[hdr_ptr + 8:hdr_ptr + 10], 'little')
+      seen = set()
+      for addr, h in track_phrases(walker, seq_ptr):
+        # Repeats inside of one track say nothing new
+        if h not in seen:
+          seen.add(h)
+          res['phrases'].append((song_idx, track_idx, addr, h))
+
+  return res
+
+
+def index_worker(path, force, use_long):
+  fplay_parse.FORCE = force
+  fplay_parse.LONG_VCMDS = use_long
+  try:
+    with open(path, 'rb') as f:
+      return path, fingerprints(f.read())
+  except Exception as e:
+    return path, f'{type(e).__name__}: {e}'
+
+
+def remove(db, bank):
+  for table in TABLES:
+    db.execute(f'delete from {table} where bank = ?', (bank,))
+  db.execute('delete from banks where id = ?', (bank,))
+
+
+def prune(db, paths):
+  ''' Drops banks under directories in paths that are gone from disk, returns their count
+  '''
+  dirs = [os.path.join(os.path.abspath(x), '') for x in paths if os.path.isdir(x)]
+  gone = [(bank, path) for bank, path in db.execute('select id, path from banks')
+          if path.startswith(tuple(dirs)) and not os.path.exists(path)] if dirs else []
+  for bank, _ in gone:
+    remove(db, bank)
+  db.commit()
+  return len(gone)
+
+
+def update(db, paths, workers=None, force=False, use_long=False, ext='.DAT'):
+  ''' Indexes new and changed banks and forgets deleted ones, returns (indexed, unchanged, removed, failed)
+  '''
+  removed = prune(db, paths)
+  known = {path: (size, mtime) for path, size, mtime in db.execute('select path, size, mtime from banks')}
+  todo = []
+  unchanged = 0
+  for path in find_banks(paths, ext):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    if known.get(path) == (st.st_size, st.st_mtime_ns):
+      unchanged += 1
+    else:
+      todo.append((path, st))
+
+  indexed = failed = 0
+  stats = dict(todo)
+  with ProcessPoolExecutor(workers) as pool:
+    results = pool.map(index_worker, stats, [force] * len(todo), [use_long] * len(todo), chunksize=8)
+    for path, res in results:
+      if isinstance(res, str):
+        failed += 1
+        orig_print(f'{path}\t{res}', file=sys.stderr)
+        continue
+
+      old = db.execute('select id from banks where path = ?', (path,)).fetchone()
+      if old:
+        remove(db, old[0])
+      bank = db.execute('insert into banks (path, size, mtime) values (?, ?, ?)',
+                        (path, stats[path].st_size, stats[path].st_mtime_ns)).lastrowid
+      for table, rows in res.items():
+        if rows:
+          marks = ', '.join('?' * (len(rows[0]) + 1))
+          db.executemany(f'insert into {table} values ({marks})', [(bank,) + row for row in rows])
+
+      # Bank is committed only together with its rows, in batches so commits don't dominate
+      indexed += 1
+      if indexed % COMMIT_BANKS == 0:
+        db.commit()
+
+  db.commit()
+  return indexed, unchanged, removed, failed
+
+
+def patch_features(params):
+  ''' Operator parameters of N x PATCH_BYTES patches, unpacked and scaled to 0..1
+  '''
+  p = params.astype(np.float64)
+  ops = lambda first: p[:, first:first + 4]
+  fields = [
+    (ops(0) // 16 % 8, 7), (ops(0) % 16, 15),     # dt, ml
+    (ops(4) % 128, 127),                            # tl
+    (ops(8) // 64, 3), (ops(8) % 32, 31),           # ks, ar
+    (ops(12) % 32, 31), (ops(16) % 32, 31),         # dr, sr
+    (ops(20) // 16, 15), (ops(20) % 16, 15),        # sl, rr
+    (ops(24) % 16, 15),                             # ssg-eg
+    (p[:, 28:29] // 8 % 8, 7),                      # fb
+  ]
+  return np.hstack([value / scale for value, scale in fields])
+
+
+def similar_patches(db, params, count=10):
+  ''' Nearest patches with the same algorithm, by L1 distance of scaled operator parameters
+  '''
+  rows = db.execute('select banks.path, idx, params from instruments join banks on banks.id = bank '
+                    'where alg = ?', (params[28] & 7,)).fetchall()
+  if not rows:
+    return []
+  matrix = np.frombuffer(b''.join(x[2] for x in rows), np.uint8).reshape(-1, PATCH_BYTES)
+  dist = np.abs(patch_features(matrix) - patch_features(np.frombuffer(params, np.uint8)[None])).sum(axis=1)
+  best = np.argsort(dist, kind='stable')[:count]
+  return [(rows[i][0], rows[i][1], float(dist[i])) for i in best]
+
+
+def lookup(db, table, dig, count=10):
+  return db.execute(f'select banks.path, idx, addr from {table} join banks on banks.id = bank '
+                    f'where digest = ? order by banks.path, idx limit ?', (dig, count)).fetchall()
+
+
+def shared_phrases(db, hashes, count=10):
+  ''' Banks sharing phrases with query track, most shared first
+  '''
+  marks = ', '.join('?' * len(hashes))
+  return db.execute(f'select banks.path, song, track, count(distinct hash) as n from phrases '
+                    f'join banks on banks.id = bank where hash in ({marks}) '
+                    f'group by bank, song, track order by n desc, banks.path limit ?', list(hashes) + [count]).fetchall()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Fingerprint index of FPLAY instruments, envelopes and phrases')
+  parser.add_argument('-d', '--db', default=default_db(), help='Index file, $FPLAY_INDEX or fplay.idx by default')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-l', '--long', action='store_true', help='Use long command names')
+  sub = parser.add_subparsers(dest='cmd', required=True)
+
+  cmd = sub.add_parser('add', help='Index new or changed banks')
+  cmd.add_argument('paths', nargs='+', help='Bank files or directories')
+  cmd.add_argument('-j', '--jobs', type=int, help='Worker processes')
+  cmd.add_argument('-e', '--ext', default='.DAT', help='Bank file extension when scanning directories')
+
+  for name, what in (('inst', 'instrument'), ('drum', 'drum macro'), ('similar', 'instrument')):
+    cmd = sub.add_parser(name, help=f'Banks with {"similar" if name == "similar" else "same"} {what}')
+    cmd.add_argument('file', help='Bank the query comes from')
+    cmd.add_argument('idx', type=int, help=f'Index of {what} in its table')
+    cmd.add_argument('-n', '--count', type=int, default=10, help='Results to show')
+
+  cmd = sub.add_parser('env', help='Banks with same envelope')
+  cmd.add_argument('file', help='Bank the query comes from')
+  cmd.add_argument('kind', choices=ENVELOPES, help='Envelope kind')
+  cmd.add_argument('idx', type=int, help='Index of envelope among ones of its kind')
+  cmd.add_argument('-n', '--count', type=int, default=10, help='Results to show')
+
+  cmd = sub.add_parser('phrase', help='Tracks sharing phrases with track')
+  cmd.add_argument('file', help='Bank the query comes from')
+  cmd.add_argument('song', type=int, help='Song index')
+  cmd.add_argument('track', type=int, help='Track index in song')
+  cmd.add_argument('-n', '--count', type=int, default=10, help='Results to show')
+
+  sub.add_parser('stats', help='Row counts')
+  args = parser.parse_args()
+
+  fplay_parse.FORCE = args.force
+  fplay_parse.LONG_VCMDS = args.long
+  db = connect(args.db)
+
+  if args.cmd == 'add':
+    indexed, unchanged, removed, failed = update(db, args.paths, args.jobs, args.force, args.long, args.ext.upper())
+    orig_print(f'{indexed} indexed, {unchanged} unchanged, {removed} removed, {failed} failed')
+    sys.exit(1 if failed else 0)
+
+  if args.cmd == 'stats':
+    for table in ('banks',) + TABLES:
+      orig_print(f'{table}\t{db.execute(f"select count(*) from {table}").fetchone()[0]}')
+    sys.exit(0)
+
+  with open(args.file, 'rb') as f:
+    query = fingerprints(f.read())
+
+  if args.cmd == 'phrase':
+    hashes = {row[3] for row in query['phrases'] if row[:2] == (args.song, args.track)}
+    if not hashes:
+      sys.exit(f'No phrases of {PHRASE_TOKENS} tokens in song {args.song} track {args.track}')
+    for path, song, track, n in shared_phrases(db, hashes, args.count):
+      orig_print(f'{path}\t{song}/{track}\t{n} of {len(hashes)} phrases')
+    sys.exit(0)
+
+  if args.cmd == 'env':
+    rows = [x[1:] for x in query['envelopes'] if x[0] == args.kind]
+  else:
+    rows = query['drums' if args.cmd == 'drum' else 'instruments']
+  if args.idx >= len(rows):
+    sys.exit(f'{args.file} has only {len(rows)} of those')
+  row = rows[args.idx]
+
+  if args.cmd == 'similar':
+    for path, idx, dist in similar_patches(db, row[-1], args.count):
+      orig_print(f'{path}\t{idx}\t{dist:.3f}')
+  else:
+    table = {'inst': 'instruments', 'drum': 'drums', 'env': 'envelopes'}[args.cmd]
+    dig = row[3] if table == 'instruments' else row[2]
+    for path, idx, addr in lookup(db, table, dig, args.count):
+      orig_print(f'{path}\t{idx}\t{addr - HEADER_BASE_ADDR:04x}')
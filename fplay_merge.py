@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+import argparse
+import fplay_parse
+import fplay_bank
+import fplay_check
+from fplay_flow import CodeWalker, SKIP_BYTES
+from fplay_bank import Bank, Unit, DRUM_ENV_OFFSETS, TRACK_SEQ_OFFSET
+from fplay_parse import (HEADER_BASE_ADDR, MAGIC_OFFSET, FM_TONE_TBL, NOTE_LEN_TBL, VOL_TBL, PITCH_TBL,
+                         SNG_TBL, DRUM_MACRO_TBL)
+from fplay_sim import WAIT_BASE, WAIT_END, TRACK_HDR_SIZE, FM_CHANNELS, SongPlayer, song_pointers, EV_INSTRUMENT
+from tools import *
+
+# Merges several banks into one. Instruments, envelopes and drum macros are pooled by content,
+# so copies shared between banks are stored once, then every reference is renumbered:
+# i/ve/pe/sso arguments, drum bytes, track headers and drumDef envelope pointers.
+# drumDef instrument byte is FM tone only for drums played on FM channels, SSG channels load it
+# into pitch envelope multiplier, so it is renumbered only for drums no SSG track plays. Drum
+# played on both kinds of channels keeps working only when its tone keeps its number.
+# Song table is rebuilt as tables of all banks one after another, blanks included,
+# so song of bank N is at its old index plus number of entries in banks before it.
+#
+# Output layout keeps every table followed by the next one, decoder sizes tables by that:
+# header, magic, fm tones, drum macros, envelopes, note lengths, vol table, pitch table,
+# song table, song headers, code.
+
+FM_TONE_SIZE = 0x20
+NOTE_LEN_COUNT = WAIT_END - WAIT_BASE - 1
+
+SET_PITCH_ENV = 0x83
+SET_VOL_ENV = 0x88
+SONG_START = 0x8b
+SET_INSTRUMENT = 0xa3
+JUMP_IF_FM = 0xa1
+JUMP_IF_SSG = 0xa2
+SKIP_IF_FM = 0xa5
+SKIP_IF_SSG = 0xa6
+TRACK_CHAN_OFFSET = 7
+EV_SSG_DRUM = 'ssgDrum'
+
+MAX_INSTRUMENTS = 0x100
+MAX_ENVELOPES = 0x80    # Env index is doubled into byte offset of the table
+MAX_INTERRUPTS = 20000
+ENV_KINDS = ('volSeq', 'pitchSeq', 'gateSeq', 'noiseSeq')
+
+
+class Pool:
+  ''' Items deduplicated by content, index is position of first copy
+  '''
+
+  def __init__(self, what, limit):
+    self.what = what
+    self.limit = limit
+    self.items = []
+    self.index = {}
+
+  def add(self, item):
+    if item not in self.index:
+      if len(self.items) >= self.limit:
+        raise ValueError(f'Merged bank needs more than {self.limit} {self.what}')
+      self.index[item] = len(self.items)
+      self.items.append(item)
+    return self.index[item]
+
+
+def env_blob(ptr, kind):
+  ''' Envelope bytes, relative jumps inside them keep working wherever they are placed
+  '''
+  obj = fplay_parse.ADDR_MAP.get(ptr)
+  if getattr(obj, 'name', None) != kind:
+    return None
+  return kind, bytes(fplay_parse.DATA[ptr:ptr + obj.length])
+
+
+def channel_successors(walker, ins, fm):
+  ''' Like CodeWalker.successors, jfm/jsg and swfm/swsg go only one way on known kind of channel
+  '''
+  op = walker.data[ins.addr]
+  nxt = ins.addr + ins.length
+  if ins._vcmd and op in (JUMP_IF_FM, JUMP_IF_SSG):
+    return [walker.target(ins) if fm == (op == JUMP_IF_FM) else nxt]
+  if ins._vcmd and op in (SKIP_IF_FM, SKIP_IF_SSG):
+    return [nxt + SKIP_BYTES if fm == (op == SKIP_IF_FM) else nxt]
+  return walker.successors(ins)
+
+
+def drum_channels(bank, use_long=False):
+  ''' Sets of drum indexes played by FM and by SSG tracks of bank
+  '''
+  data = fplay_parse.DATA
+  walker = CodeWalker(data, use_long)
+  lo, hi = bank.parser.drum_lo, bank.parser.drum_hi
+  fm_drums, ssg_drums = set(), set()
+  for _, tracks in bank.song_headers.values():
+    for hdr in tracks:
+      fm = hdr[TRACK_CHAN_OFFSET] < FM_CHANNELS
+      found = fm_drums if fm else ssg_drums
+      stack = [int.from_bytes(hdr[TRACK_SEQ_OFFSET:TRACK_SEQ_OFFSET + 2], 'little')]
+      seen = set()
+      while stack:
+        addr = stack.pop()
+        if addr in seen:
+          continue
+        seen.add(addr)
+        if lo <= data[addr] <= hi:
+          found.add(data[addr] - lo)
+        stack += channel_successors(walker, walker.decode(addr), fm)
+  return fm_drums, ssg_drums
+
+
+def read_bank(raw, num, use_long=False, path=None):
+  ''' Pull tables, songs and relocatable code out of one bank
+  '''
+  bank = fplay_bank.from_raw(raw, use_long)
+  data = fplay_parse.DATA
+  addr_map = fplay_parse.ADDR_MAP
+  objs = [(addr, obj) for addr, obj in addr_map.items() if obj is not None and not isinstance(obj, str)]
+
+  res = mkobj('sourceBank', num=num, path=path or str(num))
+  res.magic = bytes(data[MAGIC_OFFSET:min(fplay_parse.get_word(x) for x in fplay_bank.HEADER_POINTERS)])
+  res.instruments = [bytes(data[a:a + FM_TONE_SIZE]) for a, o in objs if o.name == 'fmInstrument']
+  res.note_len = list(data[fplay_parse.get_word(NOTE_LEN_TBL):][:NOTE_LEN_COUNT])
+  res.vol = [env_blob(o.pos, 'volSeq') for a, o in objs if o.name == 'pVolSeq']
+  res.pitch = [env_blob(o.pos, 'pitchSeq') for a, o in objs if o.name == 'pPitchSeq']
+
+  res.drums = []
+  for addr, obj in objs:
+    if obj.name == 'drumDef':
+      envs = tuple(
+        env_blob(fplay_parse.get_word(addr + offset), kind) for offset, kind in zip(DRUM_ENV_OFFSETS, ENV_KINDS))
+      res.drums.append((data[addr], data[addr + 1], data[addr + 2], envs))
+
+  # Song table with blanks, up to the last song, sso indexes it directly
+  tbl = fplay_parse.get_word(SNG_TBL)
+  songs = {o.pos: a for a, o in objs if o.name == 'song'}
+  res.song_table = [fplay_parse.get_word(pos) for pos in range(tbl, max(songs.values(), default=tbl - 2) + 2, 2)]
+
+  res.song_headers = {}
+  for ptr in songs:
+    count = data[ptr] & 0xf
+    res.song_headers[ptr] = (data[ptr], [bytes(data[ptr + 1 + i * TRACK_HDR_SIZE:ptr + 1 + (i + 1) * TRACK_HDR_SIZE])
+                                        for i in range(count)])
+
+  res.code = [u for u in bank.units if u.code]
+  res.frozen = fplay_bank.frozen_keys(bank)
+  res.parser = bank.parser
+  res.fm_drums, res.ssg_drums = drum_channels(res, use_long)
+  return res
+
+
+def remap(items, idx, what, bank, where=''):
+  if idx >= len(items):
+    raise ValueError(f'Bank {bank.path}{where} references {what} {idx}, it has only {len(items)}')
+  # Envelope table entry that doesn't point at envelope of its kind has nothing to merge
+  if items[idx] is None:
+    raise ValueError(f'Bank {bank.path}{where} references {what} {idx}, its table entry points at no {what}')
+  return items[idx]
+
+
+def merge(raws, use_long=False, names=None):
+  ''' Returns merged bank bytes and per bank instrument maps (used by verify)
+  '''
+  banks = [read_bank(raw, num, use_long, names and names[num]) for num, raw in enumerate(raws)]
+  parser = banks[0].parser
+  max_drums = parser.drum_hi - parser.drum_lo + 1
+
+  instruments = Pool('instruments', MAX_INSTRUMENTS)
+  envelopes = Pool('envelopes', 0x10000)
+  vol_tbl = Pool('volume envelopes', MAX_ENVELOPES)
+  pitch_tbl = Pool('pitch envelopes', MAX_ENVELOPES)
+  drums = Pool('drum macros', max_drums)
+  note_len = banks[0].note_len
+
+  inst_maps, song_offsets = [], []
+  table = []
+  stats = mkobj('mergeStats', waits_widened=0)
+
+  for bank in banks:
+    inst_map = [instruments.add(x) for x in bank.instruments]
+    vol_map = [vol_tbl.add(envelopes.items[envelopes.add(x)]) if x else None for x in bank.vol]
+    pitch_map = [pitch_tbl.add(envelopes.items[envelopes.add(x)]) if x else None for x in bank.pitch]
+    drum_map = []
+    for idx, (instr, note, vol_mod, envs) in enumerate(bank.drums):
+      for env in envs:
+        if env:
+          envelopes.add(env)
+      if idx in bank.fm_drums:
+        tone = remap(inst_map, instr, 'instrument', bank, f' drum {idx}')
+        if idx in bank.ssg_drums and tone != instr:
+          raise ValueError(f'Bank {bank.path} drum {idx} is played on FM and SSG channels, its FM tone {instr} '
+                           f'would become {tone} and change SSG pitch envelope multiplier')
+        instr = tone
+      drum_map.append(drums.add((instr, note, vol_mod, envs)))
+
+    bank.inst_map, bank.vol_map, bank.pitch_map, bank.drum_map = inst_map, vol_map, pitch_map, drum_map
+    bank.song_offset = len(table)
+    inst_maps.append(inst_map)
+    song_offsets.append(bank.song_offset)
+    table += [(bank.num, ptr) for ptr in bank.song_table]
+
+  units = [Unit('header', bytes(12), [(ptr - HEADER_BASE_ADDR, key, 0) for ptr, key in (
+    (FM_TONE_TBL, 'fm'), (NOTE_LEN_TBL, 'noteLen'), (VOL_TBL, 'volTbl'), (PITCH_TBL, 'pitchTbl'),
+    (SNG_TBL, 'songTbl'), (DRUM_MACRO_TBL, 'drumTbl'))])]
+  units.append(Unit('magic', banks[0].magic))
+  units.append(Unit('fm', b''.join(instruments.items)))
+
+  drum_unit = Unit('drumTbl', b'')
+  for instr, note, vol_mod, envs in drums.items:
+    base = len(drum_unit.data)
+    drum_unit.data += bytes([instr, note, vol_mod]) + bytes(8)
+    for offset, env in zip(DRUM_ENV_OFFSETS, envs):
+      if env:
+        drum_unit.relocs.append((base + offset, ('env', envelopes.index[env]), 0))
+  units.append(drum_unit)
+
+  units += [Unit(('env', i), blob) for i, (kind, blob) in enumerate(envelopes.items)]
+  units.append(Unit('noteLen', bytes(note_len)))
+
+  for key, pool in (('volTbl', vol_tbl), ('pitchTbl', pitch_tbl)):
+    units.append(Unit(key, bytes(2 * len(pool.items)),
+                      [(i * 2, ('env', envelopes.index[env]), 0) for i, env in enumerate(pool.items)]))
+
+  song_unit = Unit('songTbl', b'')
+  for num, ptr in table:
+    if ptr in (0x0000, 0xffff):
+      song_unit.data += ptr.to_bytes(2, 'little')
+    else:
+      song_unit.relocs.append((len(song_unit.data), (num, 'song', ptr), 0))
+      song_unit.data += bytes(2)
+  units.append(song_unit)
+
+  for bank in banks:
+    for ptr, (props, tracks) in bank.song_headers.items():
+      unit = Unit((bank.num, 'song', ptr), bytes([props]))
+      song = bank.song_table.index(ptr)
+      for i, hdr in enumerate(tracks):
+        hdr = bytearray(hdr)
+        where = f' song {song} track {i}'
+        hdr[3] = remap(bank.vol_map, hdr[3], 'volume envelope', bank, where)
+        hdr[4] = remap(bank.pitch_map, hdr[4], 'pitch envelope', bank, where)
+        hdr[10] = remap(bank.inst_map, hdr[10], 'instrument', bank, where)
+        seq_ptr = int.from_bytes(hdr[TRACK_SEQ_OFFSET:TRACK_SEQ_OFFSET + 2], 'little')
+        unit.relocs.append((len(unit.data) + TRACK_SEQ_OFFSET, (bank.num, seq_ptr), 0))
+        unit.data += hdr
+      units.append(unit)
+
+  for bank in banks:
+    for src in bank.code:
+      data = remap_code(bank, src, note_len, parser, stats)
+      if len(data) != len(src.data) and src.key in bank.frozen:
+        raise ValueError(f'Bank {bank.path} code at {src.key:04x} is skipped over by swfm/swsg/scne, can\'t resize it')
+      units.append(Unit((bank.num, src.key), data, [(o, (bank.num, k), d) for o, k, d in src.relocs], code=True))
+
+  merged = Bank(units, [], use_long)
+  return merged.assemble(), banks, stats
+
+
+def remap_code(bank, unit, note_len, parser, stats):
+  data = bytearray(unit.data)
+  op = data[0]
+  where = f' code at {unit.key:04x}'
+
+  if parser.drum_lo <= op <= parser.drum_hi:
+    data[0] = parser.drum_lo + remap(bank.drum_map, op - parser.drum_lo, 'drum', bank, where)
+  elif op == SET_INSTRUMENT:
+    data[1] = remap(bank.inst_map, data[1], 'instrument', bank, where)
+  elif op == SET_VOL_ENV:
+    data[1] = remap(bank.vol_map, data[1], 'volume envelope', bank, where)
+  elif op == SET_PITCH_ENV:
+    data[1] = remap(bank.pitch_map, data[1], 'pitch envelope', bank, where)
+  elif op == SONG_START and data[1]:
+    song = bank.song_offset + data[1]
+    if song > 0xff:
+      raise ValueError(f'Bank {bank.path}{where} starts song {data[1]}, merged song table has it at {song}, '
+                       f'sso reaches only 255')
+    data[1] = song
+  elif WAIT_BASE < op < WAIT_END:
+    # Short wait indexes note length table, other banks may have different one
+    ticks = bank.note_len[op - WAIT_BASE - 1]
+    if ticks in note_len:
+      data[0] = WAIT_BASE + 1 + note_len.index(ticks)
+    else:
+      data = bytearray([WAIT_BASE, ticks])
+      stats.waits_widened += 1
+
+  return data
+
+
+class VerifyPlayer(SongPlayer):
+  ''' SSG drum instrument byte isn't FM tone and isn't renumbered, its event is told apart
+  '''
+  drum_track = None
+
+  def drum(self, track, idx, events):
+    self.drum_track = track
+    try:
+      return super().drum(track, idx, events)
+    finally:
+      self.drum_track = None
+
+  def emit(self, events, track, kind, a=None, b=None):
+    if kind == EV_INSTRUMENT and track is self.drum_track and track.chan >= FM_CHANNELS:
+      kind = EV_SSG_DRUM
+    super().emit(events, track, kind, a, b)
+
+
+def play(raw, song):
+  ''' Events of n-th song, envelopes are read from loaded bank so it is loaded every time
+  '''
+  fplay_parse.load_bank(raw)
+  return list(VerifyPlayer(fplay_parse.DATA, song_pointers(fplay_parse.DATA)[song]).run(MAX_INTERRUPTS))
+
+
+def verify(raws, merged, banks):
+  ''' Every song must play the same from merged bank, instrument numbers translated
+  '''
+  bad = []
+  first = 0
+  for raw, bank in zip(raws, banks):
+    fplay_parse.load_bank(raw)
+    count = len(song_pointers(fplay_parse.DATA))
+    for song in range(count):
+      old = [(t, ch, k, bank.inst_map[a] if k == EV_INSTRUMENT else a, b) for t, ch, k, a, b in play(raw, song)]
+      if old != play(merged, first + song):
+        bad.append((bank.path, song))
+    first += count
+  return bad
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Merge FPLAY banks into one with shared instruments and envelopes')
+  parser.add_argument('files', nargs='+', help='Banks to merge, songs keep this order')
+  parser.add_argument('-o', '--output', required=True, help='Where to write merged bank')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-l', '--long', action='store_true', help='Use long command names')
+  parser.add_argument('-v', '--verify', action='store_true', help='Compare playback of every song in simulator')
+  args = parser.parse_args()
+
+  fplay_parse.FORCE = args.force
+  raws = []
+  for name in args.files:
+    with open(name, 'rb') as f:
+      raws.append(f.read())
+
+  try:
+    merged, banks, stats = merge(raws, args.long, args.files)
+  except ValueError as e:
+    raise SystemExit(str(e))
+
+  for name, raw, bank in zip(args.files, raws, banks):
+    orig_print(f'{name}\t{len(raw)} bytes\tsongs from #{bank.song_offset}')
+  orig_print(f'merged\t{len(merged)} bytes, {sum(map(len, raws)) - len(merged)} saved, '
+             f'{stats.waits_widened} waits widened for shared note length table')
+
+  if args.verify:
+    try:
+      bad = verify(raws, merged, banks)
+    except ValueError as e:
+      raise SystemExit(f'can\'t verify: {e}')
+    for path, song in bad:
+      orig_print(f'bank {path} song {song} plays differently')
+    if bad:
+      raise SystemExit(1)
+    orig_print('playback identical')
+
+  fplay_check.refuse_broken(merged, args.long)
+  with open(args.output, 'wb') as f:
+    f.write(merged)
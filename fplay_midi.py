@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+import os, sys, struct, argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import fplay_parse
+from fplay_sim import SongPlayer, song_pointers, EV_KEYON, EV_KEYOFF, EV_INSTRUMENT, EV_END
+from fplay_cost import OPN_CLOCK, DEFAULT_TIMER_A
+from fplay_stats import find_banks
+from tools import *
+
+# Standard MIDI File export through the driver model, so waits, note length table, transpose,
+# volume and loops come out exactly as the driver would play them. One MIDI tick is one timer
+# interrupt, tempo is set so that ticks last as long as interrupts do.
+#
+# Driver channel N goes to MIDI channel N, skipping percussion channel. Drum macros go to
+# percussion channel as key DRUM_KEY_BASE + macro number. Envelopes are not exported.
+# Legato note only changes frequency on the chip, here it is note off and note on.
+# Note of track that loses its channel to another one is released right away.
+# Events are written to the file as simulator produces them, only track length is patched at the end.
+
+PPQN = 48
+PERCUSSION = 9
+DRUM_KEY_BASE = 35      # Acoustic bass drum, m0..m31 land on GM drum keys
+NOTE_BASE = 12          # Driver pitch 0 is o0 c, MIDI 12 is C0
+MAX_VOLUME = 0xf
+
+
+def varlen(value):
+  res = bytearray([value & 0x7f])
+  value >>= 7
+  while value:
+    res.insert(0, 0x80 | value & 0x7f)
+    value >>= 7
+  return bytes(res)
+
+
+class SmfWriter:
+  ''' Format 0 SMF written straight to seekable file, events must come in time order
+  '''
+
+  def __init__(self, f, division=PPQN):
+    self.f = f
+    self.time = 0
+    f.write(b'MThd' + struct.pack('>IHHH', 6, 0, 1, division))
+    f.write(b'MTrk\0\0\0\0')
+    self.start = f.tell()
+
+  def event(self, time, msg):
+    self.f.write(varlen(time - self.time) + msg)
+    self.time = time
+
+  def tempo(self, time, usec):
+    self.event(time, b'\xff\x51\x03' + usec.to_bytes(3, 'big'))
+
+  def close(self, time):
+    self.event(max(time, self.time), b'\xff\x2f\x00')
+    end = self.f.tell()
+    self.f.seek(self.start - 4)
+    self.f.write(struct.pack('>I', end - self.start))
+    self.f.seek(end)
+
+
+def midi_channel(chan):
+  return min(chan + (chan >= PERCUSSION), 0xf)
+
+
+class MidiPlayer(SongPlayer):
+  ''' Turns driver events into MIDI messages as they are emitted
+  '''
+
+  def __init__(self, data, song_ptr, smf, loops=1, drum_base=DRUM_KEY_BASE):
+    self.smf = smf
+    self.drum_base = drum_base
+    self.held = {}
+    super().__init__(data, song_ptr, loops=loops)
+
+  def envelope(self, track, events):
+    pass
+
+  def emit(self, events, track, kind, a=None, b=None):
+    if track.blocked or track.chan in self.muted:
+      return
+
+    if kind in (EV_KEYOFF, EV_END) or kind == EV_KEYON and track.chan in self.held:
+      self.release(track.chan)
+
+    if kind == EV_KEYON:
+      if track.drum is not None:
+        key = (PERCUSSION, min(self.drum_base + track.drum, 0x7f))
+      else:
+        key = (midi_channel(track.chan), min(a + NOTE_BASE, 0x7f))
+      velocity = max(min(b, MAX_VOLUME), 0) * 0x7f // MAX_VOLUME or 1
+      self.smf.event(self.interrupt, bytes([0x90 | key[0], key[1], velocity]))
+      self.held[track.chan] = (key, track)
+
+    elif kind == EV_INSTRUMENT and track.drum is None:
+      self.smf.event(self.interrupt, bytes([0xc0 | midi_channel(track.chan), a & 0x7f]))
+
+  def key_on(self, track, note, events):
+    if track.key_held and track.legato and note and note != track.note and track.drum is None:
+      # Same pitch as SongPlayer.key_on works it out
+      self.emit(events, track, EV_KEYON, (note - 1 + track.transpose + track.transpose_vcmd) & 0x7f,
+                track.volume_track)
+    super().key_on(track, note, events)
+
+  def step(self):
+    events = super().step()
+    # Blocked or replaced track doesn't get to emit its key off
+    for chan, (_, track) in list(self.held.items()):
+      if track.blocked or not track.active or track not in self.tracks:
+        self.release(chan, self.interrupt - 1)
+    return events
+
+  def release(self, chan, time=None):
+    held = self.held.pop(chan, None)
+    if held is not None:
+      key = held[0]
+      self.smf.event(self.interrupt if time is None else time, bytes([0x80 | key[0], key[1], 0]))
+
+  def export(self, period, max_interrupts=None):
+    self.smf.tempo(0, round(period * 1e6 * PPQN))
+
+    # Instruments from track headers, slot with higher track number owns the channel
+    chans = set()
+    for track in self.tracks:
+      if track.chan not in chans:
+        chans.add(track.chan)
+        self.smf.event(0, bytes([0xc0 | midi_channel(track.chan), track.instrument & 0x7f]))
+
+    for _ in self.run(max_interrupts):
+      pass
+    for chan in list(self.held):
+      self.release(chan)
+    self.smf.close(self.interrupt)
+
+
+def interrupt_period(timer_a=DEFAULT_TIMER_A):
+  return 72 * (1024 - timer_a) / OPN_CLOCK
+
+
+def output_stem(path, root, out_dir=None):
+  ''' Output path without _NN.mid, under out_dir bank keeps its directory relative to the root it was found in
+  '''
+  if not out_dir:
+    return os.path.splitext(path)[0]
+  rel = os.path.relpath(path, root) if os.path.isdir(root) else os.path.basename(path)
+  return os.path.join(out_dir, os.path.splitext(rel)[0])
+
+
+def export_bank(path, stem, loops=1, max_interrupts=None, timer_a=DEFAULT_TIMER_A, drum_base=DRUM_KEY_BASE,
+                force=False):
+  ''' Writes every song of bank to STEM_NN.mid, runs in worker. Returns (path, written files or error)
+  '''
+  fplay_parse.FORCE = force
+  try:
+    with open(path, 'rb') as f:
+      fplay_parse.load_bank(f.read())
+
+    os.makedirs(os.path.dirname(stem) or '.', exist_ok=True)
+    res = []
+    for num, song_ptr in enumerate(song_pointers(fplay_parse.DATA)):
+      name = f'{stem}_{num:02d}.mid'
+      try:
+        with open(name, 'wb') as f:
+          player = MidiPlayer(fplay_parse.DATA, song_ptr, SmfWriter(f), loops, drum_base)
+          player.export(interrupt_period(timer_a), max_interrupts)
+      except Exception:
+        # Half written song is not worth keeping
+        os.unlink(name)
+        raise
+      res.append(name)
+    return path, res
+  except Exception as e:
+    return path, f'{type(e).__name__}: {e}'
+
+
+def export_all(paths, workers=None, ext='.DAT', out_dir=None, **kwargs):
+  ''' Streams banks through a process pool, yields export_bank results as they complete.
+      Bank that would write over files of another one is refused.
+  '''
+  stems = {}
+  with ProcessPoolExecutor(workers) as pool:
+    limit = (workers or os.cpu_count() or 1) * 4
+    pending = set()
+    for root in paths:
+      for path in find_banks([root], ext):
+        stem = output_stem(path, root, out_dir)
+        key = os.path.normcase(os.path.abspath(stem))
+        if key in stems:
+          yield path, f'output {stem}_NN.mid already taken by {stems[key]}'
+          continue
+        stems[key] = path
+        pending.add(pool.submit(export_bank, path, stem, **kwargs))
+        if len(pending) >= limit:
+          done, pending = wait(pending, return_when=FIRST_COMPLETED)
+          yield from (x.result() for x in done)
+
+    for fut in pending:
+      yield fut.result()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Export FPLAY songs to Standard MIDI Files')
+  parser.add_argument('paths', nargs='+', help='Bank files or directories to convert')
+  parser.add_argument('-o', '--out', help='Output directory, next to bank by default')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-n', '--loops', type=int, default=1, help='Stop after every track looped this many times')
+  parser.add_argument('-m', '--max', type=int, default=100000, help='Stop after this many interrupts')
+  parser.add_argument('-t', '--timer', type=lambda x: int(x, 0), default=DEFAULT_TIMER_A, help='OPN timer A value')
+  parser.add_argument('-d', '--drums', type=int, default=DRUM_KEY_BASE, help='MIDI key of drum macro m0')
+  parser.add_argument('-j', '--jobs', type=int, help='Worker processes')
+  parser.add_argument('-e', '--ext', default='.DAT', help='Bank file extension when scanning directories')
+  args = parser.parse_args()
+
+  if args.out:
+    os.makedirs(args.out, exist_ok=True)
+
+  failed = 0
+  for path, res in export_all(args.paths, args.jobs, args.ext.upper(), out_dir=args.out, loops=args.loops,
+                              max_interrupts=args.max, timer_a=args.timer, drum_base=args.drums, force=args.force):
+    if isinstance(res, str):
+      failed += 1
+      orig_print(f'{path}\t{res}', file=sys.stderr)
+    else:
+      orig_print(f'{path}\t{len(res)} songs')
+  sys.exit(1 if failed else 0)
@@ -0,0 +1,535 @@
+#!/usr/bin/env python3
+import argparse
+from collections import deque
+import fplay_parse
+import fplay_bank
+import fplay_check
+from fplay_bank import Unit
+from fplay_parse import NOTE_LEN_TBL
+from fplay_flow import GOTO, JCNZ, SET_LOOP, ENTER, RETURN, COND_JUMPS, SKIP_NEXT, SKIP_BYTES, JUMPS, FINALS
+from fplay_sim import WAIT_BASE, WAIT_END, LEGATO_TOGGLE, SongPlayer, song_pointers, EV_INSTRUMENT, EV_TEMPO
+from tools import *
+
+# Size optimizer working on relocatable bank from fplay_bank. Every pass keeps playback the same
+# as driver in fplay.lst would do it:
+#
+#   props  - drop noop/nop2, repeated gl/s/d/sc with known same value and waits equal to sticky length
+#   waits  - "w n" becomes one byte wait when n is in note length table
+#   rests  - "r w a r w b" becomes "r w a+b" when following note sets its own length
+#   loops  - back to back repeats become slc/jcnz loop, only in tracks that never use loop counter
+#   subs   - phrases repeated anywhere become enter/return subroutines, never inside other subroutine
+#
+# i is left alone, SETTON reloads the patch on every i when track isn't blocked, so repeated one
+# restores it after sfx track took the channel. ve/pe restart envelope position, so they aren't
+# plain setters either. v is relative.
+#
+# Note, its wait and legato byte after it are read by note handler in one go, they are never split.
+
+PORTAMENTO = 0x84
+TRANSPOSE_ONCE = 0x94
+SETTERS = {PORTAMENTO, 0x96, 0x97, 0x9d}
+NOPS = {0x8c, 0xa4}
+LEGATO_OPCODES = {LEGATO_TOGGLE, 0xae, 0xaf}
+WAIT_DIRECT = WAIT_BASE
+
+ENTER_SIZE = 3
+RETURN_SIZE = 1
+LOOP_SIZE = 3 + 4
+MAX_EVENTS = 32
+MAX_LOOP = 0xff
+
+PASSES = ('props', 'waits', 'rests', 'loops', 'subs')
+
+
+def is_wait(op):
+  return WAIT_BASE <= op < WAIT_END
+
+
+class Flow:
+  ''' Control flow over units of a bank, rebuilt after every change of code layout
+  '''
+
+  def __init__(self, bank, note_len, entry_states=None):
+    self.bank = bank
+    self.units = units = bank.units
+    self.note_len = note_len
+    index = bank.index()
+
+    # Unit after each one that has bytes, empty units alias to next one with bytes
+    self.next = [None] * len(units)
+    nxt = None
+    for i in range(len(units) - 1, -1, -1):
+      self.next[i] = nxt
+      if units[i].data:
+        nxt = i
+
+    def resolve(i):
+      return i if units[i].data else self.next[i]
+
+    self.resolve = resolve
+    self.entries = [resolve(index[key]) for key in bank.entries]
+
+    self.succ = {}
+    for i, unit in enumerate(units):
+      if unit.code and unit.data:
+        self.succ[i] = [x for x in self.successors(i, index) if x is not None]
+
+    self.leaders = set(self.entries)
+    for i, succ in self.succ.items():
+      if len(succ) != 1 or succ[0] != self.next[i]:
+        self.leaders.update(succ)
+
+    self.state_in = self.dataflow(entry_states or {})
+
+  def kind(self, i):
+    op = self.units[i].data[0]
+    if op < 0x80:
+      return 'note'
+    if self.bank.parser.drum_lo <= op <= self.bank.parser.drum_hi:
+      return 'drum'
+    if is_wait(op):
+      return 'wait'
+    return 'vcmd'
+
+  def wait_value(self, i):
+    data = self.units[i].data
+    return data[1] if data[0] == WAIT_DIRECT else self.note_len[data[0] - WAIT_DIRECT - 1]
+
+  def target(self, i, index):
+    return self.resolve(index[self.units[i].relocs[0][1]])
+
+  def successors(self, i, index):
+    data = self.units[i].data
+    nxt = self.next[i]
+    op = data[0]
+    if self.kind(i) != 'vcmd':
+      return [nxt]
+    if op in FINALS or op == RETURN:
+      return []
+    if op == GOTO:
+      return [self.target(i, index)]
+    if op in COND_JUMPS or op == ENTER:
+      return [nxt, self.target(i, index)]
+    if op in SKIP_NEXT:
+      j, left = nxt, SKIP_BYTES
+      while j is not None and left > 0:
+        left -= len(self.units[j].data)
+        j = self.next[j]
+      return [nxt, j]
+    return [nxt]
+
+  def transfer(self, i, state):
+    ''' Known track fields after unit i, per successor
+    '''
+    unit = self.units[i]
+    op = unit.data[0]
+    state = dict(state)
+
+    kind = self.kind(i)
+    if kind == 'wait':
+      state['dur'] = self.wait_value(i)
+    elif kind == 'vcmd':
+      if op in SETTERS:
+        state[op] = bytes(unit.data[1:])
+      elif op == TRANSPOSE_ONCE:
+        state.pop(PORTAMENTO, None)
+      elif op == ENTER:
+        # Nothing is known once subroutine returns
+        nxt, tgt = self.succ[i]
+        return [(nxt, {}), (tgt, state)]
+
+    return [(s, state) for s in self.succ[i]]
+
+  def dataflow(self, entry_states):
+    state_in = {}
+    work = deque()
+    for i in self.entries:
+      state = entry_states.get(self.units[i].key, {})
+      state_in[i] = meet(state_in.get(i), state)
+      work.append(i)
+
+    while work:
+      i = work.popleft()
+      if i not in self.succ:
+        continue
+      for s, state in self.transfer(i, state_in[i]):
+        new = meet(state_in.get(s), state)
+        if new != state_in.get(s):
+          state_in[s] = new
+          work.append(s)
+
+    return state_in
+
+  def reach(self, starts):
+    seen = set()
+    stack = list(starts)
+    while stack:
+      i = stack.pop()
+      if i is None or i in seen or i not in self.succ:
+        continue
+      seen.add(i)
+      stack.extend(self.succ[i])
+    return seen
+
+  def in_subroutines(self):
+    index = self.bank.index()
+    return self.reach(self.target(i, index) for i in self.succ if self.units[i].data[0] == ENTER
+                      and self.kind(i) == 'vcmd')
+
+  def counter_tracks(self):
+    ''' Code of every track that touches loop counters
+    '''
+    res = set()
+    for entry in set(self.entries):
+      code = self.reach([entry])
+      if any(self.kind(i) == 'vcmd' and self.units[i].data[0] in (JCNZ, SET_LOOP) for i in code):
+        res |= code
+    return res
+
+  def events(self, frozen, exclude):
+    ''' Straight line runs of events without control flow or jump targets inside.
+        Event is (unit indices, bytes), note/drum event carries its wait and legato byte.
+    '''
+    units = self.units
+    segs = []
+    seg = []
+    i = self.next[0] if not units[0].data else 0
+
+    def flush():
+      nonlocal seg
+      if len(seg) > 1:
+        segs.append(seg)
+      seg = []
+
+    while i is not None:
+      unit = units[i]
+      if not unit.code or i not in self.state_in or i in exclude or unit.key in frozen:
+        flush()
+        i = self.next[i]
+        continue
+
+      if i in self.leaders:
+        flush()
+
+      kind = self.kind(i)
+      op = unit.data[0]
+      if kind == 'vcmd' and (op in JUMPS or op in FINALS or op in SKIP_NEXT or op in (RETURN, SET_LOOP)):
+        flush()
+        i = self.next[i]
+        continue
+
+      idxs = [i]
+      j = self.next[i]
+      if kind in ('note', 'drum'):
+        if j is not None and units[j].code and self.kind(j) == 'wait':
+          idxs.append(j)
+          j = self.next[j]
+        if j is not None and units[j].code and units[j].data[0] == LEGATO_TOGGLE:
+          idxs.append(j)
+          j = self.next[j]
+
+      if any(x in self.leaders or units[x].key in frozen for x in idxs[1:]):
+        flush()
+        i = j
+        continue
+
+      seg.append((idxs, b''.join(bytes(units[x].data) for x in idxs)))
+      i = j
+
+    flush()
+    return segs
+
+
+def meet(a, b):
+  if a is None:
+    return dict(b)
+  return {k: v for k, v in a.items() if b.get(k) == v}
+
+
+def clear(unit):
+  unit.data = bytearray()
+  unit.relocs = []
+
+
+def encode_wait(n, note_len):
+  if n in note_len:
+    return bytearray([WAIT_DIRECT + 1 + note_len.index(n)])
+  return bytearray([WAIT_DIRECT, n])
+
+
+def pass_props(bank, flow, frozen):
+  units = bank.units
+  for i in flow.succ:
+    unit = units[i]
+    state = flow.state_in.get(i)
+    if state is None or unit.key in frozen:
+      continue
+
+    kind = flow.kind(i)
+    op = unit.data[0]
+    if kind == 'vcmd':
+      if op in NOPS or (op in SETTERS and state.get(op) == bytes(unit.data[1:])):
+        clear(unit)
+
+    elif kind == 'wait' and i not in flow.leaders and state.get('dur') == flow.wait_value(i):
+      # Byte that comes after must not look like wait to note handler
+      nxt = flow.next[i]
+      if nxt is not None and is_wait(units[nxt].data[0]):
+        continue
+      clear(unit)
+
+
+def pass_waits(bank, flow, frozen):
+  for i in flow.succ:
+    unit = bank.units[i]
+    if unit.key in frozen or unit.data[0] != WAIT_DIRECT or flow.kind(i) != 'wait':
+      continue
+    if unit.data[1] in flow.note_len:
+      unit.data = encode_wait(unit.data[1], flow.note_len)
+
+
+def pass_rests(bank, flow, frozen):
+  units = bank.units
+  # With legato on rest doesn't release held key, leave such banks alone
+  if any(flow.kind(i) == 'vcmd' and units[i].data[0] in LEGATO_OPCODES for i in flow.succ):
+    return
+
+  for seg in flow.events(frozen, ()):
+    k = 0
+    while k + 2 < len(seg):
+      (a_idx, _), (b_idx, _), (c_idx, _) = seg[k:k + 3]
+      if not (units[a_idx[0]].data[0] == 0 and units[b_idx[0]].data[0] == 0 and len(a_idx) == 2
+              and flow.kind(a_idx[1]) == 'wait'
+              and flow.kind(c_idx[0]) in ('note', 'drum') and len(c_idx) > 1 and flow.kind(c_idx[1]) == 'wait'
+              and units[c_idx[0]].data[0] != 0):
+        k += 1
+        continue
+
+      a = flow.wait_value(a_idx[1])
+      b = flow.wait_value(b_idx[1]) if len(b_idx) > 1 and flow.kind(b_idx[1]) == 'wait' \
+        else flow.state_in.get(b_idx[0], {}).get('dur')
+      if b is None or a + b > 0xff or len(b_idx) > 2:
+        k += 1
+        continue
+
+      merged = encode_wait(a + b, flow.note_len)
+      removed = sum(len(units[x].data) for x in b_idx) + len(units[a_idx[1]].data) - len(merged)
+      if removed <= 0:
+        k += 1
+        continue
+
+      units[a_idx[1]].data = merged
+      for x in b_idx:
+        clear(units[x])
+      seg[k] = (a_idx, b'')
+      del seg[k + 1]
+
+
+def pass_loops(bank, flow, frozen):
+  units = bank.units
+  patches = []
+
+  for seg in flow.events(frozen, flow.counter_tracks()):
+    taken = [False] * len(seg)
+
+    # Greedy on best saving first, repeats never overlap
+    candidates = []
+    for length in range(1, min(MAX_EVENTS, len(seg) // 2) + 1):
+      for start in range(len(seg) - length * 2 + 1):
+        body = [ev[1] for ev in seg[start:start + length]]
+        reps = 1
+        while reps < MAX_LOOP and start + (reps + 1) * length <= len(seg) and \
+            [ev[1] for ev in seg[start + reps * length:start + (reps + 1) * length]] == body:
+          reps += 1
+        saving = (reps - 1) * sum(len(x) for x in body) - LOOP_SIZE
+        if reps > 1 and saving > 0:
+          candidates.append((saving, start, length, reps))
+
+    for saving, start, length, reps in sorted(candidates, key=lambda x: (-x[0], x[1])):
+      end = start + length * reps
+      if any(taken[start:end]):
+        continue
+      taken[start:end] = [True] * (end - start)
+      patches.append((seg[start:start + length], seg[start + length:end], reps))
+
+  # Apply from the end, so insertions don't shift units still to be patched
+  for body, copies, reps in sorted(patches, key=lambda p: -p[0][0][0][0]):
+    first = units[body[0][0][0]]
+    last = body[-1][0][-1]
+    for idxs, _ in copies:
+      for x in idxs:
+        clear(units[x])
+
+    # Loop start takes over the key, so jumps into the phrase run slc first
+    body_key = bank.new_key('loop')
+    slc = Unit(first.key, bytes([SET_LOOP, 0, reps]), code=True)
+    first.key = body_key
+    jcnz = Unit(bank.new_key('loop'), bytes([JCNZ, 0, 0, 0]), [(2, body_key, 0)], code=True)
+    units.insert(last + 1, jcnz)
+    units.insert(body[0][0][0], slc)
+
+
+def pass_subs(bank, flow_factory, frozen, rounds):
+  for _ in range(rounds):
+    flow = flow_factory()
+    segs = flow.events(frozen, flow.in_subroutines())
+
+    occurrences = {}
+    for seg_id, seg in enumerate(segs):
+      for start in range(len(seg)):
+        acc = b''
+        for length in range(1, min(MAX_EVENTS, len(seg) - start) + 1):
+          acc += seg[start + length - 1][1]
+          if len(acc) > ENTER_SIZE:
+            occurrences.setdefault((length, acc), []).append((seg_id, start))
+
+    best = None
+    for (length, acc), occ in occurrences.items():
+      if len(occ) < 2:
+        continue
+      picked = []
+      last_end = {}
+      for seg_id, start in occ:
+        if start >= last_end.get(seg_id, 0):
+          picked.append((seg_id, start))
+          last_end[seg_id] = start + length
+      k = len(picked)
+      saving = k * len(acc) - (k * ENTER_SIZE + len(acc) + RETURN_SIZE)
+      if saving > 0 and (best is None or (saving, len(acc)) > (best[0], len(best[2]))):
+        best = (saving, length, acc, picked)
+
+    if best is None:
+      return
+
+    _, length, acc, picked = best
+    units = bank.units
+    body_key = bank.new_key('sub')
+
+    body_units = []
+    for idxs, _ in segs[picked[0][0]][picked[0][1]:picked[0][1] + length]:
+      for x in idxs:
+        body_units.append(Unit(body_key if not body_units else bank.new_key('sub'), units[x].data, code=True))
+    body_units.append(Unit(bank.new_key('sub'), bytes([RETURN]), code=True))
+
+    for seg_id, start in picked:
+      events = segs[seg_id][start:start + length]
+      first = units[events[0][0][0]]
+      for idxs, _ in events:
+        for x in idxs:
+          clear(units[x])
+      first.data = bytearray([ENTER, 0, 0])
+      first.relocs = [(1, body_key, 0)]
+
+    # Subroutines go right after the last code, tables that may follow code stay where they are
+    last_code = max(i for i, u in enumerate(units) if u.code)
+    units[last_code + 1:last_code + 1] = body_units
+
+
+PASS_FUNCS = {
+  'props': pass_props,
+  'waits': pass_waits,
+  'rests': pass_rests,
+  'loops': pass_loops,
+}
+
+
+def optimize(raw, passes=PASSES, rounds=64, use_long=False):
+  ''' Returns optimized bank bytes and [(pass, size after it)]
+  '''
+  bank = fplay_bank.from_raw(raw, use_long)
+  note_len = list(fplay_parse.DATA[fplay_parse.get_word(NOTE_LEN_TBL):][:WAIT_END - WAIT_BASE - 1])
+
+  # Sticky length track starts with, from header
+  entry_states = {}
+  for obj in fplay_parse.ADDR_MAP.values():
+    if getattr(obj, 'name', None) == 'track':
+      entry_states[obj.seq_ptr] = meet(entry_states.get(obj.seq_ptr), {'dur': (obj.unknown + 1) & 0xff})
+
+  frozen = fplay_bank.frozen_keys(bank)
+
+  def flow_factory():
+    return Flow(bank, note_len, entry_states)
+
+  report = [('input', bank.size())]
+  for name in PASSES:
+    if name not in passes:
+      continue
+    if name == 'subs':
+      pass_subs(bank, flow_factory, frozen, rounds)
+    else:
+      PASS_FUNCS[name](bank, flow_factory(), frozen)
+    report.append((name, bank.size()))
+
+  return bank.assemble(), report
+
+
+def normalized_events(raw, song, max_interrupts):
+  ''' Sim events with repeated instrument/tempo writes folded, those are what props pass drops
+  '''
+  fplay_parse.load_bank(raw)
+  ptr = song_pointers(fplay_parse.DATA)[song]
+  player = SongPlayer(fplay_parse.DATA, ptr)
+  last = {}
+  res = []
+  for ev in player.run(max_interrupts):
+    interrupt, chan, kind, a, b = ev
+    if kind in (EV_INSTRUMENT, EV_TEMPO):
+      if last.get((chan, kind)) == a:
+        continue
+      last[(chan, kind)] = a
+    res.append(ev)
+  return res
+
+
+def verify(old_raw, new_raw, max_interrupts=20000):
+  ''' Returns list of (song, first interrupt where playback differs)
+  '''
+  fplay_parse.load_bank(old_raw)
+  count = len(song_pointers(fplay_parse.DATA))
+  res = []
+  for song in range(count):
+    old = normalized_events(old_raw, song, max_interrupts)
+    new = normalized_events(new_raw, song, max_interrupts)
+    if old != new:
+      diff = next((a[0] for a, b in zip(old, new) if a != b), min(len(old), len(new)))
+      res.append((song, diff))
+  return res
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Make FPLAY bank smaller without changing playback')
+  parser.add_argument('file', help='Path to SONG.DAT')
+  parser.add_argument('output', help='Where to write optimized bank')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-l', '--long', action='store_true', help='Use long command names')
+  parser.add_argument('-p', '--passes', default=','.join(PASSES), help=f'Comma separated passes, default {",".join(PASSES)}')
+  parser.add_argument('-r', '--rounds', type=int, default=64, help='Max subroutines to extract')
+  parser.add_argument('-v', '--verify', action='store_true', help='Compare playback of every song in simulator')
+  args = parser.parse_args()
+
+  fplay_parse.FORCE = args.force
+  with open(args.file, 'rb') as f:
+    raw = f.read()
+
+  out, report = optimize(raw, args.passes.split(','), args.rounds, args.long)
+
+  prev = report[0][1]
+  for name, size in report:
+    orig_print(f'{name}\t{size}\t{size - prev:+d}')
+    prev = size
+  orig_print(f'saved\t{report[0][1] - len(out)} bytes')
+
+  if args.verify:
+    try:
+      bad = verify(raw, out)
+    except ValueError as e:
+      raise SystemExit(f'can\'t verify: {e}')
+    for song, interrupt in bad:
+      orig_print(f'song {song} differs at interrupt {interrupt}')
+    if bad:
+      raise SystemExit(1)
+    orig_print('playback identical')
+
+  fplay_check.refuse_broken(out, args.long)
+  with open(args.output, 'wb') as f:
+    f.write(out)
@@ -16,17 +16,61 @@ PITCH_TBL = 0x4006
 SNG_TBL = 0x4008
 
 
-class GuardedDict(dict):
-    def __setitem__(self, key, value):
-        if key < HEADER_BASE_ADDR:
-            breakpoint()
-        return super().__setitem__(key, value)
+# Every byte nothing decoded yet is one of these, shared between banks
+RAW_BYTES = tuple(f'db 0{x:02x}h' for x in range(0x100))
+
+
+class AddrMap:
+  ''' Address -> raw byte text, decoded object or None inside of object, for every byte of bank.
+      Every address from HEADER_BASE_ADDR on has an entry, so it is a list and not a dict.
+  '''
+  __slots__ = ('cells',)
+
+  def __init__(self, cells=()):
+    self.cells = list(cells)
+
+  def __getitem__(self, addr):
+    if not HEADER_BASE_ADDR <= addr < HEADER_BASE_ADDR + len(self.cells):
+      raise KeyError(addr)
+    return self.cells[addr - HEADER_BASE_ADDR]
+
+  def __setitem__(self, addr, value):
+    if addr < HEADER_BASE_ADDR:
+      breakpoint()
+    pos = addr - HEADER_BASE_ADDR
+    if pos >= len(self.cells):
+      self.cells += [None] * (pos + 1 - len(self.cells))
+    self.cells[pos] = value
+
+  def __contains__(self, addr):
+    return HEADER_BASE_ADDR <= addr < HEADER_BASE_ADDR + len(self.cells)
+
+  def __len__(self):
+    return len(self.cells)
+
+  def __iter__(self):
+    return iter(range(HEADER_BASE_ADDR, HEADER_BASE_ADDR + len(self.cells)))
+
+  def get(self, addr, default=None):
+    return self[addr] if addr in self else default
+
+  def keys(self):
+    return iter(self)
+
+  def values(self):
+    return iter(self.cells)
+
+  def items(self):
+    return zip(iter(self), self.cells)
+
 
 DATA = b''
-ADDR_MAP = GuardedDict()
+ADDR_MAP = AddrMap()
 EVENT_TAIL_MAP = {}
 DEBUG_ENABLED = False
 LONG_VCMDS = False
+FORCE = False
+SCAN = False
 
 boundaries = {
   HEADER_BASE_ADDR,
@@ -57,17 +101,7 @@ def proc_fm_table(fm_table_ptr):
 
   while pos < end:
     raw = DATA[pos:pos + 0x20]
-    inst = mkobj("fmInstrument")
-
-    inst.op1_dtml, inst.op3_dtml, inst.op2_dtml, inst.op4_dtml, inst.op1_tl, inst.op3_tl, inst.op2_tl, \
-    inst.op4_tl, inst.op1_ksar, inst.op3_ksar, inst.op2_ksar, inst.op4_ksar, inst.op1_dr, inst.op3_dr, \
-    inst.op2_dr, inst.op4_dr, inst.op1_sr, inst.op3_sr, inst.op2_sr, inst.op4_sr, inst.op1_slrr, inst.op3_slrr,\
-    inst.op2_slrr, inst.op4_slrr, inst.op1_ssge, inst.op3_ssge, inst.op2_ssge, inst.op4_ssge, inst.fbalg, \
-    inst.unused1, inst.unused2, inst.unused3 = \
-      struct.unpack('<BBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB', raw)
-    inst.length = 0x20
-    inst._addr = pos
-    ADDR_MAP[pos] = inst
+    ADDR_MAP[pos] = FmInstrument(*struct.unpack('<BBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB', raw), length=0x20, _addr=pos)
 
     pos += 0x20
 
@@ -93,7 +127,7 @@ def proc_drumseq(drum_seq_ptr, name='gateSeq'):
     pos += 1
     size += 1
 
-  ADDR_MAP[drum_seq_ptr] = mkobj(name, _addr=drum_seq_ptr, tokens=tokens, length=size)
+  ADDR_MAP[drum_seq_ptr] = EnvSeq(name, tokens, _addr=drum_seq_ptr, length=size)
 
 
 def proc_volseq(vol_seq_ptr):
@@ -137,7 +171,7 @@ def proc_volseq(vol_seq_ptr):
       pos += 1
       size += 1
 
-  ADDR_MAP[vol_seq_ptr] = mkobj('volSeq', _addr=vol_seq_ptr, tokens=tokens, length=size)
+  ADDR_MAP[vol_seq_ptr] = EnvSeq('volSeq', tokens, _addr=vol_seq_ptr, length=size)
 
 
 def proc_pitchseq(pitch_seq_ptr):
@@ -161,7 +195,7 @@ def proc_pitchseq(pitch_seq_ptr):
   else:
     breakpoint()
 
-  ADDR_MAP[pitch_seq_ptr] = mkobj('pitchSeq', _addr=pitch_seq_ptr, tokens=tokens, length=size)
+  ADDR_MAP[pitch_seq_ptr] = EnvSeq('pitchSeq', tokens, _addr=pitch_seq_ptr, length=size)
 
 
 def proc_macro_table(macro_table_ptr):
@@ -172,12 +206,8 @@ def proc_macro_table(macro_table_ptr):
   while True:
 
     raw = DATA[pos:pos + 0xb]
-    macro = mkobj("drumDef")
-
-    macro.instr, macro.note, macro.vol_mod, macro.vol_env_ptr, macro.pitch_env_ptr, macro.ssg_mask_env_ptr, \
-    macro.ssg_noise_env_ptr = struct.unpack('<BBbHHHH', raw)
+    macro = DrumDef(*struct.unpack('<BBbHHHH', raw), length=0xb)
     macro.note = seq_parser._note_text(macro.note)
-    macro.length = 0xb
 
     end = macro_table_ptr + calc_obj_size(macro_table_ptr)
     if pos > end - 0xb:
@@ -228,7 +258,7 @@ def proc_voltable(vol_seq_tbl):
 
   while pos < end:
     vol_seq_ptr = get_word(pos)
-    ADDR_MAP[pos] = mkobj('pVolSeq', _addr=pos, pos=vol_seq_ptr, length=2)
+    ADDR_MAP[pos] = Pointer('pVolSeq', vol_seq_ptr, _addr=pos, length=2)
     boundaries.add(vol_seq_ptr)
     end = vol_seq_tbl + calc_obj_size(vol_seq_tbl)
     proc_volseq(vol_seq_ptr)
@@ -241,7 +271,7 @@ def proc_pitchtable(pitch_env_tbl):
 
   while pos < end:
     pitch_seq_ptr = get_word(pos)
-    ADDR_MAP[pos] = mkobj('pPitchSeq', _addr=pos, pos=pitch_seq_ptr, length=2)
+    ADDR_MAP[pos] = Pointer('pPitchSeq', pitch_seq_ptr, _addr=pos, length=2)
     boundaries.add(pitch_seq_ptr)
     end = pitch_env_tbl + calc_obj_size(pitch_env_tbl)
     proc_pitchseq(pitch_seq_ptr)
@@ -277,19 +307,14 @@ def proc_song(song_ptr):
   song_props = DATA[song_ptr]
   song_flags = (song_props & 0b11110000) >> 4
   track_count = song_props & 0b00001111
-  ADDR_MAP[song_ptr] = mkobj("songDef", flags=song_flags, track_count=track_count, length=1)
+  ADDR_MAP[song_ptr] = SongDef(song_flags, track_count, length=1)
   res = []
 
   track_ptr = song_ptr + 1
   for i in range(0, track_count):
 
     hdr = DATA[track_ptr:track_ptr + 0xc]
-    track = mkobj("track")
-
-    track.num, track.mode, track.vol, track.vol_env, track.pitch_env, track.transpose, \
-    track.speed, track.chan, track.seq_ptr, track.instrument, track.unknown = struct.unpack('<BBbBBbBBHBB', hdr)
-    track._addr = track_ptr
-    track.length = 12
+    track = Track(*struct.unpack('<BBbBBbBBHBB', hdr), _addr=track_ptr, length=12)
 
     proc_track(track.seq_ptr)
     ADDR_MAP[track_ptr] = track
@@ -305,7 +330,7 @@ def proc_notelentable(note_len_tbl):
 
   while pos < end:
     note_len = DATA[pos]
-    ADDR_MAP[pos] = mkobj('noteLen', _addr=pos, duration=note_len, length=1)
+    ADDR_MAP[pos] = NoteLen(note_len, _addr=pos, length=1)
     pos += 1
 
 
@@ -329,16 +354,16 @@ def proc_songtable(song_ptr_tbl):
       pos += 2
       continue
 
-    song = mkobj('song', _addr=pos, pos=head_addr, length=2)
+    song = Pointer('song', head_addr, _addr=pos, length=2)
     ADDR_MAP[pos] = song
     proc_song(head_addr)
 
     pos += 2
 
-def process_single_label(obj, offset):
+def process_single_label(offset):
 
   # Skip whatever lies outside our token map
-  if offset not in ADDR_MAP:
+  if not isinstance(offset, int) or offset not in ADDR_MAP:
     return
 
   reference = ADDR_MAP[offset]
@@ -352,15 +377,14 @@ def process_single_label(obj, offset):
 
     diff = offset - pos
 
-  if hasattr(reference, 'label'):
+  if isinstance(reference, str):
+    label = f'loc_{offset:x}'
+    reference = Location(text=reference, label=label)
+  elif reference.label:
     label = reference.label
     if diff:
       label += f'+{diff}'
     return label
-
-  if isinstance(reference, str):
-    label = f'loc_{offset:x}'
-    reference = mkobj('location', text=reference, label=label)
   else:
     label = f'{reference.name}_{offset:x}'
     reference.label = label
@@ -383,7 +407,23 @@ def proc_magic(magic_ptr):
     if DATA[i] > 0x7f or DATA[i] < 0x20:
       end = i
 
-  ADDR_MAP[MAGIC_OFFSET] = mkobj("magic", data=f'"{DATA[pos:end].decode()}"', length=end-pos)
+  ADDR_MAP[MAGIC_OFFSET] = Magic(f'"{DATA[pos:end].decode()}"', length=end-pos)
+
+
+def proc_orphans():
+  ''' Decodes song headers and tracks that fplay_scan finds in bytes nothing points at.
+      Roots get orphan label, so they stand out even when nothing jumps there.
+  '''
+  import fplay_scan
+
+  for cand in fplay_scan.scan(DATA, ADDR_MAP, LONG_VCMDS):
+    if not isinstance(ADDR_MAP[cand.addr], str):
+      continue
+    if cand.name == 'songCandidate':
+      proc_song(cand.addr)
+    else:
+      proc_track(cand.addr)
+    ADDR_MAP[cand.addr].label = f'orphan_{cand.addr:x}'
 
 
 def process_address_map():
@@ -393,36 +433,25 @@ def process_address_map():
     if isinstance(obj, str) or obj is None:
       continue
 
-    if not hasattr(obj, 'length'):
-      breakpoint()
-
-    length = obj.length
-
-    for i in range(addr+1, addr+length):
+    for i in range(addr+1, addr+obj.length):
       ADDR_MAP[i] = None
 
-  # Pass 1: For all objects with pos attribute, add label at that address
-  pointers = ('pos', 'vol_env_ptr', 'pitch_env_ptr', 'ssg_mask_env_ptr', 'ssg_noise_env_ptr', 'seq_ptr')
-  for obj_addr, obj in ADDR_MAP.items():
+  # Pass 1: Label every address some object points at, pointer fields are declared by node classes
+  for obj in ADDR_MAP.values():
     if isinstance(obj, str) or obj is None:
       continue
-
-    for ref_attr in pointers:
-      if hasattr(obj, ref_attr):
-        label_name = process_single_label(obj, getattr(obj, ref_attr))
-        if label_name:
-          setattr(obj, ref_attr, label_name)
-
-    if hasattr(obj, 'args') and type(obj.args) == dict and 'addr' in obj.args:
-      label_name = process_single_label(obj, obj.args['addr'])
-      if label_name:
-        obj.args['addr'] = label_name
+    obj.relabel(process_single_label)
 
 
 def print_listing():
 
   print('\n\tinclude "general.inc"\n\torg 04000h\n\nstart:')
 
+  if DEBUG_ENABLED:
+    prefix = lambda addr: f'{addr-HEADER_BASE_ADDR:04x}\t'
+  else:
+    prefix = lambda addr: '\t'
+
   # To explicitly add new line on object type change
   hanging = False
   old_obj = str()
@@ -430,48 +459,51 @@ def print_listing():
   # Print the whole listing
   for addr, obj in ADDR_MAP.items():
 
+    if obj is None:
+      continue
+
     if isinstance(obj, str):
       if (addr - 1 in ADDR_MAP) and (ADDR_MAP[addr-1] is None) or hanging:
         print()
         hanging = False
 
-      print(f'{addr-HEADER_BASE_ADDR:04x}\t{obj}' if DEBUG_ENABLED else f'\t{obj}')
-
-    elif obj is None:
+      print(prefix(addr) + obj)
       continue
 
-    else:
-      if hasattr(obj, 'label'):
-        if hanging: print(); hanging = False
-        print(f'\n{obj.label}:')
-
-      # Ugh, I need to add some proper type instead of these lousy heuristics
-      if hasattr(obj, '_vcmd'):
-        if obj._vcmd and not obj._vcmd.is_property:
-
-          if hanging: print(); hanging = False
-          print(f'{addr-HEADER_BASE_ADDR:04x}\t{obj.as_macro()}' if DEBUG_ENABLED else f'\t{obj.as_macro()}' )
-        else:
+    if obj.label:
+      if hanging: print(); hanging = False
+      print(f'\n{obj.label}:')
 
-          if not hanging: print('\t', end='')
-          print(f'{obj.as_macro()}' , end=' ')
-          hanging = True
+    # Notes and properties run on one line, commands and tables get their own
+    if obj.inline:
+      if not hanging: print('\t', end='')
+      print(obj.as_macro(), end=' ')
+      hanging = True
+      continue
 
-      else:
-        if hanging: print(); hanging = False
-        if old_obj != obj.name:
+    if hanging: print(); hanging = False
+    if obj.annotated:
+      if old_obj != obj.name:
+        print(f';\t{obj.annotate()}')
+      old_obj = obj.name
 
-          print(f';\t{obj.annotate()}')
+    print(prefix(addr) + obj.as_macro())
 
-        print(f'{addr-HEADER_BASE_ADDR:04x}\t{obj.as_macro()}' if DEBUG_ENABLED else f'\t{obj.as_macro()}' )
-        old_obj = obj.name
 
+def load_bank(raw):
+  ''' Decode raw bank bytes into ADDR_MAP, keeping pointers numeric.
+      Resets module state, so it can be called repeatedly by other tools.
+  '''
+  global DATA, ADDR_MAP
 
-def do_barrel_roll(data):
+  DATA = b'\x00'*HEADER_BASE_ADDR + raw
+  ADDR_MAP = AddrMap(RAW_BYTES[x] for x in raw)
+  EVENT_TAIL_MAP.clear()
+  boundaries.clear()
+  boundaries.add(HEADER_BASE_ADDR)
 
-  # Populate maps with raw bytes
-  for i, db, in enumerate(DATA[HEADER_BASE_ADDR:], start=HEADER_BASE_ADDR):
-    ADDR_MAP[i] = f"db 0{db:02x}h"
+  if DATA[MAGIC_OFFSET:MAGIC_OFFSET + len(MAGIC)] != MAGIC and not FORCE:
+    raise ValueError('Not a FRS00PLAY data?')
 
   # Gather all pointers and file end location, this will allow us to determine object boundaries.
   fm_inst_ptr = get_word(FM_TONE_TBL)
@@ -481,12 +513,12 @@ def do_barrel_roll(data):
   pitch_seq_ptr = get_word(PITCH_TBL)
   sng_tbl_ptr = get_word(SNG_TBL)
 
-  ADDR_MAP[FM_TONE_TBL] = mkobj("pFmToneTbl", pos=fm_inst_ptr, text=f"dw {fm_inst_ptr:04x}h", length=2)
-  ADDR_MAP[DRUM_MACRO_TBL] = mkobj("pDrumMacroTbl", pos=macro_table_ptr, text=f"dw {macro_table_ptr:04x}h", length=2)
-  ADDR_MAP[NOTE_LEN_TBL] = mkobj("pNoteLengthTbl", pos=note_len_ptr, text=f"dw {note_len_ptr:04x}h", length=2)
-  ADDR_MAP[VOL_TBL] = mkobj("pVolEnvTbl", pos=vol_seq_ptr, text=f"dw {vol_seq_ptr:04x}h", length=2)
-  ADDR_MAP[PITCH_TBL] = mkobj("pPitchEnvTbl", pos=pitch_seq_ptr, text=f"dw {pitch_seq_ptr:04x}h", length=2)
-  ADDR_MAP[SNG_TBL] = mkobj("pSongTbl", pos=sng_tbl_ptr, text=f"dw {sng_tbl_ptr:04x}h", length=2)
+  ADDR_MAP[FM_TONE_TBL] = Pointer("pFmToneTbl", fm_inst_ptr, length=2)
+  ADDR_MAP[DRUM_MACRO_TBL] = Pointer("pDrumMacroTbl", macro_table_ptr, length=2)
+  ADDR_MAP[NOTE_LEN_TBL] = Pointer("pNoteLengthTbl", note_len_ptr, length=2)
+  ADDR_MAP[VOL_TBL] = Pointer("pVolEnvTbl", vol_seq_ptr, length=2)
+  ADDR_MAP[PITCH_TBL] = Pointer("pPitchEnvTbl", pitch_seq_ptr, length=2)
+  ADDR_MAP[SNG_TBL] = Pointer("pSongTbl", sng_tbl_ptr, length=2)
 
   boundaries.update([
     fm_inst_ptr,
@@ -506,6 +538,13 @@ def do_barrel_roll(data):
   proc_songtable(sng_tbl_ptr)
   proc_magic(MAGIC_OFFSET)  # There seem to be interesting stuff from time to time
 
+  return ADDR_MAP
+
+
+def do_barrel_roll(raw):
+  load_bank(raw)
+  if SCAN:
+    proc_orphans()
   process_address_map()
   print_listing()
 
@@ -515,18 +554,21 @@ if __name__ == '__main__':
   parser.add_argument('-d', '--debug', action='store_true', help='Print address of each token')
   parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
   parser.add_argument('-l', '--long', action='store_true', help='Use long command names for listing')
+  parser.add_argument('-s', '--scan', action='store_true', help='Also decode songs and tracks nothing points at')
+  parser.add_argument('-w', '--watch', action='store_true', help='Decode into NAME.M every time file changes')
   args = parser.parse_args()
 
+  if args.watch:
+    import fplay_watch
+    fplay_watch.watch([args.file], args.long, force=args.force, scan=args.scan, build=False)
+    raise SystemExit
+
   DEBUG_ENABLED = args.debug
   LONG_VCMDS = args.long
   FORCE = args.force
+  SCAN = args.scan
 
   with open(args.file, 'rb') as f:
     raw = f.read()
 
-  DATA = b'\x00'*HEADER_BASE_ADDR + raw
-
-  if DATA[MAGIC_OFFSET:MAGIC_OFFSET + len(MAGIC)] != MAGIC and not FORCE:
-    raise ValueError('Not a FRS00PLAY data?')
-
   do_barrel_roll(raw)
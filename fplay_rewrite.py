@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+import os, re, sys, bisect, argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import fplay_parse
+import fplay_bank
+import fplay_check
+from fplay_stats import find_banks
+from tools import *
+
+# Bulk edits straight on relocatable bank from fplay_bank, no listing text and no assembler:
+#
+#   args(cmd, fn)        argument of every `cmd` mapped through fn, bytes patched where they are
+#   header(field, fn)    field of every track header mapped through fn, patched in place too
+#   replace(unit, data)  command gets other bytes, code after it moves and pointers follow
+#   drop(cmd)            every `cmd` removed, one right after swfm/swsg/scne becomes noops instead
+#
+# Values are clamped to what the argument holds. When nothing changed length assembled bank has
+# every address where it was, so it differs from input only in patched bytes.
+
+SET_SPEED = 0x96
+SET_INSTRUMENT = 0xa3
+NOOP = 0x8c
+
+# Track header field: (offset, param flag), layout is the one fplay_parse unpacks
+HEADER_FIELDS = {
+  'vol': (2, 's'),
+  'vol_env': (3, 'b'),
+  'pitch_env': (4, 'b'),
+  'transpose': (5, 's'),
+  'speed': (6, 'b'),
+  'instrument': (10, 'b'),
+}
+LIMITS = {'b': (0, 0xff), 'c': (0, 0xff), 's': (-0x80, 0x7f), 'w': (0, 0xffff)}
+# Speed 0 never lets tempo counter overflow, driver takes that as tick every interrupt
+MIN_SPEED = 1
+
+RULE_RE = re.compile(r'^(\w+?)(?:\.(\d+))?([-+*=:])(.+)$')
+
+
+def encode(value, flag):
+  lo, hi = LIMITS[flag]
+  value = max(lo, min(hi, value))
+  return value.to_bytes(2 if flag == 'w' else 1, 'little', signed=flag == 's')
+
+
+class Rewriter:
+  ''' Edits of one bank, result() assembles it
+  '''
+
+  def __init__(self, raw, use_long=False):
+    self.raw = raw
+    self.bank = fplay_bank.from_raw(raw, use_long)
+    self.parser = self.bank.parser
+    self.names = {cmd.name: code for code, cmd in self.parser.commands.items()}
+    self.frozen = fplay_bank.frozen_keys(self.bank)
+    self.tracks = sorted({addr for addr, obj in fplay_parse.ADDR_MAP.items() if getattr(obj, 'name', None) == 'track'})
+    self.keys = [u.key for u in self.bank.units]
+    self.patched = 0
+    self.resized = 0
+
+  def opcode(self, cmd):
+    if isinstance(cmd, int):
+      return cmd
+    if cmd not in self.names:
+      raise ValueError(f'Unknown command {cmd}')
+    return self.names[cmd]
+
+  def commands(self, cmd):
+    code = self.opcode(cmd)
+    for unit in self.bank.units:
+      if unit.code and unit.data and unit.data[0] == code:
+        yield unit
+
+  def patch(self, unit, offset, data):
+    if unit.data[offset:offset + len(data)] != data:
+      unit.data[offset:offset + len(data)] = data
+      self.patched += 1
+
+  def args(self, cmd, fn, arg=0):
+    ''' Maps argument number arg of every cmd through fn(value)
+    '''
+    code = self.opcode(cmd)
+    params = self.parser.commands[code].parameters
+    if arg >= len(params):
+      raise ValueError(f'{self.parser.commands[code].name} has {len(params)} arguments')
+    param = params[arg]
+    offset = 1 + sum(x.length for x in params[:arg])
+    for unit in self.commands(code):
+      if any(x[0] == offset for x in unit.relocs):
+        raise ValueError(f'{param.name} of {self.parser.commands[code].name} is a pointer')
+      value = param.parser(unit.data[offset:offset + param.length])
+      self.patch(unit, offset, encode(fn(value), param.flag))
+
+  def locate(self, addr):
+    ''' Original unit holding original address, with offset in it
+    '''
+    i = bisect.bisect_right(self.keys, addr) - 1
+    unit = self.bank.units[i]
+    return unit, addr - unit.key
+
+  def header(self, field, fn):
+    ''' Maps field of every track header through fn(value)
+    '''
+    if field not in HEADER_FIELDS:
+      raise ValueError(f'Unknown track header field {field}')
+    offset, flag = HEADER_FIELDS[field]
+    for addr in self.tracks:
+      unit, pos = self.locate(addr + offset)
+      value = int.from_bytes(unit.data[pos:pos + 1], 'little', signed=flag == 's')
+      self.patch(unit, pos, encode(fn(value), flag))
+
+  def replace(self, unit, data, relocs=None):
+    ''' New bytes for code unit. Changing length of command with pointer needs its relocs given,
+        changing length right after skip command is refused, driver skips fixed number of bytes.
+    '''
+    data = bytearray(data)
+    if len(data) == len(unit.data):
+      self.patch(unit, 0, data)
+      if relocs is not None:
+        unit.relocs = relocs
+      return
+    if unit.key in self.frozen:
+      raise ValueError(f'{unit.key}: size of command after skip can\'t change')
+    if unit.relocs and relocs is None:
+      raise ValueError(f'{unit.key}: command with pointer changes size, relocs needed')
+    unit.data = data
+    unit.relocs = relocs or []
+    self.resized += 1
+
+  def drop(self, cmd):
+    code = self.opcode(cmd)
+    vcmd = self.parser.commands[code]
+    if vcmd.is_final or vcmd.is_control:
+      raise ValueError(f'{vcmd.name} changes control flow, can\'t drop it')
+    for unit in list(self.commands(code)):
+      if unit.key in self.frozen:
+        self.replace(unit, bytes([NOOP] * len(unit.data)))
+      else:
+        self.replace(unit, b'')
+
+  def result(self):
+    ''' Assembled bank and whether any code moved
+    '''
+    return self.bank.assemble(), bool(self.resized)
+
+
+def parse_rule(rule):
+  ''' "trp+1", "sva.2-3", "s*1.5", "vol=12" or "i:3=5,4=7" into (name, arg, op, value)
+  '''
+  m = RULE_RE.match(rule)
+  if not m:
+    raise ValueError(f'Bad rule {rule}')
+  name, arg, op, value = m.groups()
+  if op == ':':
+    value = {int(a, 0): int(b, 0) for a, b in (x.split('=') for x in value.split(','))}
+  elif op == '*':
+    value = float(value)
+  else:
+    value = int(value, 0)
+  return name, int(arg or 0), op, value
+
+
+def rule_fn(op, value, low=None):
+  ''' Function of the rule, with low its result never goes under low
+  '''
+  fn = rule_op(op, value)
+  return fn if low is None else lambda x: max(low, fn(x))
+
+
+def rule_op(op, value):
+  if op == '+':
+    return lambda x: x + value
+  if op == '-':
+    return lambda x: x - value
+  if op == '*':
+    return lambda x: round(x * value)
+  if op == '=':
+    return lambda x: value
+  return lambda x: value.get(x, x)
+
+
+def apply(rewriter, edits):
+  ''' edits are ('arg', cmd, arg, op, value), ('header', field, op, value) or ('drop', cmd)
+  '''
+  for kind, *rest in edits:
+    if kind == 'arg':
+      cmd, arg, op, value = rest
+      speed = rewriter.opcode(cmd) == SET_SPEED
+      rewriter.args(cmd, rule_fn(op, value, MIN_SPEED if speed else None), arg)
+    elif kind == 'header':
+      field, op, value = rest
+      rewriter.header(field, rule_fn(op, value, MIN_SPEED if field == 'speed' else None))
+    else:
+      rewriter.drop(rest[0])
+
+
+def rewrite_bank(path, edits, out_dir=None, use_long=False, force=False):
+  ''' Applies edits to one bank, runs in worker. Returns (path, (patched, resized, growth, moved) or error)
+  '''
+  fplay_parse.FORCE = force
+  try:
+    with open(path, 'rb') as f:
+      raw = f.read()
+    rewriter = Rewriter(raw, use_long)
+    apply(rewriter, edits)
+    out, moved = rewriter.result()
+
+    problems = fplay_check.check_bank(out, use_long=use_long, force=True).problems if out != raw else []
+    if problems:
+      return path, 'fails driver limits: ' + '; '.join(problems)
+    if out_dir:
+      with open(os.path.join(out_dir, os.path.basename(path)), 'wb') as f:
+        f.write(out)
+    return path, (rewriter.patched, rewriter.resized, len(out) - len(raw), moved)
+  except Exception as e:
+    return path, f'{type(e).__name__}: {e}'
+
+
+def rewrite_all(paths, edits, workers=None, ext='.DAT', **kwargs):
+  ''' Streams banks through a process pool, yields rewrite_bank results as they complete
+  '''
+  with ProcessPoolExecutor(workers) as pool:
+    limit = (workers or os.cpu_count() or 1) * 4
+    pending = set()
+    for path in find_banks(paths, ext):
+      pending.add(pool.submit(rewrite_bank, path, edits, **kwargs))
+      if len(pending) >= limit:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        yield from (x.result() for x in done)
+
+    for fut in pending:
+      yield fut.result()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Rewrite FPLAY banks without going through listing and assembler')
+  parser.add_argument('paths', nargs='+', help='Bank files or directories to rewrite')
+  parser.add_argument('-o', '--out', help='Output directory, without it nothing is written')
+  parser.add_argument('-a', '--arg', action='append', default=[],
+                      help='Command argument rule, "trp+1", "sc*2", "sva.1-3", "i:3=5,4=7"')
+  parser.add_argument('-H', '--header', action='append', default=[],
+                      help=f'Track header rule, fields {", ".join(HEADER_FIELDS)}')
+  parser.add_argument('-d', '--drop', action='append', default=[], help='Remove every such command')
+  parser.add_argument('-t', '--transpose', type=int, help='Transpose every track by semitones')
+  parser.add_argument('-k', '--tempo', type=float, help='Scale every track speed and s command')
+  parser.add_argument('-i', '--instruments', help='Remap FM tones in headers and i commands, "3=5,4=7"')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-l', '--long', action='store_true', help='Use long command names')
+  parser.add_argument('-j', '--jobs', type=int, help='Worker processes')
+  parser.add_argument('-e', '--ext', default='.DAT', help='Bank file extension when scanning directories')
+  args = parser.parse_args()
+
+  edits = []
+  if args.transpose:
+    edits.append(('header', 'transpose', '+', args.transpose))
+  if args.tempo:
+    edits += [('header', 'speed', '*', args.tempo), ('arg', SET_SPEED, 0, '*', args.tempo)]
+  try:
+    if args.instruments:
+      _, _, _, mapping = parse_rule('i:' + args.instruments)
+      edits += [('header', 'instrument', ':', mapping), ('arg', SET_INSTRUMENT, 0, ':', mapping)]
+    for rule in args.arg:
+      edits.append(('arg', *parse_rule(rule)))
+    for rule in args.header:
+      name, _, op, value = parse_rule(rule)
+      edits.append(('header', name, op, value))
+  except ValueError as e:
+    parser.error(str(e))
+  edits += [('drop', x) for x in args.drop]
+  if not edits:
+    parser.error('nothing to do')
+
+  if args.out:
+    os.makedirs(args.out, exist_ok=True)
+
+  failed = 0
+  for path, res in rewrite_all(args.paths, edits, args.jobs, args.ext.upper(), out_dir=args.out, use_long=args.long,
+                               force=args.force):
+    if isinstance(res, str):
+      failed += 1
+      orig_print(f'{path}\t{res}', file=sys.stderr)
+    else:
+      patched, resized, growth, moved = res
+      orig_print(f'{path}\t{patched} patched\t{resized} resized\t' +
+                 (f'relocated, {growth:+d} bytes' if moved else 'in place'))
+  sys.exit(1 if failed else 0)
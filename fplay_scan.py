@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+import fplay_parse
+from fplay_parse import HEADER_BASE_ADDR
+from fplay_flow import JUMPS
+from fplay_stats import find_banks
+from tools import *
+
+# Looks for sequence code nothing in the header points at: orphaned tracks, alternate songs, leftovers.
+# Every byte of the bank is classified at once from the grammar, then decoding from every byte is
+# followed to where it stops with pointer doubling, so the whole bank costs log2(size) numpy passes.
+#
+#   final    decoding stops on stop/hlt/goto/return, like proc_track does
+#   joins    decoding runs into code that header pointers already reach
+#   invalid  unknown byte, byte of decoded table, jump out of bank or end of data
+
+FINAL, JOINS, INVALID = 'final', 'joins', 'invalid'
+MIN_TOKENS = 4
+
+
+def byte_classes(parser):
+  ''' Per byte value lookup tables: token length (0 when byte can't start token),
+      whether it ends decoding, whether it is note or drum, whether it has jump address
+  '''
+  length = np.zeros(256, np.int64)
+  final = np.zeros(256, bool)
+  sound = np.zeros(256, bool)
+  jump = np.zeros(256, bool)
+
+  for value in range(256):
+    # Parser stops on anything above 0efh
+    if value > 0xef:
+      continue
+    vcmd = parser.commands.get(value)
+    if vcmd is not None:
+      length[value] = vcmd.length
+      final[value] = vcmd.is_final
+      jump[value] = value in JUMPS
+    elif parser._note_text(value) is not None or parser._drum_text(value) is not None:
+      length[value] = 1
+      sound[value] = True
+
+  return length, final, sound, jump
+
+
+def claimed_bytes(addr_map, size):
+  ''' Masks of bytes covered by decoded objects and of decoded code starts, relative to bank start
+  '''
+  claimed = np.zeros(size, bool)
+  code = np.zeros(size, bool)
+  for addr, obj in addr_map.items():
+    if obj is None or isinstance(obj, str):
+      continue
+    pos = addr - HEADER_BASE_ADDR
+    claimed[pos:pos + obj.length] = True
+    if isinstance(obj, Token):
+      code[pos] = True
+  return claimed, code
+
+
+def follow(data, claimed, code, parser):
+  ''' Decodes from every byte at once. Returns arrays of token count, note and drum count
+      and end kind as index into (FINAL, JOINS, INVALID)
+  '''
+  size = len(data) - HEADER_BASE_ADDR
+  ops = np.frombuffer(data, np.uint8, offset=HEADER_BASE_ADDR)
+  length, final, sound, jump = [x[ops] for x in byte_classes(parser)]
+  pos = np.arange(size)
+  nxt = pos + length
+
+  # Jump address is always the last word of token, it has to land on code or undecoded bytes
+  padded = np.concatenate([ops, np.zeros(2, np.uint8)]).astype(np.int64)
+  hi = np.minimum(nxt, size + 1) - 1
+  target = padded[hi - 1] | padded[hi] << 8
+  target -= HEADER_BASE_ADDR
+  inside = (target >= 0) & (target < size)
+  safe = np.where(inside, target, 0)
+  bad_jump = jump & ~(inside & (code[safe] | ~claimed[safe]))
+
+  # Jumps into undecoded bytes are only as good as decoding from their target, recheck until nothing changes
+  while True:
+    tokens, sounds, end = chase(size, length == 0, nxt, final, sound, bad_jump | (claimed & ~code), code)
+    worse = bad_jump | (jump & inside & ~code[safe] & (end[safe] == 2))
+    if (worse == bad_jump).all():
+      return tokens, sounds, end
+    bad_jump = worse
+
+
+def chase(size, unknown, nxt, final, sound, bad, code):
+  # Sinks: size ends invalid, size + 1 ends final, size + 2 joins known code
+  sink_invalid, sink_final, sink_joins = size, size + 1, size + 2
+  invalid = unknown | (nxt > size) | bad
+  step = np.where(final, sink_final, np.minimum(nxt, sink_invalid))
+  step = np.where(invalid, sink_invalid, step)
+  step = np.where(code, sink_joins, step)
+  walked = ~invalid & ~code
+
+  step = np.concatenate([step, [sink_invalid, sink_final, sink_joins]])
+  tokens = np.concatenate([walked, np.zeros(3, bool)]).astype(np.int64)
+  sounds = np.concatenate([walked & sound, np.zeros(3, bool)]).astype(np.int64)
+
+  # Pointer doubling, chains only go forward so they all reach sink in log2(size) rounds
+  for _ in range(max(1, int(size).bit_length())):
+    tokens += tokens[step]
+    sounds += sounds[step]
+    step = step[step]
+
+  end = np.choose(step[:size] - sink_invalid, [2, 0, 1])
+  return tokens[:size], sounds[:size], end
+
+
+def table_sizes(addr_map):
+  objs = [o for o in addr_map.values() if o is not None and not isinstance(o, str)]
+  return [sum(o.name == name for o in objs) for name in ('pVolSeq', 'pPitchSeq', 'fmInstrument')]
+
+
+def song_headers(ops, claimed, code, end, sizes):
+  ''' Song header candidates: track count in low nibble followed by that many track headers
+      numbered from 0, with envelope and instrument indexes inside tables and sequence pointer
+      landing on code or on bytes that decode. Returns mask of header starts.
+  '''
+  size = len(ops)
+  pos = np.arange(size)
+  counts = ops & 0xf
+  span = 1 + 12 * counts
+  padded = np.concatenate([ops, np.zeros(12 * 16, np.uint8)]).astype(np.int64)
+
+  # Whole header has to lie in undecoded bytes
+  taken = np.concatenate([[0], np.cumsum(claimed)])
+  good = (counts > 0) & (pos + span <= size)
+  good &= taken[np.minimum(pos + span, size)] == taken[pos]
+
+  vol_envs, pitch_envs, instruments = sizes
+  for k in range(15):
+    hdr = pos + 1 + 12 * k
+    target = padded[hdr + 8] | padded[hdr + 9] << 8
+    target -= HEADER_BASE_ADDR
+    inside = (target >= 0) & (target < size)
+    safe = np.where(inside, target, 0)
+    ok = (padded[hdr] == k) & (padded[hdr + 3] < vol_envs) & (padded[hdr + 4] < pitch_envs)
+    ok &= (padded[hdr + 10] < instruments) & inside & (code[safe] | (~claimed[safe] & (end[safe] != 2)))
+    good &= (counts <= k) | ok
+  return good
+
+
+def scan(data=None, addr_map=None, use_long=False, min_tokens=MIN_TOKENS):
+  ''' Song headers and sequence starts in bytes decoder left as db, songs first, then tracks best first.
+      Candidates don't overlap, start inside of better candidate's tokens is dropped.
+      Works on loaded fplay_parse state by default.
+  '''
+  data = fplay_parse.DATA if data is None else data
+  addr_map = fplay_parse.ADDR_MAP if addr_map is None else addr_map
+  parser = SequenceParser(use_long, data)
+  size = len(data) - HEADER_BASE_ADDR
+  ops = np.frombuffer(data, np.uint8, offset=HEADER_BASE_ADDR)
+  length = byte_classes(parser)[0][ops]
+
+  claimed, code = claimed_bytes(addr_map, size)
+  tokens, sounds, end = follow(data, claimed, code, parser)
+  res = []
+  roots = []
+
+  # Songs come first, their headers would otherwise decode as notes
+  for pos in np.flatnonzero(song_headers(ops, claimed, code, end, table_sizes(addr_map))).tolist():
+    count = int(ops[pos] & 0xf)
+    if claimed[pos:pos + 1 + 12 * count].any():
+      continue
+    claimed[pos:pos + 1 + 12 * count] = True
+    res.append(mkobj('songCandidate', addr=pos + HEADER_BASE_ADDR, tracks=count))
+    for k in range(count):
+      hdr = pos + 1 + 12 * k
+      roots.append(int(ops[hdr + 8]) | int(ops[hdr + 9]) << 8)
+
+  if res:
+    tokens, sounds, end = follow(data, claimed, code, parser)
+
+  # Ending cleanly matters more than length, code that only runs into known code is weaker evidence
+  score = tokens * np.where(end == 0, 2, 1)
+  ok = ~claimed & (end != 2) & (tokens >= min_tokens) & (sounds > 0)
+  order = np.flatnonzero(ok)
+  order = order[np.lexsort((order, -score[order]))]
+
+  covered = claimed.copy()
+  for addr in roots:
+    pos = addr - HEADER_BASE_ADDR
+    for _ in range(tokens[pos]):
+      covered[pos:pos + length[pos]] = True
+      pos += length[pos]
+
+  for pos in order.tolist():
+    if covered[pos]:
+      continue
+    start = pos
+    for _ in range(tokens[start]):
+      covered[pos:pos + length[pos]] = True
+      pos += length[pos]
+    res.append(mkobj('trackCandidate', addr=start + HEADER_BASE_ADDR, tokens=int(tokens[start]),
+                     notes=int(sounds[start]), end=(FINAL, JOINS)[end[start]], score=int(score[start])))
+  return res
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Find sequence code that FPLAY bank header doesn\'t reach')
+  parser.add_argument('paths', nargs='+', help='Bank files or directories to scan')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-l', '--long', action='store_true', help='Use long command names')
+  parser.add_argument('-e', '--ext', default='.DAT', help='Bank file extension when scanning directories')
+  parser.add_argument('-m', '--min', type=int, default=MIN_TOKENS, help='Minimum tokens decoded from candidate')
+  parser.add_argument('-n', '--top', type=int, default=10, help='Candidates to print per bank')
+  args = parser.parse_args()
+
+  fplay_parse.FORCE = args.force
+  for path in find_banks(args.paths, args.ext.upper()):
+    with open(path, 'rb') as f:
+      fplay_parse.load_bank(f.read())
+    for cand in scan(use_long=args.long, min_tokens=args.min)[:args.top]:
+      if cand.name == 'songCandidate':
+        orig_print(f'{path}\t{cand.addr - HEADER_BASE_ADDR:04x}\tsong\t{cand.tracks} tracks')
+      else:
+        orig_print(f'{path}\t{cand.addr - HEADER_BASE_ADDR:04x}\ttrack\t{cand.tokens} tokens, {cand.notes} notes, {cand.end}')
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+import os, json, asyncio, argparse
+from concurrent.futures import ProcessPoolExecutor
+import fplay_parse
+from fplay_sim import SongPlayer, song_pointers
+from tools import *
+
+# Audition server: bank is loaded once, clients send JSON line commands and get
+# driver events streamed back as JSON lines.
+#
+#   {"cmd": "songs"}
+#   {"cmd": "play", "song": 0, "loops": 1, "rate": 0}   rate is interrupts per second, 0 streams ASAP
+#   {"cmd": "stop"}
+#   {"cmd": "seek", "interrupt": 1000}                   song starts again from there, paced from there
+#   {"cmd": "mute", "chan": 3, "on": true}
+#
+# Events are rendered by worker processes in chunks, every connection has a bounded chunk
+# queue, so slow client stalls its own renderer instead of piling up memory.
+
+CHUNK_INTERRUPTS = 64
+QUEUE_CHUNKS = 8
+
+WORKER_DATA = None
+
+
+def worker_init(raw, force):
+  global WORKER_DATA
+  fplay_parse.FORCE = force
+  fplay_parse.load_bank(raw)
+  WORKER_DATA = fplay_parse.DATA
+
+
+def render_chunk(player, interrupts):
+  ''' Runs in worker, returns advanced player and events it emitted
+  '''
+  player.attach(WORKER_DATA)
+  events = []
+  for _ in range(interrupts):
+    if player.finished:
+      break
+    events.extend(player.step())
+  return player, events
+
+
+class Session:
+  def __init__(self, server, reader, writer):
+    self.server = server
+    self.reader = reader
+    self.writer = writer
+    self.queue = asyncio.Queue(QUEUE_CHUNKS)
+    self.render_task = None
+    self.send_task = None
+    self.muted = set()
+    self.playing = None
+
+  async def send(self, msg):
+    self.writer.write(json.dumps(msg).encode() + b'\n')
+    await self.writer.drain()
+
+  async def render(self, player, start=0):
+    loop = asyncio.get_running_loop()
+    try:
+      # Seeking is plain rendering with events thrown away
+      while player.interrupt < start and not player.finished:
+        player, _ = await loop.run_in_executor(
+          self.server.pool, render_chunk, player, min(start - player.interrupt, CHUNK_INTERRUPTS * 16))
+
+      while not player.finished:
+        player.muted = set(self.muted)
+        player, events = await loop.run_in_executor(self.server.pool, render_chunk, player, CHUNK_INTERRUPTS)
+        await self.queue.put(events)
+    except Exception as e:
+      # Bad bytecode stops the song, client gets told instead of waiting forever
+      await self.queue.put(f'{type(e).__name__}: {e}')
+
+    await self.queue.put(None)
+
+  async def stream(self, rate, start=0):
+    loop = asyncio.get_running_loop()
+    started = None
+
+    while (events := await self.queue.get()) is not None:
+      if isinstance(events, str):
+        await self.send({'error': events})
+        continue
+
+      # Paced from the first chunk after seek point, skipping doesn't count as playing time
+      if started is None:
+        started = loop.time()
+      if rate and events:
+        delay = started + (events[0][0] - start) / rate - loop.time()
+        if delay > 0:
+          await asyncio.sleep(delay)
+
+      for interrupt, chan, kind, a, b in events:
+        self.writer.write(json.dumps({'t': interrupt, 'ch': chan, 'ev': kind, 'a': a, 'b': b}).encode() + b'\n')
+      await self.writer.drain()
+
+    await self.send({'done': True})
+
+  async def stop(self):
+    for task in (self.render_task, self.send_task):
+      if task and not task.done():
+        task.cancel()
+        try:
+          await task
+        except asyncio.CancelledError:
+          pass
+    self.render_task = self.send_task = None
+    self.queue = asyncio.Queue(QUEUE_CHUNKS)
+
+  async def play(self, song, loops, rate, start=0):
+    await self.stop()
+    songs = self.server.songs
+    if not 0 <= song < len(songs):
+      raise ValueError(f'No song {song}, bank has {len(songs)}')
+
+    player = SongPlayer(self.server.data, songs[song], loops=loops)
+    self.playing = (song, loops, rate)
+    self.render_task = asyncio.create_task(self.render(player, start))
+    self.send_task = asyncio.create_task(self.stream(rate, start))
+
+  async def seek(self, interrupt):
+    # Player state only goes forward, so song is started again from the top either way
+    # and chunks queued before seek are dropped by stop()
+    if self.playing is None:
+      raise ValueError('Nothing is playing')
+    if interrupt < 0:
+      raise ValueError(f'Bad interrupt {interrupt}')
+    await self.play(*self.playing, start=interrupt)
+
+  async def handle(self, msg):
+    if not isinstance(msg, dict):
+      raise ValueError('expected object')
+    cmd = msg.get('cmd')
+
+    if cmd == 'songs':
+      await self.send({'songs': [f'{ptr:04x}' for ptr in self.server.songs]})
+    elif cmd == 'play':
+      await self.play(int(msg.get('song', 0)), int(msg.get('loops', 1)), float(msg.get('rate', 0)))
+    elif cmd == 'stop':
+      await self.stop()
+      self.playing = None
+      await self.send({'stopped': True})
+    elif cmd == 'seek':
+      await self.seek(int(msg['interrupt']))
+    elif cmd == 'mute':
+      if msg.get('on', True):
+        self.muted.add(int(msg['chan']))
+      else:
+        self.muted.discard(int(msg['chan']))
+    else:
+      raise ValueError(f'Unknown command {cmd!r}')
+
+  async def run(self):
+    try:
+      while line := await self.reader.readline():
+        try:
+          await self.handle(json.loads(line))
+        except (ValueError, KeyError, TypeError) as e:
+          await self.send({'error': str(e)})
+    except ConnectionError:
+      pass
+    finally:
+      await self.stop()
+      self.writer.close()
+
+
+class PlaybackServer:
+  def __init__(self, raw, workers=None):
+    fplay_parse.load_bank(raw)
+    self.data = fplay_parse.DATA
+    self.songs = song_pointers(self.data)
+    self.pool = ProcessPoolExecutor(workers, initializer=worker_init, initargs=(raw, fplay_parse.FORCE))
+
+  async def client(self, reader, writer):
+    await Session(self, reader, writer).run()
+
+  async def serve(self, unix=None, host='127.0.0.1', port=None):
+    if unix:
+      if os.path.exists(unix):
+        os.unlink(unix)
+      server = await asyncio.start_unix_server(self.client, unix)
+    else:
+      server = await asyncio.start_server(self.client, host, port)
+
+    async with server:
+      await server.serve_forever()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='FPLAY audition server')
+  parser.add_argument('file', help='Path to SONG.DAT')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-u', '--unix', help='Listen on this unix socket path')
+  parser.add_argument('-p', '--port', type=int, default=9898, help='Listen on localhost TCP port')
+  parser.add_argument('-w', '--workers', type=int, help='Render worker processes')
+  args = parser.parse_args()
+
+  fplay_parse.FORCE = args.force
+  with open(args.file, 'rb') as f:
+    server = PlaybackServer(f.read(), args.workers)
+
+  try:
+    asyncio.run(server.serve(args.unix, port=args.port))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.pool.shutdown(cancel_futures=True)
@@ -0,0 +1,601 @@
+#!/usr/bin/env python3
+import struct, argparse
+import fplay_parse
+import fplay_env
+from fplay_parse import HEADER_BASE_ADDR, NOTE_LEN_TBL, SNG_TBL
+from tools import *
+
+# Model of PLAY_INTERRUPT/PLAY from fplay.lst. One step() is one timer interrupt,
+# every track adds its speed to tempo_tick and only does work on overflow, same as driver.
+# We don't synthesize sound here, only emit events that driver would turn into register writes.
+
+TRACK_HDR_SIZE = 0xc
+FM_CHANNELS = 3
+
+# Byte classes as seen by PLAY fetch loop
+DRUM_BASE = 0xb0
+DRUM_END = 0xf0
+WAIT_BASE = 0xde
+WAIT_END = 0xef
+LEGATO_TOGGLE = 0x99
+
+# OPN registers we emit writes for
+OPN_KEY_ON_OFF = 0x28
+SSG_NOISE_PERIOD = 0x06
+
+# Event kinds, events are (interrupt, channel, kind, a, b) tuples
+EV_KEYON = 'on'       # a=note, b=volume
+EV_KEYOFF = 'off'
+EV_REG = 'reg'        # a=register, b=value
+EV_INSTRUMENT = 'inst'  # a=instrument
+EV_TEMPO = 'tempo'    # a=speed
+EV_ENVELOPE = 'env'   # a=envelope level, b=pitch envelope offset
+EV_END = 'end'
+
+
+def song_pointers(data):
+  ''' Walk song table the same way proc_songtable does, returns list of song header pointers
+  '''
+  tbl = int.from_bytes(data[SNG_TBL:SNG_TBL+2], 'little')
+  res = []
+  pos = tbl
+  while pos + 1 < len(data):
+    ptr = int.from_bytes(data[pos:pos+2], 'little')
+    if ptr in (0x0000, 0xffff):
+      pos += 2
+      continue
+    if ptr < HEADER_BASE_ADDR or ptr >= len(data) or ptr <= pos:
+      break
+    res.append(ptr)
+    pos += 2
+  return res
+
+
+def init_track(data, hdr_ptr, is_bgm=True):
+  ''' Same as INIT_TRACKS body for a single 12 byte track header
+  '''
+  num, flags, vol, vol_env, pitch_env, transpose, speed, chan, seq_ptr, instrument, unknown = \
+    struct.unpack('<BBbBBbBBHBB', data[hdr_ptr:hdr_ptr + TRACK_HDR_SIZE])
+
+  return mkobj(
+    'trackState',
+    num=num,
+    chan=chan,
+    flags=flags,
+    is_bgm=is_bgm,
+    pos=seq_ptr,
+    start=seq_ptr,
+    volume_vcmd=vol,
+    volume_track=vol,
+    vol_env=vol_env,
+    pitch_env=pitch_env,
+    transpose=transpose,
+    transpose_vcmd=0,
+    transpose_single=0,
+    tempo=speed,
+    tempo_tick=0,
+    instrument=instrument,
+    cycles_per_cmd=(unknown + 1) & 0xff,
+    cycles_left=1,
+    koff_cycle=2,
+    note=0,
+    key_held=False,
+    legato=False,
+    fm3=False,
+    fine_tune=0,
+    porta_speed=0,
+    loop_counter=0,
+    loop_escape=0,
+    jump_offset=None,
+    fade=0,
+    fade_tempo=0,
+    fade_tick=0,
+    soft_drum=0,
+    drum=None,
+    env_step=0,
+    released_at=None,
+    env_level=None,
+    pitch_offset=0,
+    loops=0,
+    active=True,
+    blocked=False,
+  )
+
+
+class SongPlayer:
+  ''' Steps one song of a bank through the driver model and collects events.
+      `data` is bank buffer with HEADER_BASE_ADDR padding, like fplay_parse.DATA.
+      Players are picklable without their bank, call attach() after unpickling.
+  '''
+
+  def __init__(self, data, song_ptr, loops=1, use_long=False):
+    self.song_ptr = song_ptr
+    self.loops = loops
+    self.use_long = use_long
+    self.interrupt = 0
+    self.muted = set()
+    self.pending_songs = []
+    self.attach(data)
+
+    self.tracks = []
+    self.start_song(song_ptr)
+
+  def attach(self, data):
+    self.data = data
+    self.parser = SequenceParser(self.use_long, data)
+    self.note_len = data[self.get_word(NOTE_LEN_TBL):][:0x10]
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['data'], state['parser']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.data = self.parser = None
+
+  def get_word(self, ptr):
+    return int.from_bytes(self.data[ptr:ptr+2], 'little')
+
+  def start_song(self, song_ptr):
+    count = self.data[song_ptr] & 0x7f
+    is_bgm = bool(self.data[song_ptr] & 0x80) or song_ptr == self.song_ptr
+
+    for i in range(count):
+      track = init_track(self.data, song_ptr + 1 + i * TRACK_HDR_SIZE, is_bgm)
+      # Track with same number takes over the driver slot
+      self.tracks = [t for t in self.tracks if t.num != track.num]
+      self.tracks.append(track)
+
+    # Driver walks slots from TRACK16 down, higher track number comes first and owns the channel
+    self.tracks.sort(key=lambda t: -t.num)
+
+  @property
+  def finished(self):
+    return all(not t.active or t.loops >= self.loops for t in self.tracks)
+
+  def emit(self, events, track, kind, a=None, b=None):
+    if track.blocked or track.chan in self.muted:
+      return
+    events.append((self.interrupt, track.chan, kind, a, b))
+
+  def step(self):
+    ''' Process one timer interrupt, returns list of events emitted during it
+    '''
+    events = []
+    claimed = set()
+
+    for song_ptr in self.pending_songs:
+      self.start_song(song_ptr)
+    self.pending_songs = []
+
+    for track in self.tracks:
+      if not track.active:
+        continue
+
+      # Lower priority tracks still run, but are not allowed to touch the chip
+      track.blocked = track.chan in claimed
+      claimed.add(track.chan)
+
+      self.fade(track)
+      self.play(track, events)
+      self.envelope(track, events)
+
+    self.interrupt += 1
+    return events
+
+  def run(self, max_interrupts=None):
+    ''' Generator over events until every track has stopped or looped enough
+    '''
+    while not self.finished:
+      if max_interrupts is not None and self.interrupt >= max_interrupts:
+        break
+      yield from self.step()
+
+  def seek(self, interrupt):
+    ''' Fast-forward without collecting events
+    '''
+    while self.interrupt < interrupt and not self.finished:
+      self.step()
+
+  def fade(self, track):
+    # PFADE
+    if not track.fade:
+      return
+    track.fade_tick += track.fade_tempo
+    overflow = track.fade_tick > 0xff or not track.fade_tick & 0xff
+    track.fade_tick &= 0xff
+    if not overflow:
+      return
+
+    vol = track.volume_vcmd
+    target = track.fade & 0x7f
+    if track.fade & 0x80:
+      vol -= 1
+      if vol < 0 or vol < target:
+        vol, track.fade = target, 0
+    else:
+      vol += 1
+      if vol >= target:
+        vol, track.fade = target, 0
+    track.volume_vcmd = track.volume_track = vol
+
+  def envelope(self, track, events):
+    # SOFTEV/VIBADD, envelopes advance once per interrupt from key on, curves come expanded
+    if not track.note:
+      return
+
+    if track.drum is not None:
+      vol_curve, pitch_curve = fplay_env.drum_curves(track.drum)[:2]
+    else:
+      vol_curve, pitch_curve = fplay_env.vol_curve(track.vol_env), fplay_env.pitch_curve(track.pitch_env)
+
+    step = track.env_step
+    track.env_step += 1
+    level = vol_curve.value(step, track.released_at) if vol_curve else 0xf
+    offset = track.pitch_offset
+    if pitch_curve and not track.porta_speed:
+      offset += pitch_curve.value(step)
+
+    if (level, offset) != (track.env_level, track.pitch_offset):
+      track.env_level, track.pitch_offset = level, offset
+      self.emit(events, track, EV_ENVELOPE, level, offset)
+
+  def play(self, track, events):
+    # PLAY, tick only happens when tempo_tick overflows
+    track.tempo_tick += track.tempo
+    overflow = track.tempo_tick > 0xff or not track.tempo_tick & 0xff
+    track.tempo_tick &= 0xff
+    if not overflow:
+      return
+
+    self.trace(track, 'tick')
+    cut = track.koff_cycle
+    if cut & 0x80:
+      cut = max(track.cycles_per_cmd - (cut & 0x7f), 0)
+    if cut >= track.cycles_left:
+      self.key_off(track, events)
+
+    track.cycles_left = (track.cycles_left - 1) & 0xff
+    if track.cycles_left:
+      return
+
+    self.fetch(track, events)
+
+  def fetch(self, track, events):
+    data = self.data
+
+    # Driver fetches until something takes time, more bytes than bank holds means it never will
+    budget = len(data)
+    while track.active:
+      pos = track.pos
+      budget -= 1
+      if budget < 0:
+        raise ValueError(f'Track {track.num} loops without advancing time')
+      code = data[pos]
+      self.trace(track, code)
+
+      if code < 0x80:
+        track.pos += 1
+        track.drum = None
+        self.note(track, code, events)
+        return
+
+      if DRUM_BASE <= code < DRUM_END:
+        track.pos += 1
+        self.note(track, self.drum(track, code - DRUM_BASE, events), events)
+        return
+
+      vcmd = self.parser.commands.get(code)
+      if vcmd is None:
+        raise KeyError(f'Unknown opcode byte {code:02x} at {pos:04x}')
+
+      track.pos += vcmd.length
+      args = self.args(pos, vcmd)
+      handler = self.handlers.get(code, SongPlayer.vcmd_nop)
+      if handler(self, track, args, events):
+        return
+
+  def trace(self, track, item):
+    # Called on every tick and every fetched byte, for tools that want to know what ran
+    pass
+
+  def args(self, pos, vcmd):
+    res = []
+    pos += 1
+    for p in vcmd.parameters:
+      res.append(p.parser(self.data[pos:pos + p.length]))
+      pos += p.length
+    return res
+
+  def drum(self, track, idx, events):
+    # Drum macro sets up instrument and envelopes, then plays its note
+    tbl = self.get_word(fplay_parse.DRUM_MACRO_TBL)
+    instr, note, vol_mod, vol_env, pitch_env, mask_env, noise_env = \
+      struct.unpack('<BBbHHHH', self.data[tbl + idx * 0xb:tbl + idx * 0xb + 0xb])
+
+    track.instrument = instr
+    track.drum = idx
+    track.volume_track = max(track.volume_vcmd - vol_mod, 0)
+    self.emit(events, track, EV_INSTRUMENT, instr)
+    return note
+
+  def note(self, track, note, events):
+    data = self.data
+
+    # Length that follows note is sticky, it stays until next one
+    nxt = data[track.pos]
+    if WAIT_BASE <= nxt < WAIT_END:
+      track.pos += 1
+      if nxt == WAIT_BASE:
+        track.cycles_per_cmd = data[track.pos]
+        track.pos += 1
+      else:
+        track.cycles_per_cmd = self.note_len[nxt - WAIT_BASE - 1]
+
+    if data[track.pos] == LEGATO_TOGGLE and track.legato:
+      track.legato = False
+      track.pos += 1
+
+    self.key_off(track, events)
+    self.key_on(track, note, events)
+    track.cycles_left = track.cycles_per_cmd
+
+  def key_off(self, track, events):
+    if track.legato:
+      return
+    if track.key_held:
+      self.emit(events, track, EV_KEYOFF)
+      if track.chan < FM_CHANNELS:
+        self.emit(events, track, EV_REG, OPN_KEY_ON_OFF, track.chan & 3)
+      track.released_at = track.env_step
+    track.key_held = False
+
+  def key_on(self, track, note, events):
+    if track.key_held and track.legato:
+      track.note = note
+      return
+
+    track.note = note
+    if not note:
+      # Rest, driver stores note 0 and doesn't key on
+      track.drum = None
+      return
+
+    pitch = (note - 1 + track.transpose + track.transpose_vcmd) & 0x7f
+    self.emit(events, track, EV_KEYON, pitch, track.volume_track)
+    if track.chan < FM_CHANNELS:
+      self.emit(events, track, EV_REG, OPN_KEY_ON_OFF, 0xf0 | (track.chan & 3))
+    track.key_held = True
+    track.volume_track = track.volume_vcmd
+    track.env_step = 0
+    track.released_at = None
+    track.env_level = None
+    track.pitch_offset = 0
+
+  # Vcmd handlers, return True when fetch loop must stop for this tick
+
+  def vcmd_nop(self, track, args, events):
+    return False
+
+  def vcmd_goto(self, track, args, events):
+    track.pos = args[0]
+    track.loops += 1
+    return False
+
+  def vcmd_jcnz(self, track, args, events):
+    sel, addr = args
+    if sel:
+      track.loop_escape = (track.loop_escape - 1) & 0xff
+      left = track.loop_escape
+    else:
+      track.loop_counter = (track.loop_counter - 1) & 0xff
+      left = track.loop_counter
+    if left:
+      track.pos = addr
+    return False
+
+  def vcmd_stop(self, track, args, events):
+    self.key_off(track, events)
+    track.active = False
+    self.emit(events, track, EV_END)
+    return True
+
+  def vcmd_set_loop(self, track, args, events):
+    mode, n = args
+    if mode:
+      track.loop_escape = n
+    else:
+      track.loop_counter = n
+    return False
+
+  def vcmd_pitch_env(self, track, args, events):
+    track.pitch_env = args[0]
+    return False
+
+  def vcmd_vol_env(self, track, args, events):
+    track.vol_env = args[0]
+    return False
+
+  def vcmd_portamento(self, track, args, events):
+    track.porta_speed = args[0]
+    track.transpose_single = 0
+    return False
+
+  def vcmd_set_volumes(self, track, args, events):
+    track.volume_vcmd = track.volume_track = args[0]
+    return False
+
+  def vcmd_transpose(self, track, args, events):
+    track.transpose_vcmd = (track.transpose_vcmd + args[0] + 0x80) % 0x100 - 0x80
+    return False
+
+  def vcmd_add_volume(self, track, args, events):
+    track.volume_vcmd = track.volume_track = min(max(track.volume_vcmd + args[0], 0), 0xf)
+    return False
+
+  def vcmd_song_offset(self, track, args, events):
+    # Driver picks up queued song on next interrupt, by raw song table index
+    if args[0]:
+      self.pending_songs.append(self.get_word(self.get_word(SNG_TBL) + args[0] * 2))
+    return False
+
+  def vcmd_soft_drum(self, track, args, events):
+    track.soft_drum = args[0]
+    return False
+
+  def vcmd_noise_period(self, track, args, events):
+    self.emit(events, track, EV_REG, SSG_NOISE_PERIOD, args[0])
+    return False
+
+  def vcmd_fade(self, track, args, events):
+    track.fade = args[0] & 0xff
+    track.fade_tempo = args[1]
+    track.fade_tick = 0
+    return False
+
+  def vcmd_transpose_once(self, track, args, events):
+    track.transpose_single = args[0]
+    track.porta_speed = 0
+    return False
+
+  def vcmd_jump_if_fading(self, track, args, events):
+    if track.fade:
+      track.pos = args[0]
+    return False
+
+  def vcmd_speed(self, track, args, events):
+    track.tempo = args[0]
+    self.emit(events, track, EV_TEMPO, args[0])
+    return False
+
+  def vcmd_finetune(self, track, args, events):
+    track.fine_tune = args[0]
+    return False
+
+  def vcmd_legato_on(self, track, args, events):
+    track.legato = True
+    return False
+
+  def vcmd_legato_off(self, track, args, events):
+    track.legato = False
+    return False
+
+  def vcmd_enter(self, track, args, events):
+    track.jump_offset = track.pos
+    track.pos = args[0]
+    return False
+
+  def vcmd_return(self, track, args, events):
+    if track.jump_offset is None:
+      raise ValueError(f'Return without enter on track {track.num}')
+    track.pos = track.jump_offset
+    return False
+
+  def vcmd_note_cut(self, track, args, events):
+    track.koff_cycle = args[0]
+    return False
+
+  def vcmd_jump_if_fm(self, track, args, events):
+    if track.chan < FM_CHANNELS:
+      track.pos = args[0]
+    return False
+
+  def vcmd_jump_if_ssg(self, track, args, events):
+    if track.chan >= FM_CHANNELS:
+      track.pos = args[0]
+    return False
+
+  def vcmd_instrument(self, track, args, events):
+    track.instrument = args[0]
+    self.emit(events, track, EV_INSTRUMENT, args[0])
+    return False
+
+  def vcmd_skip_if_fm(self, track, args, events):
+    if track.chan < FM_CHANNELS:
+      track.pos += 2
+    return False
+
+  def vcmd_skip_if_ssg(self, track, args, events):
+    if track.chan >= FM_CHANNELS:
+      track.pos += 2
+    return False
+
+  def vcmd_write_reg(self, track, args, events):
+    self.emit(events, track, EV_REG, args[0], args[1])
+    return False
+
+  def vcmd_skip_if_chan(self, track, args, events):
+    if args[0] == track.chan:
+      track.pos += 2
+    return False
+
+  def vcmd_jump_if_chan(self, track, args, events):
+    if args[0] == track.chan:
+      track.pos = args[1]
+    return False
+
+  def vcmd_toggle_fm3(self, track, args, events):
+    track.fm3 = not track.fm3
+    return False
+
+  handlers = {
+    0x80: vcmd_goto,
+    0x81: vcmd_jcnz,
+    0x82: vcmd_stop,
+    0x83: vcmd_pitch_env,
+    0x84: vcmd_portamento,
+    0x85: vcmd_stop,
+    0x87: vcmd_set_volumes,
+    0x88: vcmd_vol_env,
+    0x89: vcmd_transpose,
+    0x8a: vcmd_add_volume,
+    0x8b: vcmd_song_offset,
+    0x8d: vcmd_set_loop,
+    0x8e: vcmd_soft_drum,
+    0x92: vcmd_noise_period,
+    0x93: vcmd_fade,
+    0x94: vcmd_transpose_once,
+    0x95: vcmd_jump_if_fading,
+    0x96: vcmd_speed,
+    0x97: vcmd_finetune,
+    0x98: vcmd_stop,
+    0x99: vcmd_legato_on,
+    0x9a: vcmd_enter,
+    0x9b: vcmd_return,
+    0x9c: vcmd_stop,
+    0x9d: vcmd_note_cut,
+    0x9e: vcmd_stop,
+    0x9f: vcmd_stop,
+    0xa0: vcmd_stop,
+    0xa1: vcmd_jump_if_fm,
+    0xa2: vcmd_jump_if_ssg,
+    0xa3: vcmd_instrument,
+    0xa5: vcmd_skip_if_fm,
+    0xa6: vcmd_skip_if_ssg,
+    0xa7: vcmd_write_reg,
+    0xa9: vcmd_skip_if_chan,
+    0xaa: vcmd_jump_if_chan,
+    0xab: vcmd_toggle_fm3,
+    0xae: vcmd_legato_on,
+    0xaf: vcmd_legato_off,
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Dump FPLAY driver events for a song')
+  parser.add_argument('file', help='Path to SONG.DAT')
+  parser.add_argument('song', type=int, nargs='?', default=0, help='Song index in song table')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-n', '--loops', type=int, default=1, help='Stop after every track looped this many times')
+  parser.add_argument('-m', '--max', type=int, default=100000, help='Stop after this many interrupts')
+  args = parser.parse_args()
+
+  fplay_parse.FORCE = args.force
+  with open(args.file, 'rb') as f:
+    fplay_parse.load_bank(f.read())
+
+  songs = song_pointers(fplay_parse.DATA)
+  player = SongPlayer(fplay_parse.DATA, songs[args.song], loops=args.loops)
+  for interrupt, chan, kind, a, b in player.run(args.max):
+    orig_print(interrupt, chan, kind, *(x for x in (a, b) if x is not None), sep='\t')
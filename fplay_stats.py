@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import os, sys, csv, json, argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import fplay_parse
+from fplay_flow import CodeWalker, ENTER
+from tools import *
+
+# Corpus statistics over many banks. Every bank is decoded in a worker process which
+# returns small Counter aggregates, main process only merges them, so memory use depends
+# on number of distinct opcodes and argument values, not on corpus size.
+
+SECTIONS = ('opcodes', 'args', 'features', 'subroutine_depth', 'song_channels', 'banks')
+
+FM3_OPCODES = {0xab, 0xac, 0xad}
+LEGATO_OPCODES = {0x99, 0xae, 0xaf}
+
+
+def new_stats():
+  return {section: Counter() for section in SECTIONS}
+
+
+def merge_stats(total, part):
+  for section in SECTIONS:
+    total[section].update(part[section])
+  return total
+
+
+def enter_depth(walker, start, depth_cache, active=()):
+  ''' Deepest enter nesting reachable from code at start, nested enter recursion counts once
+  '''
+  if start in depth_cache:
+    return depth_cache[start]
+  if start in active:
+    return 0
+
+  depth = 0
+  for block in walker.blocks([start]).values():
+    for ins in block:
+      if ins._vcmd and walker.opcode(ins) == ENTER:
+        depth = max(depth, 1 + enter_depth(walker, walker.target(ins), depth_cache, active + (start,)))
+
+  depth_cache[start] = depth
+  return depth
+
+
+def bank_stats(path, force=False, use_long=False):
+  stats = new_stats()
+  fplay_parse.FORCE = force
+  fplay_parse.LONG_VCMDS = use_long
+
+  try:
+    with open(path, 'rb') as f:
+      fplay_parse.load_bank(f.read())
+  except Exception as e:
+    stats['banks']['failed'] += 1
+    # struct.error alone would say just error:error
+    kind = type(e).__name__ if type(e).__module__ == 'builtins' else f'{type(e).__module__}.{type(e).__name__}'
+    stats['banks'][f'error:{kind}'] += 1
+    return stats
+
+  stats['banks']['decoded'] += 1
+  uses = set()
+
+  for obj in fplay_parse.ADDR_MAP.values():
+    if not isinstance(obj, Token):
+      continue
+
+    if obj._vcmd is None:
+      stats['opcodes']['drum' if isinstance(obj, Drum) else 'note'] += 1
+      continue
+
+    stats['opcodes'][obj.name] += 1
+    # Word parameters are addresses or frequencies, histogram of those is just noise
+    for p, (param, value) in zip(obj._vcmd.parameters, obj.args.items()):
+      if p.length == 1:
+        stats['args'][f'{obj.name}.{param}={value}'] += 1
+
+    code = fplay_parse.DATA[obj.addr]
+    if code in FM3_OPCODES:
+      uses.add('fm3')
+    if code in LEGATO_OPCODES:
+      uses.add('legato')
+    if obj._vcmd.is_final:
+      uses.add(obj.name)
+
+  walker = CodeWalker(fplay_parse.DATA, use_long)
+  depth_cache = {}
+
+  for obj in list(fplay_parse.ADDR_MAP.values()):
+    if getattr(obj, 'name', None) != 'song':
+      continue
+
+    stats['features']['songs'] += 1
+    song_ptr = obj.pos
+    chans = set()
+    for i in range(fplay_parse.DATA[song_ptr] & 0xf):
+      hdr_ptr = song_ptr + 1 + i * 0xc
+      chans.add(fplay_parse.DATA[hdr_ptr + 7])
+      seq_ptr = fplay_parse.get_word(hdr_ptr + 8)
+      try:
+        stats['subroutine_depth'][enter_depth(walker, seq_ptr, depth_cache)] += 1
+      except (KeyError, ValueError, IndexError):
+        stats['subroutine_depth']['undecodable'] += 1
+    stats['song_channels'][len(chans)] += 1
+
+  for use in uses:
+    stats['features'][f'banks_with_{use}'] += 1
+
+  return stats
+
+
+def find_banks(paths, ext):
+  for path in paths:
+    if os.path.isdir(path):
+      for root, _, files in os.walk(path):
+        for name in sorted(files):
+          if name.upper().endswith(ext):
+            yield os.path.join(root, name)
+    else:
+      yield path
+
+
+def collect(paths, workers=None, force=False, use_long=False, ext='.DAT'):
+  ''' Streams banks through a process pool, returns merged statistics
+  '''
+  total = new_stats()
+  files = find_banks(paths, ext)
+
+  with ProcessPoolExecutor(workers) as pool:
+    # Keep a bounded number of banks in flight so huge corpora don't queue everything at once
+    limit = (workers or os.cpu_count() or 1) * 4
+    pending = set()
+    for path in files:
+      pending.add(pool.submit(bank_stats, path, force, use_long))
+      if len(pending) >= limit:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+          merge_stats(total, fut.result())
+
+    for fut in pending:
+      merge_stats(total, fut.result())
+
+  return total
+
+
+def to_json(stats):
+  return {section: {str(k): v for k, v in stats[section].most_common()} for section in SECTIONS}
+
+
+def write_csv(stats, out):
+  writer = csv.writer(out)
+  writer.writerow(('section', 'key', 'count'))
+  for section in SECTIONS:
+    for key, count in stats[section].most_common():
+      writer.writerow((section, key, count))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Aggregate opcode and feature usage over many FPLAY banks')
+  parser.add_argument('paths', nargs='+', help='Bank files or directories to scan')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-l', '--long', action='store_true', help='Use long command names')
+  parser.add_argument('-j', '--jobs', type=int, help='Worker processes')
+  parser.add_argument('-e', '--ext', default='.DAT', help='Bank file extension when scanning directories')
+  parser.add_argument('-o', '--format', choices=('json', 'csv'), default='json', help='Output format')
+  args = parser.parse_args()
+
+  stats = collect(args.paths, args.jobs, args.force, args.long, args.ext.upper())
+  if args.format == 'csv':
+    write_csv(stats, sys.stdout)
+  else:
+    orig_print(json.dumps(to_json(stats), indent=2))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import os, hashlib, argparse
+from array import array
+import numpy as np
+import fplay_parse
+from fplay_parse import HEADER_BASE_ADDR
+from fplay_sim import SongPlayer, song_pointers, EV_KEYON, EV_KEYOFF, EV_REG, EV_INSTRUMENT, EV_TEMPO, \
+  EV_ENVELOPE, EV_END
+from tools import *
+
+# Song flattened into columns once: driver model runs it, loops come out unrolled and enter/return
+# inlined, every event gets address of the token that the track fetched last. Tools can answer
+# "notes per channel" or "events per tick" with numpy instead of interpreting bytecode again.
+#
+#   tick   interrupt number        chan   driver channel        kind   index into KINDS
+#   a, b   event values, see fplay_sim event kinds                      addr   source token address
+#   track  driver track number     drum   drum macro of key on, -1 otherwise
+
+KINDS = (EV_KEYON, EV_KEYOFF, EV_REG, EV_INSTRUMENT, EV_TEMPO, EV_ENVELOPE, EV_END)
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+COLUMNS = {
+  'tick': ('I', np.uint32),
+  'chan': ('B', np.uint8),
+  'kind': ('B', np.uint8),
+  'a': ('h', np.int16),
+  'b': ('h', np.int16),
+  'addr': ('H', np.uint16),
+  'track': ('B', np.uint8),
+  'drum': ('b', np.int8),
+}
+CACHE_VERSION = 1
+
+
+class TimelinePlayer(SongPlayer):
+  ''' Appends events to columns instead of returning them
+  '''
+
+  def __init__(self, data, song_ptr, loops=1, envelopes=True):
+    self.columns = {name: array(code) for name, (code, _) in COLUMNS.items()}
+    self.source = {}
+    self.envelopes = envelopes
+    super().__init__(data, song_ptr, loops=loops)
+
+  def trace(self, track, item):
+    if item != 'tick':
+      self.source[track.num] = track.pos
+
+  def envelope(self, track, events):
+    if self.envelopes:
+      super().envelope(track, events)
+
+  def emit(self, events, track, kind, a=None, b=None):
+    if track.blocked or track.chan in self.muted:
+      return
+    row = (self.interrupt, track.chan, KIND_CODES[kind], a or 0, b or 0,
+           self.source.get(track.num, track.start), track.num, -1 if track.drum is None else track.drum)
+    for column, value in zip(self.columns.values(), row):
+      column.append(value)
+
+
+class Timeline:
+  ''' Columnar events of one song, columns are numpy arrays of the same length
+  '''
+
+  def __init__(self, columns, meta):
+    self.meta = meta
+    for name, (_, dtype) in COLUMNS.items():
+      setattr(self, name, np.asarray(columns[name], dtype))
+
+  @classmethod
+  def build(cls, data, song_ptr, loops=1, max_interrupts=None, envelopes=True):
+    player = TimelinePlayer(data, song_ptr, loops, envelopes)
+    for _ in player.run(max_interrupts):
+      pass
+    meta = {'song_ptr': song_ptr, 'loops': loops, 'interrupts': player.interrupt}
+    return cls({name: np.frombuffer(col, dtype) if len(col) else [] for (name, col), (_, dtype)
+                in zip(player.columns.items(), COLUMNS.values())}, meta)
+
+  def __len__(self):
+    return len(self.tick)
+
+  def save(self, path):
+    np.savez_compressed(path, **{name: getattr(self, name) for name in COLUMNS},
+                        meta=np.array([CACHE_VERSION, self.meta['song_ptr'], self.meta['loops'],
+                                       self.meta['interrupts']]))
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path) as f:
+      version, song_ptr, loops, interrupts = f['meta'].tolist()
+      if version != CACHE_VERSION:
+        raise ValueError(f'{path}: timeline cache version {version}, expected {CACHE_VERSION}')
+      return cls({name: f[name] for name in COLUMNS}, {'song_ptr': song_ptr, 'loops': loops, 'interrupts': interrupts})
+
+  def of(self, kind):
+    return self.kind == KIND_CODES[kind]
+
+  def notes_per_channel(self):
+    return np.bincount(self.chan[self.of(EV_KEYON)], minlength=self.chan.max(initial=0) + 1)
+
+  def density(self, window=1):
+    ''' Events per window of interrupts
+    '''
+    return np.bincount(self.tick // window, minlength=self.meta['interrupts'] // window + 1)
+
+  def hot_addresses(self, count=10):
+    ''' Token addresses that produced most key ons, [(address, key ons)]
+    '''
+    addrs, counts = np.unique(self.addr[self.of(EV_KEYON)], return_counts=True)
+    best = np.argsort(-counts, kind='stable')[:count]
+    return list(zip(addrs[best].tolist(), counts[best].tolist()))
+
+
+def cached(raw, song, loops=1, max_interrupts=None, cache_dir=None):
+  ''' Timeline of song index in bank, from cache_dir when the same bank bytes were flattened before.
+      Bank has to be loaded into fplay_parse already.
+  '''
+  path = None
+  if cache_dir:
+    key = hashlib.blake2b(raw, digest_size=12)
+    key.update(repr((song, loops, max_interrupts)).encode())
+    path = os.path.join(cache_dir, key.hexdigest() + '.npz')
+    if os.path.exists(path):
+      return Timeline.load(path)
+
+  songs = song_pointers(fplay_parse.DATA)
+  if not 0 <= song < len(songs):
+    raise ValueError(f'No song {song}, bank has {len(songs)} songs')
+  timeline = Timeline.build(fplay_parse.DATA, songs[song], loops, max_interrupts)
+  if path:
+    os.makedirs(cache_dir, exist_ok=True)
+    timeline.save(path)
+  return timeline
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Flatten FPLAY song into columnar event timeline')
+  parser.add_argument('file', help='Path to SONG.DAT')
+  parser.add_argument('song', type=int, nargs='?', default=0, help='Song index in song table')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-n', '--loops', type=int, default=1, help='Stop after every track looped this many times')
+  parser.add_argument('-m', '--max', type=int, default=100000, help='Stop after this many interrupts')
+  parser.add_argument('-o', '--out', help='Save timeline to this .npz file')
+  parser.add_argument('-c', '--cache', help='Directory to keep timelines in, keyed by bank bytes')
+  parser.add_argument('-w', '--window', type=int, default=64, help='Interrupts per bin of density summary')
+  args = parser.parse_args()
+
+  fplay_parse.FORCE = args.force
+  with open(args.file, 'rb') as f:
+    raw = f.read()
+  fplay_parse.load_bank(raw)
+  songs = len(song_pointers(fplay_parse.DATA))
+  if not 0 <= args.song < songs:
+    parser.error(f'song {args.song} out of range, {args.file} has {songs} songs')
+
+  try:
+    timeline = cached(raw, args.song, args.loops, args.max, args.cache)
+  except ValueError as e:
+    raise SystemExit(f'{args.file}: {e}')
+  if args.out:
+    timeline.save(args.out)
+
+  orig_print(f'events\t{len(timeline)}\tover {timeline.meta["interrupts"]} interrupts')
+  for chan, count in enumerate(timeline.notes_per_channel().tolist()):
+    orig_print(f'chan {chan}\t{count} notes')
+  density = timeline.density(args.window)
+  orig_print(f'busiest\t{density.max(initial=0)} events in {args.window} interrupts from {density.argmax() * args.window}')
+  for addr, count in timeline.hot_addresses(5):
+    orig_print(f'{addr - HEADER_BASE_ADDR:04x}\t{count} key ons')
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import os, sys, time, hashlib, argparse
+from fplay_daemon import decompile, compile_listing
+from tools import *
+
+# Watches banks, listings and grammars and redoes only what a change affects:
+#
+#   NAME.DAT     decoded again into NAME.M when its bytes changed, listing of the same bytes comes from memory
+#   NAME.M       compiled into NAME.M.bin like compile.sh does
+#   vcmds*.json  banks are decoded again when it is decode grammar, listings compiled again when it is
+#                compile grammar
+#
+# Files are polled by mtime and size, nothing outside of python is needed. Changes are collected
+# until nothing changed for debounce interval, so editor saving in several writes triggers one rebuild.
+# Listing written by watcher itself is remembered by digest and doesn't trigger compile.
+
+BANK_EXT = '.DAT'
+LISTING_EXT = '.M'
+POLL_INTERVAL = 0.1
+DEBOUNCE = 0.25
+
+
+def file_digest(path):
+  with open(path, 'rb') as f:
+    return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+class Watcher:
+  def __init__(self, paths, use_long=False, grammar=None, force=False, scan=False, debounce=DEBOUNCE,
+               build=True):
+    self.paths = paths
+    self.build = build
+    self.use_long = use_long
+    self.force = force
+    self.scan = scan
+    self.decode_grammar = grammar_path(use_long)
+    self.grammar = grammar or self.decode_grammar
+    self.debounce = debounce
+
+    self.stats = self.snapshot()
+    self.digests = {path: file_digest(path) for path in self.stats}
+    # (bank digest, grammar digest) -> listing text
+    self.listings = {}
+
+  def snapshot(self):
+    ''' {path: (mtime, size)} of every watched file
+    '''
+    res = {}
+    found = [x for x in {self.decode_grammar, self.grammar} if os.path.exists(x)]
+    for path in self.paths:
+      if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+          found += [os.path.join(root, x) for x in files if x.upper().endswith((BANK_EXT, LISTING_EXT))]
+      else:
+        found.append(path)
+
+    for path in found:
+      try:
+        st = os.stat(path)
+      except FileNotFoundError:
+        continue
+      res[os.path.normpath(path)] = (st.st_mtime_ns, st.st_size)
+    return res
+
+  def changed(self):
+    stats = self.snapshot()
+    res = {path for path, st in stats.items() if self.stats.get(path) != st}
+    self.stats = stats
+    return res
+
+  def content_changed(self, path):
+    # Touch without change and our own writes are not worth a rebuild
+    try:
+      dig = file_digest(path)
+    except FileNotFoundError:
+      return False
+    if self.digests.get(path) == dig:
+      return False
+    self.digests[path] = dig
+    return True
+
+  def decode(self, bank):
+    started = time.monotonic()
+    key = (self.digests[bank], self.digests.get(self.decode_grammar))
+    text = self.listings.get(key)
+    if text is None:
+      try:
+        text = self.listings[key] = decompile(bank, self.use_long, force=self.force, scan=self.scan)
+      except Exception as e:
+        orig_print(f'{bank}: {type(e).__name__}: {e}', file=sys.stderr)
+        return
+
+    listing = os.path.splitext(bank)[0] + LISTING_EXT
+    with open(listing, 'w') as f:
+      f.write(text)
+    self.digests[listing] = file_digest(listing)
+    self.stats[listing] = (os.stat(listing).st_mtime_ns, os.stat(listing).st_size)
+    orig_print(f'decoded {bank} -> {listing} in {time.monotonic() - started:.2f} s')
+    return listing
+
+  def compile(self, listing):
+    started = time.monotonic()
+    try:
+      code, out, err = compile_listing(listing, self.grammar)
+    except Exception as e:
+      code, out, err = 1, '', f'{type(e).__name__}: {e}\n'
+    if code:
+      sys.stderr.write(out + err)
+      orig_print(f'{listing}: compile failed', file=sys.stderr)
+      return
+    orig_print(f'compiled {listing} -> {listing}.bin in {time.monotonic() - started:.2f} s')
+
+  def handle(self, paths):
+    changed = {x for x in paths if self.content_changed(x)}
+    grammars = {os.path.abspath(x) for x in changed} & {os.path.abspath(x) for x in (self.decode_grammar, self.grammar)}
+    banks = {x for x in self.stats if x.upper().endswith(BANK_EXT)}
+    listings = {x for x in self.stats if x.upper().endswith(LISTING_EXT)}
+
+    if os.path.abspath(self.decode_grammar) not in grammars:
+      banks &= changed
+    if os.path.abspath(self.grammar) not in grammars:
+      listings &= changed
+
+    for bank in sorted(banks):
+      listing = self.decode(bank)
+      if listing:
+        listings.add(listing)
+    for listing in sorted(listings) if self.build else ():
+      self.compile(listing)
+
+  def run(self):
+    pending = set()
+    last = 0
+    while True:
+      changed = self.changed()
+      now = time.monotonic()
+      if changed:
+        pending |= changed
+        last = now
+      elif pending and now - last >= self.debounce:
+        self.handle(pending)
+        pending = set()
+      time.sleep(POLL_INTERVAL)
+
+
+def watch(paths, use_long=False, grammar=None, force=False, scan=False, debounce=DEBOUNCE, build=True):
+  ''' Runs until interrupted, build=False only decodes banks
+  '''
+  orig_print(f'watching {", ".join(paths)}')
+  try:
+    Watcher(paths, use_long, grammar, force, scan, debounce, build).run()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Decode changed FPLAY banks and compile changed listings')
+  parser.add_argument('paths', nargs='*', default=['.'], help='Banks, listings or directories to watch')
+  parser.add_argument('-g', '--grammar', help='Grammar to compile listings with, decode grammar by default')
+  parser.add_argument('-f', '--force', action='store_true', help='Don\'t check magic')
+  parser.add_argument('-l', '--long', action='store_true', help='Use long command names for listing')
+  parser.add_argument('-s', '--scan', action='store_true', help='Also decode songs and tracks nothing points at')
+  parser.add_argument('-t', '--debounce', type=float, default=DEBOUNCE, help='Quiet seconds before rebuilding')
+  args = parser.parse_args()
+
+  watch(args.paths, args.long, args.grammar, args.force, args.scan, args.debounce)
@@ -246,12 +246,8 @@ function is_arg0(tok) {{ return (tok in arg0); }}
 """
   return awk
 
-def main():
-  ap = argparse.ArgumentParser(description="Generate vcmds.inc and preproc.awk from JSON grammar.")
-  ap.add_argument("grammar", help="Path to grammar file")
-  args = ap.parse_args()
-
-  with open(args.grammar, "r", encoding="utf-8") as f:
+def generate(grammar):
+  with open(grammar, "r", encoding="utf-8") as f:
     data = json.load(f)
 
   with open("vcmds.inc", "w", encoding="utf-8") as f:
@@ -259,5 +255,11 @@ def main():
   with open("preproc.awk", "w", encoding="utf-8") as f:
     f.write(generate_awk_preprocessor(data))
 
+def main():
+  ap = argparse.ArgumentParser(description="Generate vcmds.inc and preproc.awk from JSON grammar.")
+  ap.add_argument("grammar", help="Path to grammar file")
+  args = ap.parse_args()
+  generate(args.grammar)
+
 if __name__ == "__main__":
   main()
@@ -1,7 +1,8 @@
+import os
 import sys
 import builtins
 import json
-from types import SimpleNamespace
+from types import SimpleNamespace, MappingProxyType
 
 # Override print to use hex() for ints
 orig_print = builtins.print
@@ -99,15 +100,210 @@ class mkobj(SimpleNamespace):
         return f"{self._name}{attrs}"
 
 
+def macro_value(value):
+  ''' Numbers are rendered as 3 digit decimals, words as fasm hex
+  '''
+  if type(value) == int:
+    return f'0{value:04x}h' if value > 255 else f'{value:03d}'
+  return str(value)
+
+
+class Node:
+  ''' Base of decoded bank objects. Subclass lists rendered attributes in `fields`, in listing order,
+      other attributes in `extra`, and declares both in __slots__. Fields that hold addresses
+      are listed in `pointers`, listing replaces them with labels.
+  '''
+  __slots__ = ('_addr', 'length', 'label')
+  fields = ()
+  extra = ()
+  pointers = ()
+  inline = False      # shares listing line with neighbours instead of taking its own
+  annotated = True    # field names are commented above run of same objects
+
+  def __init__(self, *values, **kwargs):
+    self.label = None
+    for field, value in zip(self.fields, values):
+      setattr(self, field, value)
+    for key, value in kwargs.items():
+      setattr(self, key, value)
+
+  def macro_args(self):
+    return [macro_value(getattr(self, x)) for x in self.fields]
+
+  def relabel(self, label_of):
+    ''' Replaces pointer fields with label_of(address) where it gives one
+    '''
+    for attr in self.pointers:
+      label = label_of(getattr(self, attr))
+      if label:
+        setattr(self, attr, label)
+
+  def as_macro(self):
+    attrs = self.macro_args()
+    if attrs and attrs[0]:
+      return f'{self.name} {" ".join(attrs)}'
+    return self.name
+
+  def annotate(self):
+    ''' Argument list for comment above run of same objects
+    '''
+    return f'{self.name} {", ".join(self.fields)}'
+
+  def __repr__(self):
+    attrs = ', '.join(f'{k}={getattr(self, k)!r}' for k in self.fields + self.extra if hasattr(self, k))
+    return f'{type(self).__name__}({attrs})'
+
+
+class NamedNode(Node):
+  ''' Node kind whose macro name differs between instances
+  '''
+  __slots__ = ('name',)
+
+  def __init__(self, name, *values, **kwargs):
+    self.name = name
+    super().__init__(*values, **kwargs)
+
+
+class FmInstrument(Node):
+  name = 'fmInstrument'
+  fields = ('op1_dtml', 'op3_dtml', 'op2_dtml', 'op4_dtml', 'op1_tl', 'op3_tl', 'op2_tl', 'op4_tl',
+            'op1_ksar', 'op3_ksar', 'op2_ksar', 'op4_ksar', 'op1_dr', 'op3_dr', 'op2_dr', 'op4_dr',
+            'op1_sr', 'op3_sr', 'op2_sr', 'op4_sr', 'op1_slrr', 'op3_slrr', 'op2_slrr', 'op4_slrr',
+            'op1_ssge', 'op3_ssge', 'op2_ssge', 'op4_ssge', 'fbalg', 'unused1', 'unused2', 'unused3')
+  __slots__ = fields
+
+
+class DrumDef(Node):
+  name = 'drumDef'
+  fields = ('instr', 'note', 'vol_mod', 'vol_env_ptr', 'pitch_env_ptr', 'ssg_mask_env_ptr', 'ssg_noise_env_ptr')
+  pointers = fields[3:]
+  __slots__ = fields
+
+
+class EnvSeq(NamedNode):
+  ''' volSeq, pitchSeq, gateSeq or noiseSeq, tokens are values and marks
+  '''
+  fields = ('tokens',)
+  __slots__ = fields
+
+  def macro_args(self):
+    return [' '.join(str(x) for x in self.tokens)]
+
+
+class Pointer(NamedNode):
+  ''' Header table pointers, pVolSeq, pPitchSeq and song table entries
+  '''
+  fields = ('pos',)
+  pointers = fields
+  __slots__ = fields
+
+
+class SongDef(Node):
+  name = 'songDef'
+  fields = ('flags', 'track_count')
+  __slots__ = fields
+
+
+class Track(Node):
+  name = 'track'
+  fields = ('num', 'mode', 'vol', 'vol_env', 'pitch_env', 'transpose', 'speed', 'chan', 'seq_ptr', 'instrument',
+            'unknown')
+  pointers = ('seq_ptr',)
+  __slots__ = fields
+
+
+class NoteLen(Node):
+  name = 'noteLen'
+  fields = ('duration',)
+  __slots__ = fields
+
+
+class Magic(Node):
+  name = 'magic'
+  fields = ('data',)
+  __slots__ = fields
+
+
+class Location(Node):
+  ''' Raw byte that got label
+  '''
+  name = 'location'
+  extra = ('text',)
+  __slots__ = extra
+
+  def as_macro(self):
+    return self.text
+
+
+class Token(NamedNode):
+  ''' Sequence token, `name` is note, drum or command name from grammar
+  '''
+  fields = ('args',)
+  extra = ('addr',)
+  __slots__ = fields + extra
+  _vcmd = None
+  inline = True
+  annotated = False
+
+  def macro_args(self):
+    return [' '.join(str(v) for v in self.args.values())]
+
+
+class Note(Token):
+  __slots__ = ()
+  length = 1
+  args = MappingProxyType({})
+
+
+class Drum(Note):
+  __slots__ = ()
+
+
+class Command(Token):
+  extra = ('_vcmd',)
+  __slots__ = extra
+
+  @property
+  def length(self):
+    return self._vcmd.length
+
+  @property
+  def inline(self):
+    # Properties run together with notes, everything else takes its own line
+    return self._vcmd.is_property
+
+  def relabel(self, label_of):
+    if 'addr' in self.args:
+      label = label_of(self.args['addr'])
+      if label:
+        self.args['addr'] = label
+
+  @property
+  def text(self):
+    vcmd = self._vcmd
+    arg_repr = ', '.join(f'{k}={v:x}' for k, v in self.args.items())
+    if vcmd.is_property:
+      return f'{vcmd.name} {arg_repr}' if arg_repr else vcmd.name
+    return f'{vcmd.name}({arg_repr})'
+
+
+GRAMMAR_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def grammar_path(use_long=False):
+  ''' Grammar next to the tools, so they work from any directory
+  '''
+  return os.path.join(GRAMMAR_DIR, 'vcmds_long.json' if use_long else 'vcmds.json')
+
+
 class SequenceParser:
   """
-  Returns a SimpleNamespace with:
-    name: command name | 'note' | 'drum'
-    text: human-readable representation
+  Returns Command, Note or Drum node with:
+    name: command name | note name | 'mN' for drum
+    text: human-readable representation (commands only)
     length: number of bytes consumed from the front of `tokens`
-    vcmd: command meta (for kind='command'), else None
-    args: dict of parsed args for commands, else {}
-    is_terminal: True if command is final ('e' flag), else False
+    _vcmd: command meta for commands, else None
+    args: dict of parsed args for commands, else empty
   """
 
   note_prefixes = ['c', 'cs', 'd', 'ds', 'e', 'f', 'fs', 'g', 'gs', 'a', 'as', 'b']
@@ -119,13 +315,31 @@ class SequenceParser:
   }
 
 
+  # Parsed grammars shared by every parser instance, keyed by path and reloaded when file changes
+  _grammar_cache = {}
+
   def __init__(self, use_long, data_buffer):
-    defs = './vcmds_long.json' if use_long else './vcmds.json'
-    with open(defs, 'r', encoding='utf-8') as handle:
-      cfg = json.load(handle)
-    self.parse_configuration(cfg)
+    self.load_grammar(grammar_path(use_long))
     self.data = data_buffer
 
+  def load_grammar(self, defs):
+    path = os.path.abspath(defs)
+    mtime = os.stat(path).st_mtime_ns
+    cached = self._grammar_cache.get(path)
+
+    if cached is None or cached[0] != mtime:
+      with open(path, 'r', encoding='utf-8') as handle:
+        cfg = json.load(handle)
+      self.parse_configuration(cfg)
+      self._grammar_cache[path] = (mtime, {
+        k: getattr(self, k) for k in (
+          'note_lo', 'note_hi', 'drum_lo', 'drum_hi', 'commands',
+          'cmd_buckets', 'cmd_buckets_high', '_bucket_lengths_desc')
+      })
+      return
+
+    vars(self).update(cached[1])
+
 
   def parse_configuration(self, cfg):
     self.note_lo, self.note_hi = [int(x, 0) for x in cfg['notes']]
@@ -212,31 +426,13 @@ class SequenceParser:
         )
 
       pos = 1
-      arg_repr = []
       arg_map = {}
 
       for p in vcmd.parameters:
-        chunk = tokens[pos:pos + p.length]
-        val = p.parser(chunk)
-        arg_map[p.name] = val
-        arg_repr.append(f"{p.name}={val:x}")
+        arg_map[p.name] = p.parser(tokens[pos:pos + p.length])
         pos += p.length
 
-      if vcmd.parameters:
-        text = f"{vcmd.name} {', '.join(arg_repr)}" \
-          if vcmd.is_property \
-          else f"{vcmd.name}({', '.join(arg_repr)})"
-      else:
-        text = vcmd.name if vcmd.is_property else f"{vcmd.name}()"
-
-      # Return a dict the caller can pass to mkobj with addr
-      return {
-        "name": vcmd.name,
-        "text": text,
-        "length": need,
-        "_vcmd": vcmd,
-        "args": arg_map,
-      }
+      return vcmd, arg_map
 
     return None
 
@@ -246,27 +442,18 @@ class SequenceParser:
 
     cmd = self._parse_command_tokens(tokens)
     if cmd is not None:
-      return mkobj(addr=head_ptr, **cmd)
+      vcmd, args = cmd
+      return Command(vcmd.name, args, addr=head_ptr, _vcmd=vcmd)
 
     # Try parsing as note if we didn't find anything yet
     note = self._note_text(first)
     if note is not None:
-      return mkobj(
-        name=note,
-        addr=head_ptr,
-        length=1,
-        _vcmd=None,
-        args={})
+      return Note(note, addr=head_ptr)
 
     # Finally as drum
     drum = self._drum_text(first)
     if drum is not None:
-      return mkobj(
-        name=f'm{drum}',
-        addr=head_ptr,
-        length=1,
-        _vcmd=None,
-        args={})
+      return Drum(f'm{drum}', addr=head_ptr)
 
     # Fail otherwise
     raise KeyError(f"Unknown opcode byte: {first:02x}")